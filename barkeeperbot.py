@@ -3,13 +3,30 @@
 from __future__ import annotations
 
 import os
+import io
 import re
+import csv
+import json
+import codecs
+import difflib
+import hashlib
+import math
+import secrets
+import time
+import importlib
+import asyncio
 import logging
+import functools
+import threading
 import datetime as dt
-from typing import Dict, List, Tuple, Optional
+from array import array
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable, Dict, List, Tuple, Optional
+from zoneinfo import ZoneInfo
 
-import pandas as pd
-from pandas import DataFrame
+PROCESS_STARTED = time.monotonic()  # для замера времени до первого ответа
 
 from telegram import (
     Update,
@@ -19,15 +36,41 @@ from telegram import (
 )
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
     CommandHandler,
     MessageHandler,
     ConversationHandler,
     CallbackQueryHandler,
+    TypeHandler,
     ContextTypes,
     filters,
 )
+from telegram.request import BaseRequest
+from telegram.error import BadRequest, Forbidden, RetryAfter, TimedOut, NetworkError
 from dotenv import load_dotenv
 
+if TYPE_CHECKING:
+    from pandas import DataFrame
+
+
+class _LazyModule:
+    """Модуль импортируется при первом обращении к атрибуту (pandas тянет секунды на старте)."""
+
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            t0 = time.perf_counter()
+            self._module = importlib.import_module(self._name)
+            log.info("Импортировал %s за %.2f с", self._name, time.perf_counter() - t0)
+        return getattr(self._module, attr)
+
+
+pd = _LazyModule("pandas")
+np = _LazyModule("numpy")
+
 load_dotenv()
 
 # ================== НАСТРОЙКИ ==================
@@ -40,11 +83,42 @@ SHEET_INVENTORY = "inventory"
 SHEET_MOVES = "movements"
 SHEET_SETTINGS = "settings"  # пороги закупа
 SHEET_EXPIRY = "expiry"      # сроки годности
+SHEET_STOCKTAKE = "stocktake"  # пересчёты: ожидалось / насчитали
+SHEET_UNITS = "units"          # единицы: базовая, упаковка, порция по товарам
+
+CONFIG_FILE = "bar_state.json"  # настройки заведения: admin_ids, timezone (лежит в git)
+STATE_FILE = "bot_state.json"   # рабочее состояние бота: кэш file_id, запуски джоб (не в git)
 
 PAGE_SIZE = 10
 
-# Планировщик (локальное время)
-TZ = dt.timezone(dt.timedelta(hours=0))  # при необходимости замени на свой часовой пояс
+# Что делать, если расход уводит остаток в минус:
+# "flag" — записать и предупредить админов, "reject" — не записывать
+STOCK_POLICY = os.getenv("STOCK_POLICY", "flag")
+
+# Прогноз расхода
+FORECAST_ALPHA = 0.3         # вес последнего дня в сглаженном дневном расходе
+FORECAST_SEASON_ALPHA = 0.1  # скорость подстройки коэффициентов по дням недели
+SUPPLIER_LEAD_DAYS = int(os.getenv("SUPPLIER_LEAD_DAYS", "2"))  # сколько дней едет поставка
+ORDER_CYCLE_DAYS = 7         # закупаемся раз в неделю (напоминание по вторникам)
+SAFETY_Z = 1.65              # страховой запас ~95% уровня сервиса
+
+# Отмена записей
+UNDO_WINDOW_HOURS = 24       # отменить можно только свои записи за последние сутки
+UNDO_MAX = 10                # не больше стольких за раз
+
+# Детектор аномалий расхода
+ANOMALY_ALPHA = 0.1          # вес нового наблюдения в скользящих среднем/дисперсии
+ANOMALY_MIN_SAMPLES = 5      # пока истории меньше — не судим
+ANOMALY_Z = 3.0              # порог z-оценки
+ANOMALY_RATIO = 3.0          # и во сколько раз больше обычного
+
+# Исходящие сообщения (лимиты Telegram)
+TG_MESSAGE_LIMIT = 4096      # символов в одном сообщении
+SEND_GLOBAL_RATE = 25        # сообщений в секунду на бота (лимит ~30)
+SEND_CHAT_INTERVAL = 1.0     # сек между сообщениями в личку
+SEND_GROUP_INTERVAL = 3.0    # сек между сообщениями в группу (лимит 20 в минуту)
+SEND_RETRIES = 3             # попыток на одно сообщение
+SEND_BACKOFF = 1.0           # первая пауза между попытками, сек (дальше x2)
 
 # ================== ЛОГИ ==================
 logging.basicConfig(
@@ -53,6 +127,209 @@ logging.basicConfig(
 )
 log = logging.getLogger(__name__)
 
+
+# ================== КОНФИГ ЗАВЕДЕНИЯ ==================
+def load_config() -> dict:
+    try:
+        with open(CONFIG_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def parse_tz(value: Optional[str]) -> dt.tzinfo:
+    """'Europe/Moscow', '+3', '-2:30' или пусто (UTC)."""
+    if not value:
+        return dt.timezone.utc
+    m = re.fullmatch(r"(?:UTC)?\s*([+-])(\d{1,2})(?::(\d{2}))?", value.strip())
+    if m:
+        sign = 1 if m.group(1) == "+" else -1
+        delta = dt.timedelta(hours=int(m.group(2)), minutes=int(m.group(3) or 0))
+        return dt.timezone(sign * delta)
+    return ZoneInfo(value.strip())
+
+
+CONFIG = load_config()
+
+# Планировщик (локальное время заведения): VENUE_TZ из .env или "timezone" в bar_state.json
+TZ = parse_tz(os.getenv("VENUE_TZ") or CONFIG.get("timezone"))
+
+
+def venue_now() -> dt.datetime:
+    """Единые часы бота: сейчас в TZ заведения (aware).
+
+    В журнал и листы пишем настенное время — venue_now().replace(tzinfo=None);
+    границы дней в статистике, прогнозе и кубах считаются от него же, а не от часов сервера.
+    """
+    return dt.datetime.now(TZ)
+
+
+def venue_today() -> dt.date:
+    return venue_now().date()
+
+# ================== МЕТРИКИ ==================
+# Гистограммы времени (хендлеры, хранилище, джобы), счётчики и датчики.
+# Отдаются в формате Prometheus на 127.0.0.1:METRICS_PORT и сводкой в /metrics.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 — не поднимать HTTP-эндпоинт
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_SAMPLES = 1000  # последних замеров на гистограмму для p50/p95/p99
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    __slots__ = ("buckets", "count", "sum", "samples")
+
+    def __init__(self) -> None:
+        self.buckets = [0] * len(METRICS_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.samples: deque = deque(maxlen=METRICS_SAMPLES)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        self.samples.append(value)
+        for i, le in enumerate(METRICS_BUCKETS):
+            if value <= le:
+                self.buckets[i] += 1
+
+    def quantile(self, q: float) -> float:
+        data = sorted(self.samples)
+        if not data:
+            return 0.0
+        return data[min(len(data) - 1, int(q * len(data)))]
+
+
+HISTOGRAMS: Dict[Tuple[str, LabelKey], Histogram] = {}
+COUNTERS: Dict[Tuple[str, LabelKey], float] = {}
+GAUGES: Dict[str, Callable[[], float]] = {}  # имя -> функция, считающая значение на лету
+
+
+def _key(name: str, labels: Dict[str, str]) -> Tuple[str, LabelKey]:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def observe_time(name: str, seconds: float, **labels: str) -> None:
+    k = _key(name, labels)
+    h = HISTOGRAMS.get(k)
+    if h is None:
+        h = HISTOGRAMS[k] = Histogram()
+    h.observe(seconds)
+
+
+def inc(name: str, value: float = 1.0, **labels: str) -> None:
+    k = _key(name, labels)
+    COUNTERS[k] = COUNTERS.get(k, 0.0) + value
+
+
+@contextmanager
+def timer(name: str, **labels: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_time(name, time.perf_counter() - t0, **labels)
+
+
+def timed(name: str, **labels: str):
+    """Декоратор: время вызова функции (обычной или async) в гистограмму name."""
+    def wrap(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def awrapper(*args, **kwargs):
+                with timer(name, **labels):
+                    return await fn(*args, **kwargs)
+            return awrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return wrap
+
+
+def _fmt_labels(labels: LabelKey) -> str:
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+
+
+def render_prometheus() -> str:
+    """Текстовый формат экспозиции Prometheus."""
+    out: List[str] = []
+    typed = set()
+    for (name, labels), h in sorted(HISTOGRAMS.items()):
+        full = f"bkb_{name}"
+        if full not in typed:
+            out.append(f"# TYPE {full} histogram")
+            typed.add(full)
+        for le, n in zip(METRICS_BUCKETS, h.buckets):
+            out.append(f"{full}_bucket{_fmt_labels(labels + (('le', str(le)),))} {n}")
+        out.append(f"{full}_bucket{_fmt_labels(labels + (('le', '+Inf'),))} {h.count}")
+        out.append(f"{full}_sum{_fmt_labels(labels)} {h.sum:.6f}")
+        out.append(f"{full}_count{_fmt_labels(labels)} {h.count}")
+    for (name, labels), v in sorted(COUNTERS.items()):
+        full = f"bkb_{name}"
+        if full not in typed:
+            out.append(f"# TYPE {full} counter")
+            typed.add(full)
+        out.append(f"{full}{_fmt_labels(labels)} {v:g}")
+    for name, fn in sorted(GAUGES.items()):
+        try:
+            v = float(fn())
+        except Exception:
+            continue
+        out.append(f"# TYPE bkb_{name} gauge")
+        out.append(f"bkb_{name} {v:g}")
+    return "\n".join(out) + "\n"
+
+
+def metrics_summary() -> str:
+    """Коротко для /metrics: p50/p95/p99 в мс по каждой гистограмме."""
+    lines = []
+    for (name, labels), h in sorted(HISTOGRAMS.items()):
+        lbl = ",".join(v for _, v in labels)
+        lines.append(
+            f"• {name}[{lbl}] n={h.count}: p50 {h.quantile(0.5) * 1000:.0f} / "
+            f"p95 {h.quantile(0.95) * 1000:.0f} / p99 {h.quantile(0.99) * 1000:.0f} мс"
+        )
+    for (name, labels), v in sorted(COUNTERS.items()):
+        lbl = ",".join(v_ for _, v_ in labels)
+        lines.append(f"• {name}{f'[{lbl}]' if lbl else ''} = {v:g}")
+    for name, fn in sorted(GAUGES.items()):
+        try:
+            lines.append(f"• {name} = {float(fn()):g}")
+        except Exception:
+            pass
+    return "\n".join(lines) or "Метрик пока нет."
+
+
+async def _serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass  # заголовки не нужны
+        if request.split(b" ")[1:2] == [b"/metrics"]:
+            body = render_prometheus().encode()
+            head = "HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+        else:
+            body = b"not found\n"
+            head = "HTTP/1.1 404 Not Found\r\nContent-Type: text/plain\r\n"
+        writer.write(f"{head}Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_metrics_server() -> Optional[asyncio.AbstractServer]:
+    if not METRICS_PORT:
+        return None
+    server = await asyncio.start_server(_serve_metrics, "127.0.0.1", METRICS_PORT)
+    log.info("Метрики: http://127.0.0.1:%d/metrics", METRICS_PORT)
+    return server
+
+
 # ================== КАТАЛОГ ==================
 CATEGORIES: Dict[str, Dict[str, List[str]]] = {
     "beer_bottle": {
@@ -87,8 +364,8 @@ CATEGORIES: Dict[str, Dict[str, List[str]]] = {
             "Эдельвйес н/ф",
             "Речка Вишня",
             "Речка Белое особое",
-            "Крушовица Светлое",
-            "Крушовица Темное",
+            "Крушовица Светлое разл.",
+            "Крушовица Темное разл.",
             "IPA Эль",
             "Квас",
             "Сидорова коза",
@@ -173,6 +450,10 @@ CATEGORIES: Dict[str, Dict[str, List[str]]] = {
 }
 
 ALL_PRODUCTS: List[str] = sum([v["items"] for v in CATEGORIES.values()], [])
+PRODUCT_CATEGORY: Dict[str, str] = {}
+for _cat_key, _cat in CATEGORIES.items():
+    for _p in _cat["items"]:
+        PRODUCT_CATEGORY.setdefault(_p, _cat_key)  # товар из двух категорий считаем в первой
 
 # ================== СОСТОЯНИЯ ==================
 (
@@ -194,24 +475,875 @@ ALL_PRODUCTS: List[str] = sum([v["items"] for v in CATEGORIES.values()], [])
     A_RECEIVE_NEW_QTY,    # ввести кол-во нового продукта
     A_EXPIRY_PICK_ITEM,   # выбор товара для ввода срока годности
     A_EXPIRY_ENTER_DATE,  # ввод даты
-) = range(19)
+    A_COUNT_MENU,         # меню инвентаризации
+    A_COUNT_PICK_ITEM,    # выбор товара для пересчёта
+    A_COUNT_QTY,          # ввод фактического количества
+    A_STATS_RANGE,        # ввод своего периода для срезов
+    A_IMPORT_UPLOAD,      # ждём файл накладной / пересчёта
+    A_IMPORT_CONFIRM,     # превью импорта: провести или отменить
+) = range(25)
 
 # ================== ПАМЯТЬ В ЗАПУСКЕ ==================
-ACTIVE_ADMINS: set[int] = set()
+ACTIVE_ADMINS: set[int] = set()  # заполняется в restore_admins() при старте
+
+# ================== СЛУЖЕБНОЕ СОСТОЯНИЕ ==================
+def load_state() -> dict:
+    """Читает bot_state.json (если файла нет или он битый — пустой словарь).
+
+    Это рабочее состояние бота; bar_state.json — конфиг заведения, его бот не пишет.
+    """
+    try:
+        with open(STATE_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state: dict) -> None:
+    """Атомарно перезаписывает bot_state.json."""
+    tmp = STATE_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, STATE_FILE)
+
+
+def restore_admins() -> None:
+    """Админы из admin_ids в bar_state.json — джобам после рестарта есть кому слать.
+
+    Раньше бот сам дописывал в bot_state.json всех, кто нажимал «Администратор»;
+    такие записи больше не читаются и удаляются при старте.
+    """
+    ACTIVE_ADMINS.update(int(x) for x in CONFIG.get("admin_ids", []))
+    state = load_state()
+    if "admin_ids" in state:
+        stale = set(state.pop("admin_ids")) - ACTIVE_ADMINS
+        save_state(state)
+        if stale:
+            log.warning("Из bot_state.json убраны админы не из конфига: %s", sorted(stale))
+    if not ACTIVE_ADMINS:
+        log.warning("В bar_state.json нет admin_ids — уведомления после рестарта некому слать")
+
+
+def remember_admin(user_id: int) -> None:
+    """Зашёл админом — получает уведомления до рестарта. Навсегда — только через admin_ids в конфиге."""
+    ACTIVE_ADMINS.add(user_id)
+
+
+# ================== ЕДИНИЦЫ ИЗМЕРЕНИЯ ==================
+# Количество хранится целым числом базовых единиц (мл или шт), поэтому суммы
+# точные. Снаружи — как раньше, в упаковках (бутылках, кегах). Размер упаковки
+# и порции берётся из листа units, а если товара там нет — по категории.
+UNITS_COLUMNS = ["product", "base_unit", "pack_unit", "pack_size", "pour_unit", "pour_size"]
+
+
+@dataclass(frozen=True)
+class Units:
+    base: str            # базовая единица: "мл" или "шт"
+    pack: str            # упаковка: "бут", "кег", "шт"
+    pack_size: int       # базовых единиц в упаковке
+    pour: str = ""       # порция: "порц", "бокал" (пусто — не наливается)
+    pour_size: int = 0   # базовых единиц в порции
+
+
+PIECES = Units("шт", "шт", 1)
+CATEGORY_UNITS: Dict[str, Units] = {
+    "beer_bottle": PIECES,
+    "beer_draft": Units("мл", "кег", 30000, "бокал", 500),
+    "strong": Units("мл", "бут", 700, "порц", 40),
+    "wine": Units("мл", "бут", 750, "бокал", 150),
+    "soft": PIECES,
+    "syrup": Units("мл", "бут", 1000, "порц", 20),
+}
+UNIT_OVERRIDES: Dict[str, Units] = {}  # из листа units
+# До листа units всё считали «бутылками»: у разливного это были бутылки по 0,5 л, а не кеги
+LEGACY_SIZES: Dict[str, int] = {"beer_draft": 500}
+
+# слово во вводе -> что это: упаковка, порция или мл с множителем.
+# Упаковку принимаем только своего вида («1 кег» у бутылочного — ошибка), «уп»/«pack» — любую.
+# Штучное — это бутылки и банки: «3 бут» пива в стекле — три штуки
+_PACK_WORDS = {"бут": ("бут", "bottl"), "кег": ("кег", "keg"), "шт": ("шт", "pc", "бут", "bottl", "бан", "can")}
+_ANY_PACK_WORDS = ("уп", "pack")
+_POUR_WORDS = ("порц", "pour", "шот", "shot", "бокал", "glass", "пинт", "pint")
+_ML_WORDS = {"мл": 1, "ml": 1, "сл": 10, "cl": 10, "л": 1000, "l": 1000, "литр": 1000, "литра": 1000,
+             "литров": 1000, "liter": 1000, "liters": 1000}
+
+
+def units_of(product: str) -> Units:
+    u = UNIT_OVERRIDES.get(product)
+    if u is None:
+        u = CATEGORY_UNITS.get(PRODUCT_CATEGORY.get(product, ""), PIECES)
+    return u
+
+
+def set_unit_overrides(df: DataFrame) -> None:
+    """Читает лист units; кривые строки пропускаем с предупреждением."""
+    UNIT_OVERRIDES.clear()
+    for r in df.reindex(columns=UNITS_COLUMNS).itertuples(index=False):
+        try:
+            size = int(r.pack_size)
+            pour = int(r.pour_size) if pd.notna(r.pour_size) else 0
+            if size <= 0 or pour < 0:
+                raise ValueError(size)
+            UNIT_OVERRIDES[str(r.product)] = Units(
+                str(r.base_unit) if pd.notna(r.base_unit) else "шт",
+                str(r.pack_unit) if pd.notna(r.pack_unit) else "шт",
+                size,
+                str(r.pour_unit) if pd.notna(r.pour_unit) and pour else "",
+                pour,
+            )
+        except (TypeError, ValueError):
+            log.warning("Лист %s: пропускаю строку %r", SHEET_UNITS, tuple(r))
+
+
+def units_version() -> str:
+    """Меняется вместе с листом units — по нему снимок понимает, что упаковки пересчитались."""
+    return hashlib.md5(repr(sorted(UNIT_OVERRIDES.items())).encode()).hexdigest()[:12]
+
+
+def default_units_frame() -> DataFrame:
+    """Лист units для нового файла: каждый товар с единицами своей категории — чтобы было что править."""
+    rows = []
+    for p in dict.fromkeys(ALL_PRODUCTS):
+        u = units_of(p)
+        rows.append({"product": p, "base_unit": u.base, "pack_unit": u.pack, "pack_size": u.pack_size,
+                     "pour_unit": u.pour, "pour_size": u.pour_size})
+    return pd.DataFrame(rows, columns=UNITS_COLUMNS)
+
+
+def legacy_size(product: str) -> int:
+    """Базовых единиц в «бутылке» файла без листа units (и журнала без qty_base)."""
+    return LEGACY_SIZES.get(PRODUCT_CATEGORY.get(product, ""), units_of(product).pack_size)
+
+
+def legacy_sheets(xl) -> Dict[str, DataFrame]:
+    """Пороги, сроки и пересчёты файла без листа units — из «бутылок» в упаковки.
+
+    movements и inventory сюда не входят: их пересчитывает хранилище при загрузке.
+    Возвращает только листы, где что-то поменялось.
+    """
+    out: Dict[str, DataFrame] = {}
+    for sheet, cols in ((SHEET_SETTINGS, ["poor_threshold", "luxe_threshold"]), (SHEET_EXPIRY, ["qty"]),
+                        (SHEET_STOCKTAKE, ["expected", "counted", "variance"])):
+        if sheet not in xl.sheet_names:
+            continue
+        df = xl.parse(sheet)
+        if df.empty or "product" not in df.columns:
+            continue
+        factor = df["product"].astype(str).map(lambda p: legacy_size(p) / units_of(p).pack_size)
+        if (factor == 1).all():
+            continue
+        for c in cols:
+            if c in df.columns:
+                df[c] = pd.to_numeric(df[c], errors="coerce") * factor
+        out[sheet] = df
+    return out
+
+
+def to_base(product: str, packs: float) -> int:
+    return int(round(packs * units_of(product).pack_size))
+
+
+def parse_quantity(text: str, product: str) -> Optional[int]:
+    """«5», «3 порции», «1 кег», «250 мл», «0,5 л» -> базовые единицы. Без единиц — упаковки.
+
+    None — не разобрали или единица не подходит товару (мл у штучного, кег у бутылочного).
+    """
+    m = re.fullmatch(r"\s*(\d+(?:[.,]\d+)?)\s*([^\d\s.,]*)\.?\s*", text or "")
+    if not m:
+        return None
+    num = float(m.group(1).replace(",", "."))
+    word = m.group(2).lower()
+    u = units_of(product)
+    if not word or word.startswith(_PACK_WORDS.get(u.pack, (u.pack.lower(),)) + _ANY_PACK_WORDS):
+        factor = u.pack_size
+    elif word.startswith(_POUR_WORDS):
+        if not u.pour_size:
+            return None
+        factor = u.pour_size
+    elif word in _ML_WORDS and u.base == "мл":
+        factor = _ML_WORDS[word]
+    else:
+        return None
+    return int(round(num * factor))
+
+
+def fmt_qty(product: str, base: int) -> str:
+    """Для людей: «2 бут», «0.06 бут (40 мл)», «6 шт»."""
+    u = units_of(product)
+    packs = base / u.pack_size
+    if base % u.pack_size == 0:
+        return f"{packs:g} {u.pack}"
+    return f"{packs:.2f} {u.pack} ({base} {u.base})"
+
+
+def qty_hint(product: str) -> str:
+    """Подсказка, в чём можно ввести количество этого товара."""
+    u = units_of(product)
+    parts = [f"числом — в {u.pack} (например, 5)"]
+    if u.pour_size:
+        parts.append(f"порциями — «3 {u.pour}» ({u.pour_size} {u.base})")
+    if u.base == "мл":
+        parts.append("в мл или л — «250 мл», «1,5 л»")
+    return "Количество: " + "; ".join(parts) + "."
+
+
+# ================== ЖУРНАЛ ДВИЖЕНИЙ В ПАМЯТИ ==================
+# Движения и остатки живут в компактных колонках (array) с интернированными
+# именами: тап бармена — это по элементу в каждую колонку и строка в журнале
+# на диске, без pandas. data.xlsx пересобирается изредка (flush): по таймеру,
+# перед выгрузкой таблицы, при остановке и при любой записи через save_df_map.
+# После сбоя строки журнала с seq новее, чем в data.xlsx, доигрываются при загрузке.
+# qty — в упаковках (для людей и отчётов), qty_base — точное целое в базовых единицах;
+# ref — seq отменяемой записи
+MOVE_COLUMNS = ["ts", "who", "action", "user_id", "product", "qty", "qty_base", "seq", "ref"]
+INVENTORY_COLUMNS = ["product", "unit", "qty", "qty_base"]
+JOURNAL_FILE = DATA_FILE + ".journal"
+STORE_FLUSH_SECONDS = int(os.getenv("STORE_FLUSH_SECONDS", "300"))  # как часто сбрасывать журнал в data.xlsx
+_EPOCH = dt.datetime(1970, 1, 1)  # ts храним секундами «настенного» времени от этой даты
+
+
+def _to_secs(when: dt.datetime) -> int:
+    return int((when - _EPOCH).total_seconds())
+
+
+def _month_of(secs: int) -> int:
+    """Номер месяца от 1970-01 (как datetime64[M] в numpy) — ключ партиции снимка."""
+    d = _EPOCH + dt.timedelta(seconds=secs)
+    return (d.year - 1970) * 12 + d.month - 1
+
+
+def _np(col: array, dtype) -> "np.ndarray":
+    """Копия колонки в numpy (без копии array не даст себя дописывать)."""
+    return np.frombuffer(col, dtype=dtype).copy()
+
+
+def _array(typecode: str, values) -> array:
+    out = array(typecode)
+    out.frombytes(np.ascontiguousarray(values, dtype=np.dtype(typecode)).tobytes())
+    return out
+
+
+# колонка movements -> (поле RecordStore, dtype в numpy, словарь имён или None)
+_MOVE_LAYOUT = {
+    "ts": ("ts", "int64", None),
+    "who": ("who", "int16", "whos"),
+    "action": ("action", "int16", "actions"),
+    "user_id": ("user_id", "int64", None),
+    "product": ("product", "int32", "products"),
+    "qty": ("qty", "int64", None),       # делится на размер упаковки при выдаче
+    "qty_base": ("qty", "int64", None),
+    "seq": ("seq", "int64", None),
+    "ref": ("ref", "int64", None),
+}
+
+
+def _base_column(df: DataFrame, sizes: "np.ndarray") -> "np.ndarray":
+    """qty_base из листа; где он пуст (старый файл, строка дописана руками) — из qty в упаковках.
+
+    qty_base главнее: qty в файле посчитан по размерам упаковок на момент записи
+    и после правки листа units может устареть.
+    """
+    qty = pd.to_numeric(df["qty"], errors="coerce").fillna(0.0).to_numpy()
+    base = pd.to_numeric(df["qty_base"], errors="coerce").to_numpy()
+    return np.where(np.isnan(base), np.round(qty * sizes), base).astype(np.int64)
+
+
+class Interner:
+    """Строка <-> маленький целый id (товары, действия, роли)."""
+
+    __slots__ = ("names", "ids")
+
+    def __init__(self) -> None:
+        self.names: List[str] = []
+        self.ids: Dict[str, int] = {}
+
+    def id(self, name: str) -> int:
+        i = self.ids.get(name)
+        if i is None:
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+    def codes(self, values: "pd.Series") -> "np.ndarray":
+        """id для целой колонки: factorize + по одному id на уникальное значение."""
+        codes, uniques = pd.factorize(values.fillna("").astype(str))
+        remap = np.array([self.id(u) for u in uniques] or [0], dtype=np.int64)
+        return remap[codes] if len(codes) else codes
+
+
+class RecordStore:
+    """Журнал движений колонками + остатки по id товара.
+
+    Журнал только дописывается: ошибочная запись гасится компенсирующей —
+    то же действие с обратным qty и ref = seq исходной. Остатки — вид,
+    который обновляется каждым событием.
+    """
+
+    __slots__ = ("products", "actions", "whos", "seq", "ts", "who", "action", "user_id", "product", "qty", "ref",
+                 "stock", "unit", "rows", "last_seq", "flushed_seq", "dirty_months", "_journal")
+
+    def __init__(self) -> None:
+        self.products = Interner()
+        self.actions = Interner()
+        self.whos = Interner()
+        # movements: по колонке на поле
+        self.seq = array("q")
+        self.ts = array("q")
+        self.who = array("h")
+        self.action = array("h")
+        self.user_id = array("q")
+        self.product = array("i")
+        self.qty = array("q")  # базовые единицы
+        self.ref = array("q")
+        # inventory: остаток (в базовых единицах) по id товара, rows — порядок строк листа
+        self.stock = array("q")
+        self.unit: Dict[int, str] = {}
+        self.rows: List[int] = []
+        self.last_seq = 0
+        self.flushed_seq = 0
+        self.dirty_months: Optional[set] = None  # месяцы, чьи партиции снимка устарели; None — все
+        self._journal = None
+
+    def __len__(self) -> int:
+        return len(self.seq)
+
+    @property
+    def dirty(self) -> bool:
+        return self.last_seq > self.flushed_seq
+
+    # ---- остатки ----
+    def _grow(self) -> None:
+        n = len(self.products.names)
+        if n > len(self.stock):
+            self.stock.extend([0] * (n - len(self.stock)))
+
+    def _pid(self, product: str) -> int:
+        pid = self.products.id(product)
+        self._grow()
+        return pid
+
+    def stock_base(self, product: str) -> int:
+        pid = self.products.ids.get(product)
+        return self.stock[pid] if pid is not None and pid < len(self.stock) else 0
+
+    def stock_of(self, product: str) -> float:
+        """Остаток в упаковках."""
+        return self.stock_base(product) / units_of(product).pack_size
+
+    def stock_map(self) -> Dict[str, float]:
+        names = self.products.names
+        return {names[pid]: self.stock[pid] / units_of(names[pid]).pack_size for pid in self.rows}
+
+    def pack_sizes(self) -> "np.ndarray":
+        """Размер упаковки по id товара — для перевода колонок в упаковки."""
+        return np.array([units_of(p).pack_size for p in self.products.names] or [1], dtype=np.int64)
+
+    # ---- запись ----
+    def apply(self, seq: int, secs: int, who: str, action: str, user_id: int, product: str, qty: int,
+              ref: int = 0) -> int:
+        """Дописывает движение (qty в базовых единицах) и двигает остаток. Возвращает новый остаток."""
+        pid = self._pid(product)
+        if pid not in self.unit:
+            self.unit[pid] = units_of(product).pack
+            self.rows.append(pid)
+        after = apply_movement(self.stock[pid], action, qty)
+        self.stock[pid] = after
+        self.seq.append(seq)
+        self.ts.append(secs)
+        self.who.append(self.whos.id(who))
+        self.action.append(self.actions.id(action))
+        self.user_id.append(user_id)
+        self.product.append(pid)
+        self.qty.append(qty)
+        self.ref.append(ref)
+        self.last_seq = max(self.last_seq, seq)
+        if self.dirty_months is not None:
+            self.dirty_months.add(_month_of(secs))
+        return after
+
+    def append(self, when: dt.datetime, who: str, action: str, user_id: int, product: str, qty: int,
+               ref: int = 0) -> int:
+        """Новое движение: в память и строкой в журнал (fsync — переживёт падение)."""
+        seq = self.last_seq + 1
+        packs = qty / units_of(product).pack_size
+        line = json.dumps([seq, when.strftime("%Y-%m-%d %H:%M:%S"), who, action, user_id, product, packs, ref, qty],
+                          ensure_ascii=False)
+        if self._journal is None:
+            self._journal = open(JOURNAL_FILE, "a", encoding="utf-8")
+        self._journal.write(line + "\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        return self.apply(seq, _to_secs(when), who, action, user_id, product, qty, ref)
+
+    def replay_journal(self) -> int:
+        """Доигрывает строки журнала, которых ещё нет в data.xlsx."""
+        if not os.path.exists(JOURNAL_FILE):
+            return 0
+        n = 0
+        with open(JOURNAL_FILE, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                    seq, ts, who, action, user_id, product, qty = rec[:7]
+                    ref = rec[7] if len(rec) > 7 else 0  # строки до появления ref
+                    # и до qty_base: тогда qty — в «бутылках» старого учёта
+                    base = rec[8] if len(rec) > 8 else int(round(float(qty) * legacy_size(product)))
+                except ValueError:
+                    log.warning("Битая строка журнала пропущена: %r", line[:80])  # недописанная при падении
+                    continue
+                if seq <= self.flushed_seq:
+                    continue
+                when = dt.datetime.strptime(ts, "%Y-%m-%d %H:%M:%S")
+                self.apply(seq, _to_secs(when), who, action, int(user_id), product, int(base), int(ref))
+                n += 1
+        return n
+
+    def undoable(self, user_id: int, n: int, since_secs: int) -> List[int]:
+        """Позиции последних n записей пользователя, которые ещё можно отменить.
+
+        Сами отмены и уже отменённые записи пропускаем, пересчёты (count) тоже —
+        их исправляет новый пересчёт. Дальше since_secs не смотрим.
+        """
+        undone = set()
+        out: List[int] = []
+        count = self.actions.ids.get("count")
+        for i in range(len(self.seq) - 1, -1, -1):
+            if self.ts[i] < since_secs or len(out) == n:
+                break
+            if self.ref[i]:
+                undone.add(self.ref[i])
+            elif self.user_id[i] == user_id and self.action[i] != count and self.seq[i] not in undone:
+                out.append(i)
+        return out
+
+    def close(self) -> None:
+        """Закрывает файл журнала; следующая запись откроет его заново."""
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def mark_flushed(self, upto: int) -> None:
+        """data.xlsx содержит всё до seq=upto: из журнала это можно выбросить."""
+        self.flushed_seq = max(self.flushed_seq, upto)
+        self.close()
+        if not self.dirty:
+            open(JOURNAL_FILE, "w").close()
+            return
+        # пока писали файл, пришли новые движения — их оставляем
+        keep = []
+        if os.path.exists(JOURNAL_FILE):
+            with open(JOURNAL_FILE, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        if json.loads(line)[0] > upto:
+                            keep.append(line)
+                    except ValueError:
+                        continue
+        tmp = JOURNAL_FILE + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.writelines(keep)
+        os.replace(tmp, JOURNAL_FILE)
+
+    # ---- листы целиком (загрузка, пересборка, ручные правки) ----
+    def replace_movements(self, df: DataFrame, legacy: bool = False) -> None:
+        """legacy — лист из файла без units: qty там в «бутылках» (см. legacy_size)."""
+        df = df.reindex(columns=MOVE_COLUMNS)
+        ts = pd.to_datetime(df["ts"], errors="coerce")
+        secs = ((ts - pd.Timestamp(_EPOCH)) // pd.Timedelta(seconds=1)).fillna(0)
+        seq = pd.to_numeric(df["seq"], errors="coerce")
+        missing = seq.isna()
+        if missing.any():
+            # строки без seq (старый файл или дописанные руками) нумеруем следом
+            top = int(seq.max()) if (~missing).any() else 0
+            seq = seq.copy()
+            seq[missing] = top + np.arange(1, int(missing.sum()) + 1)
+        self.seq = _array("q", seq.to_numpy())
+        self.ts = _array("q", secs.to_numpy())
+        self.who = _array("h", self.whos.codes(df["who"]))
+        self.action = _array("h", self.actions.codes(df["action"]))
+        self.user_id = _array("q", pd.to_numeric(df["user_id"], errors="coerce").fillna(0).to_numpy())
+        pids = self.products.codes(df["product"])
+        self.product = _array("i", pids)
+        sizes = np.array([legacy_size(p) for p in self.products.names] or [1], dtype=np.int64) if legacy \
+            else self.pack_sizes()
+        self.qty = _array("q", _base_column(df, sizes[pids]))
+        self.ref = _array("q", pd.to_numeric(df["ref"], errors="coerce").fillna(0).to_numpy())
+        self._grow()
+        self.dirty_months = None
+        self.last_seq = int(seq.max()) if len(seq) else 0
+
+    def replace_inventory(self, df: DataFrame, legacy: bool = False) -> None:
+        df = df.reindex(columns=INVENTORY_COLUMNS)
+        names = df["product"].astype(str)
+        sizes = np.array([legacy_size(p) if legacy else units_of(p).pack_size for p in names], dtype=np.int64)
+        base = _base_column(df, sizes)
+        self.stock = array("q", [0] * len(self.products.names))
+        self.unit = {}
+        self.rows = []
+        for prod, q in zip(names, base.tolist()):
+            pid = self._pid(prod)
+            if pid in self.unit:
+                continue  # дубль строки: учёт всегда шёл по первой
+            self.unit[pid] = units_of(prod).pack
+            self.rows.append(pid)
+            self.stock[pid] = q
+
+    def frozen(self) -> "RecordStore":
+        """Копия для записи data.xlsx в потоке: колонки копируются срезом (memcpy), имена — списком.
+
+        Цикл дальше дописывает оригинал, поток раскодирует и форматирует копию.
+        """
+        st = RecordStore()
+        for name in ("products", "actions", "whos"):
+            src, dst = getattr(self, name), getattr(st, name)
+            dst.names, dst.ids = src.names[:], dict(src.ids)
+        for name in ("seq", "ts", "who", "action", "user_id", "product", "qty", "ref", "stock"):
+            setattr(st, name, getattr(self, name)[:])
+        st.unit, st.rows = dict(self.unit), self.rows[:]
+        st.last_seq = st.flushed_seq = self.last_seq
+        return st
+
+    # ---- pandas для аналитики и выгрузки ----
+    def column_values(self, columns: Optional[List[str]] = None, since: Optional[dt.datetime] = None,
+                      until: Optional[dt.datetime] = None, actions: Optional[List[str]] = None,
+                      after_seq: int = 0) -> Dict[str, "np.ndarray"]:
+        """Колонки движений в numpy: только нужные поля и только строки с since <= ts < until,
+        action из actions и seq > after_seq. Имена раскодируются уже после фильтра."""
+        columns = columns or MOVE_COLUMNS
+        ts = _np(self.ts, np.int64)
+        mask = _np(self.seq, np.int64) > after_seq if after_seq else None
+        if since is not None:
+            m = ts >= _to_secs(since)
+            mask = m if mask is None else mask & m
+        if until is not None:
+            m = ts < _to_secs(until)
+            mask = m if mask is None else mask & m
+        if actions is not None:
+            codes = [self.actions.ids[a] for a in actions if a in self.actions.ids]
+            m = np.isin(_np(self.action, np.int16), codes)
+            mask = m if mask is None else mask & m
+        out: Dict[str, "np.ndarray"] = {}
+        for col in columns:
+            attr, dtype, names = _MOVE_LAYOUT[col]
+            v = ts if col == "ts" else _np(getattr(self, attr), dtype)
+            if mask is not None:
+                v = v[mask]
+            if names:
+                v = np.array(getattr(self, names).names, dtype=object)[v]
+            if col == "qty":
+                pids = _np(self.product, np.int32)
+                v = v / self.pack_sizes()[pids if mask is None else pids[mask]]
+            out[col] = v.astype("datetime64[s]") if col == "ts" else v
+        return out
+
+    def movements_frame(self, columns: Optional[List[str]] = None, since: Optional[dt.datetime] = None,
+                        until: Optional[dt.datetime] = None, actions: Optional[List[str]] = None,
+                        after_seq: int = 0) -> DataFrame:
+        columns = columns or MOVE_COLUMNS
+        return pd.DataFrame(self.column_values(columns, since, until, actions, after_seq), columns=columns)
+
+    def inventory_frame(self) -> DataFrame:
+        names = self.products.names
+        units = [units_of(names[pid]) for pid in self.rows]
+        return pd.DataFrame({
+            "product": [names[pid] for pid in self.rows],
+            "unit": [u.pack for u in units],
+            "qty": [self.stock[pid] / u.pack_size for pid, u in zip(self.rows, units)],
+            "qty_base": [self.stock[pid] for pid in self.rows],
+        }, columns=INVENTORY_COLUMNS)
+
+    @classmethod
+    def load(cls) -> "RecordStore":
+        st = cls()
+        if os.path.exists(DATA_FILE):
+            xl = pd.ExcelFile(DATA_FILE, engine="openpyxl")
+            if SHEET_UNITS in xl.sheet_names:
+                set_unit_overrides(xl.parse(SHEET_UNITS))  # до листов с количествами
+            if SHEET_INVENTORY in xl.sheet_names:
+                st.replace_inventory(xl.parse(SHEET_INVENTORY), legacy=SHEET_UNITS not in xl.sheet_names)
+            if SHEET_MOVES in xl.sheet_names:
+                st.replace_movements(xl.parse(SHEET_MOVES), legacy=SHEET_UNITS not in xl.sheet_names)
+        st.flushed_seq = st.last_seq
+        n = st.replay_journal()
+        if n:
+            log.warning("Доиграл из журнала %d движений, которых не было в %s", n, DATA_FILE)
+        return st
+
+
+STORE: Optional[RecordStore] = None
+_STORE_LOCK = threading.Lock()  # прогрев грузит хранилище в потоке, джобы могут прийти раньше
+
+
+def get_store() -> RecordStore:
+    global STORE
+    if STORE is None:
+        with _STORE_LOCK:
+            if STORE is None:
+                with timer("storage_seconds", op="store_load"):
+                    STORE = RecordStore.load()
+    return STORE
+
+
+# ================== АНАЛИТИЧЕСКИЙ СНИМОК ==================
+# Копия movements в Parquet по месяцам (analytics/movements-YYYY-MM.parquet).
+# Отчёты читают только нужные месяцы и колонки, фильтр по ts/action
+# проталкивается в чтение. Переписываются лишь месяцы, где были новые
+# движения. Без pyarrow отчёты фильтруют колонки хранилища в памяти.
+ANALYTICS_DIR = os.getenv("ANALYTICS_DIR", "analytics")
+_SNAPSHOT_MANIFEST = "manifest.json"  # last_seq/rows, по которым снимок собран
+_ARROW = None  # (pyarrow, pyarrow.parquet, pyarrow.dataset); False — не установлен
+
+
+def _arrow():
+    global _ARROW
+    if _ARROW is None:
+        try:
+            _ARROW = tuple(importlib.import_module(m) for m in ("pyarrow", "pyarrow.parquet", "pyarrow.dataset"))
+        except ImportError:
+            log.info("pyarrow не установлен — отчёты читают движения из памяти")
+            _ARROW = False
+    return _ARROW or None
+
+
+def _partition_path(month: int) -> str:
+    return os.path.join(ANALYTICS_DIR, f"movements-{1970 + month // 12}-{month % 12 + 1:02d}.parquet")
+
+
+def _snapshot_months() -> Dict[int, str]:
+    """Партиции на диске: номер месяца -> путь."""
+    out: Dict[int, str] = {}
+    if not os.path.isdir(ANALYTICS_DIR):
+        return out
+    for name in os.listdir(ANALYTICS_DIR):
+        m = re.fullmatch(r"movements-(\d{4})-(\d{2})\.parquet", name)
+        if m:
+            out[(int(m.group(1)) - 1970) * 12 + int(m.group(2)) - 1] = os.path.join(ANALYTICS_DIR, name)
+    return out
+
+
+def _snapshot_manifest() -> dict:
+    try:
+        with open(os.path.join(ANALYTICS_DIR, _SNAPSHOT_MANIFEST), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+SNAPSHOT_SEQ: Optional[int] = None  # по какую seq партиции на диске совпадают с хранилищем
+_SNAPSHOT_WRITING = False           # партиции сейчас переписываются (в потоке)
+_SNAPSHOT_GEN = 0                   # растёт при сбросе снимка: запись, начатая до сброса, его не оживит
+
+
+def _month_start(month: int) -> dt.datetime:
+    return dt.datetime(1970 + month // 12, month % 12 + 1, 1)
+
+
+def snapshot_seq() -> Optional[int]:
+    """По какую seq читать снимок (строки новее — хвост из памяти); None — снимку верить нельзя.
+
+    Пока месяцы дописываются в потоке, старая граница остаётся верной: в партициях
+    только добавляются строки с большими seq, а они отсекаются фильтром.
+    """
+    return None if get_store().dirty_months is None else SNAPSHOT_SEQ
+
+
+def invalidate_snapshot() -> None:
+    """Снимок больше не совпадает с хранилищем (заменён журнал, поменялись упаковки) — пересобрать целиком."""
+    global SNAPSHOT_SEQ, _SNAPSHOT_GEN
+    SNAPSHOT_SEQ = None
+    _SNAPSHOT_GEN += 1
+    get_store().dirty_months = None
+
+
+def _prepare_snapshot() -> Optional[Tuple[Dict[int, Optional[Dict[str, "np.ndarray"]]], dict, int]]:
+    """Что переписать: {месяц: колонки или None — удалить}, манифест и поколение снимка.
+    None — переписывать нечего.
+
+    Выполняется в цикле и быстро: раскодируются только строки грязных месяцев
+    (все — лишь при полной пересборке после загрузки/замены листа).
+    """
+    global SNAPSHOT_SEQ, _SNAPSHOT_WRITING
+    if _SNAPSHOT_WRITING or _arrow() is None:
+        return None
+    store = get_store()
+    dirty = store.dirty_months
+    if dirty is None:
+        # после загрузки/замены листа: снимок годен, если собран по тому же журналу
+        man = _snapshot_manifest()
+        if ((man.get("last_seq"), man.get("rows"), man.get("columns"), man.get("units"))
+                == (store.last_seq, len(store), MOVE_COLUMNS, units_version())):
+            store.dirty_months = set()
+            SNAPSHOT_SEQ = store.last_seq
+            return None
+    elif not dirty:
+        return None
+    parts: Dict[int, Optional[Dict[str, "np.ndarray"]]] = {}
+    if dirty is None:
+        cols = store.column_values()
+        months = cols["ts"].astype("datetime64[M]").astype(np.int64)
+        present = set(np.unique(months).tolist())
+        for month in present | set(_snapshot_months()):
+            sel = months == month
+            parts[month] = {c: v[sel] for c, v in cols.items()} if month in present else None
+    else:
+        for month in dirty:
+            cols = store.column_values(since=_month_start(month), until=_month_start(month + 1))
+            parts[month] = cols if len(cols["seq"]) else None
+    manifest = {"last_seq": store.last_seq, "rows": len(store), "columns": MOVE_COLUMNS,
+                "units": units_version()}
+    # новые движения с этой минуты снова пометят свои месяцы грязными
+    store.dirty_months = set()
+    if dirty is None:
+        SNAPSHOT_SEQ = None  # партиции пересобираются целиком — до конца записи читаем из памяти
+    _SNAPSHOT_WRITING = True
+    return parts, manifest, _SNAPSHOT_GEN
+
+
+def _write_snapshot(parts: Dict[int, Optional[Dict[str, "np.ndarray"]]], manifest: dict, gen: int) -> int:
+    """Пишет подготовленные партиции и манифест (можно из потока). Возвращает число файлов."""
+    global SNAPSHOT_SEQ, _SNAPSHOT_WRITING
+    pa, pq, _ = _arrow()
+    written = 0
+    try:
+        with timer("storage_seconds", op="refresh_snapshot"):
+            os.makedirs(ANALYTICS_DIR, exist_ok=True)
+            for month, cols in sorted(parts.items()):
+                path = _partition_path(month)
+                if cols is None:
+                    if os.path.exists(path):
+                        os.remove(path)
+                    continue
+                table = pa.table({
+                    "ts": pa.array(cols["ts"], type=pa.timestamp("s")),
+                    "who": pa.array(cols["who"], type=pa.string()),
+                    "action": pa.array(cols["action"], type=pa.string()),
+                    "user_id": pa.array(cols["user_id"], type=pa.int64()),
+                    "product": pa.array(cols["product"], type=pa.string()),
+                    "qty": pa.array(cols["qty"], type=pa.float64()),
+                    "qty_base": pa.array(cols["qty_base"], type=pa.int64()),
+                    "seq": pa.array(cols["seq"], type=pa.int64()),
+                    "ref": pa.array(cols["ref"], type=pa.int64()),
+                })
+                tmp = path + ".tmp"
+                pq.write_table(table, tmp)
+                os.replace(tmp, path)
+                written += 1
+            with open(os.path.join(ANALYTICS_DIR, _SNAPSHOT_MANIFEST), "w", encoding="utf-8") as f:
+                json.dump(manifest, f)
+        if gen == _SNAPSHOT_GEN:
+            SNAPSHOT_SEQ = manifest["last_seq"]
+    except Exception:
+        SNAPSHOT_SEQ = None
+        get_store().dirty_months = None  # что на диске — неизвестно: сверим с манифестом и пересоберём
+        raise
+    finally:
+        _SNAPSHOT_WRITING = False
+    inc("snapshot_partitions_written_total", written)
+    return written
+
+
+def refresh_snapshot() -> int:
+    """Переписывает партиции месяцев с новыми движениями. Возвращает число записанных файлов."""
+    job = _prepare_snapshot()
+    return _write_snapshot(*job) if job else 0
+
+
+async def refresh_snapshot_async() -> int:
+    """То же без блокировки цикла: выборка месяцев здесь, запись Parquet — в потоке."""
+    job = _prepare_snapshot()
+    return await asyncio.to_thread(_write_snapshot, *job) if job else 0
+
+
+def read_movements(columns: Optional[List[str]] = None, since: Optional[dt.datetime] = None,
+                   until: Optional[dt.datetime] = None, actions: Optional[List[str]] = None) -> DataFrame:
+    """Движения для отчётов: только колонки columns, since <= ts < until, action из actions.
+
+    Всё по seq из snapshot_seq — из снимка, а то, что натапали после его записи, —
+    хвостом из памяти. Снимок догоняет job_flush_store в потоке, отчёт его не ждёт.
+    Без снимка (нет pyarrow, пересборка) — всё из памяти.
+    """
+    columns = columns or MOVE_COLUMNS
+    with timer("storage_seconds", op="read_movements"):
+        arrow = _arrow()
+        upto = snapshot_seq() if arrow is not None else None
+        store = get_store()
+        if upto is not None:
+            try:
+                head = _read_snapshot(arrow, columns, since, until, actions, upto)
+            except Exception:
+                log.exception("Снимок не прочитался, беру движения из памяти")
+            else:
+                if store.last_seq <= upto:
+                    return head
+                tail = store.movements_frame(columns, since, until, actions, after_seq=upto)
+                return tail if head.empty else head if tail.empty else pd.concat([head, tail], ignore_index=True)
+        return store.movements_frame(columns, since, until, actions)
+
+
+def _read_snapshot(arrow, columns: List[str], since: Optional[dt.datetime], until: Optional[dt.datetime],
+                   actions: Optional[List[str]], upto: int) -> DataFrame:
+    pa, _, ds = arrow
+    lo = _month_of(_to_secs(since)) if since is not None else None
+    hi = _month_of(_to_secs(until)) if until is not None else None
+    paths = [p for m, p in sorted(_snapshot_months().items())
+             if (lo is None or m >= lo) and (hi is None or m <= hi)]
+    if not paths:
+        return get_store().movements_frame(columns).iloc[0:0]
+    cond = None
+    for c in (
+        ds.field("ts") >= pa.scalar(since, type=pa.timestamp("s")) if since is not None else None,
+        ds.field("ts") < pa.scalar(until, type=pa.timestamp("s")) if until is not None else None,
+        ds.field("action").isin(actions) if actions is not None else None,
+        ds.field("seq") <= upto,
+    ):
+        if c is not None:
+            cond = c if cond is None else cond & c
+    table = ds.dataset(paths, format="parquet").to_table(columns=columns, filter=cond)
+    return table.to_pandas()
+
 
 # ================== EXCEL УТИЛИТЫ ==================
+STOCKTAKE_COLUMNS = ["ts", "user_id", "product", "expected", "counted", "variance"]
+
+
+class StockError(ValueError):
+    """Расход больше, чем есть на складе (при STOCK_POLICY=reject)."""
+
+    def __init__(self, product: str, available: float, qty: float) -> None:
+        super().__init__(f"{product}: на складе {available:g}, списание {qty:g}")
+        self.product = product
+        self.available = available
+        self.qty = qty
+
+
+_EXCEL_CHECKED: Optional[str] = None  # файл, листы которого уже проверены в этом процессе
+
+
 def ensure_excel() -> None:
-    """Создаёт файл и нужные листы, если их нет."""
+    """Создаёт файл и нужные листы, если их нет. Листы проверяются раз за процесс."""
+    if _EXCEL_CHECKED == DATA_FILE and os.path.exists(DATA_FILE):
+        return
+    _ensure_excel()
+
+
+@timed("storage_seconds", op="ensure_excel")
+def _ensure_excel() -> None:
+    global _EXCEL_CHECKED
     if not os.path.exists(DATA_FILE):
-        inv = pd.DataFrame(columns=["product", "unit", "qty"])
-        mov = pd.DataFrame(columns=["ts", "who", "action", "user_id", "product", "qty"])
+        inv = pd.DataFrame(columns=INVENTORY_COLUMNS)
+        mov = pd.DataFrame(columns=MOVE_COLUMNS)
         setdf = pd.DataFrame(columns=["product", "poor_threshold", "luxe_threshold"])
         exp = pd.DataFrame(columns=["product", "expiry_date", "qty"])
+        cnt = pd.DataFrame(columns=STOCKTAKE_COLUMNS)
+        units = default_units_frame()
         with pd.ExcelWriter(DATA_FILE, engine="openpyxl", mode="w") as w:
             inv.to_excel(w, index=False, sheet_name=SHEET_INVENTORY)
             mov.to_excel(w, index=False, sheet_name=SHEET_MOVES)
             setdf.to_excel(w, index=False, sheet_name=SHEET_SETTINGS)
             exp.to_excel(w, index=False, sheet_name=SHEET_EXPIRY)
+            cnt.to_excel(w, index=False, sheet_name=SHEET_STOCKTAKE)
+            units.to_excel(w, index=False, sheet_name=SHEET_UNITS)
         log.info("Создан новый Excel с базовыми листами.")
 
     # Убедимся, что все листы есть
@@ -224,7 +1356,7 @@ def ensure_excel() -> None:
         )
         changed = True
     if SHEET_MOVES not in existing:
-        pd.DataFrame(columns=["ts", "who", "action", "user_id", "product", "qty"]).to_excel(
+        pd.DataFrame(columns=MOVE_COLUMNS).to_excel(
             DATA_FILE, sheet_name=SHEET_MOVES, index=False, engine="openpyxl"
         )
         changed = True
@@ -238,94 +1370,233 @@ def ensure_excel() -> None:
             DATA_FILE, sheet_name=SHEET_EXPIRY, index=False, engine="openpyxl"
         )
         changed = True
+    if SHEET_STOCKTAKE not in existing:
+        # через save_df_map, чтобы не затереть остальные листы старого файла
+        save_df_map({SHEET_STOCKTAKE: pd.DataFrame(columns=STOCKTAKE_COLUMNS)})
+        changed = True
+    if SHEET_UNITS not in existing:
+        # файл старше единиц: save_df_map сначала загрузит хранилище (movements и inventory
+        # из «бутылок» в базовые единицы) и запишет их с qty_base, остальные листы переводим здесь
+        migrated = legacy_sheets(xl)
+        save_df_map({SHEET_UNITS: default_units_frame(), **migrated})
+        log.warning("Файл без листа %s: количества перевёл в упаковки (разливное — из бутылок по 0,5 л в кеги)",
+                    SHEET_UNITS)
+        changed = True
     if changed:
         log.info("Добавил недостающие листы в Excel.")
+    _EXCEL_CHECKED = DATA_FILE
 
 
 def load_df(sheet: str) -> DataFrame:
-    return pd.read_excel(DATA_FILE, sheet_name=sheet, engine="openpyxl")
+    """movements и inventory отдаёт хранилище в памяти, остальные листы — из data.xlsx."""
+    with timer("storage_seconds", op="load_df", sheet=sheet):
+        if sheet == SHEET_MOVES:
+            return get_store().movements_frame()
+        if sheet == SHEET_INVENTORY:
+            return get_store().inventory_frame()
+        return pd.read_excel(DATA_FILE, sheet_name=sheet, engine="openpyxl")
 
 
-def save_df_map(dfs: Dict[str, DataFrame]) -> None:
-    # читаем все текущие, обновляем только нужные
-    try:
-        xl = pd.ExcelFile(DATA_FILE, engine="openpyxl")
-        all_sheets = {name: xl.parse(name) for name in xl.sheet_names}
-    except Exception:
-        all_sheets = {}
-    all_sheets.update(dfs)
-    with pd.ExcelWriter(DATA_FILE, engine="openpyxl", mode="w") as w:
-        for name, df in all_sheets.items():
-            df.to_excel(w, sheet_name=name, index=False)
+_WRITE_LOCK = threading.Lock()  # data.xlsx пишет и цикл, и фоновый flush
 
 
-def add_movement(
-    who: str, action: str, user_id: int, product: str, qty: float
-) -> None:
-    """Пишем строку в movements и корректируем остатки в inventory."""
-    ensure_excel()
-    try:
-        mov = load_df(SHEET_MOVES)
-    except Exception:
-        mov = pd.DataFrame(columns=["ts", "who", "action", "user_id", "product", "qty"])
-    try:
-        inv = load_df(SHEET_INVENTORY)
-    except Exception:
-        inv = pd.DataFrame(columns=["product", "unit", "qty"])
+def _store_snapshot(store: Optional[RecordStore] = None) -> Tuple[Dict[str, DataFrame], int]:
+    """Листы movements и inventory из хранилища (или его копии frozen — тогда в потоке)."""
+    store = store or get_store()
+    mov = store.movements_frame()
+    mov["ts"] = mov["ts"].dt.strftime("%Y-%m-%d %H:%M:%S")
+    return {SHEET_INVENTORY: store.inventory_frame(), SHEET_MOVES: mov}, store.last_seq
 
-    ts = dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    mov = pd.concat(
-        [mov, pd.DataFrame([{"ts": ts, "who": who, "action": action, "user_id": user_id, "product": product, "qty": qty}])],
-        ignore_index=True,
-    )
 
-    inv = inv.copy()
-    if product in inv.get("product", pd.Series([])).values:
-        idx = inv.index[inv["product"] == product][0]
-        cur = float(inv.at[idx, "qty"]) if pd.notna(inv.at[idx, "qty"]) else 0.0
-        delta = -qty if action == "consume" else qty
-        inv.at[idx, "qty"] = cur + delta
-    else:
-        # Если не было — создаём
-        delta = -qty if action == "consume" else qty
-        new_qty = max(0.0, delta) if action == "receive" else 0.0  # расход для нового = 0
-        inv = pd.concat(
-            [inv, pd.DataFrame([{"product": product, "unit": "", "qty": new_qty}])],
-            ignore_index=True,
-        )
+def _write_workbook(dfs: Dict[str, DataFrame], snapshot: Dict[str, DataFrame], upto: int) -> bool:
+    """Перезаписывает data.xlsx (через временный файл). False — кто-то уже записал новее."""
+    with _WRITE_LOCK:
+        if upto < get_store().flushed_seq:
+            return False
+        # читаем все текущие, обновляем только нужные
+        try:
+            xl = pd.ExcelFile(DATA_FILE, engine="openpyxl")
+            all_sheets = {name: xl.parse(name) for name in xl.sheet_names if name not in snapshot}
+        except Exception:
+            all_sheets = {}
+        all_sheets.update(dfs)
+        all_sheets = {**snapshot, **all_sheets}
+        tmp = DATA_FILE + ".tmp.xlsx"
+        with pd.ExcelWriter(tmp, engine="openpyxl", mode="w") as w:
+            for name, df in all_sheets.items():
+                df.to_excel(w, sheet_name=name, index=False)
+        os.replace(tmp, DATA_FILE)
+        return True
 
-    save_df_map({SHEET_MOVES: mov, SHEET_INVENTORY: inv})
 
+def _write_frozen(dfs: Dict[str, DataFrame], frozen: RecordStore) -> bool:
+    """Для потока: листы хранилища строятся из копии здесь, а не на цикле."""
+    snapshot, upto = _store_snapshot(frozen)
+    return _write_workbook(dfs, snapshot, upto)
 
-def get_thresholds() -> DataFrame:
-    ensure_excel()
-    try:
-        s = load_df(SHEET_SETTINGS)
-    except Exception:
-        s = pd.DataFrame(columns=["product", "poor_threshold", "luxe_threshold"])
-    if s.empty:
-        # инициализируем строками для всех товаров (0 пороги по умолчанию)
-        base = pd.DataFrame(
-            [{"product": p, "poor_threshold": 0, "luxe_threshold": 0} for p in ALL_PRODUCTS]
-        )
-        save_df_map({SHEET_SETTINGS: base})
-        return base
-    # дополним отсутствующие позиции
-    present = set(s["product"].astype(str).tolist())
-    missing = [p for p in ALL_PRODUCTS if p not in present]
-    if missing:
-        add_rows = pd.DataFrame(
-            [{"product": p, "poor_threshold": 0, "luxe_threshold": 0} for p in missing]
-        )
-        s = pd.concat([s, add_rows], ignore_index=True)
-        save_df_map({SHEET_SETTINGS: s})
-    return s
 
+@timed("storage_seconds", op="save_df_map")
+def save_df_map(dfs: Dict[str, DataFrame]) -> None:
+    """Пишет листы в data.xlsx. movements/inventory сначала уходят в хранилище,
+    а в файл всегда попадает их актуальное состояние (заодно это flush журнала)."""
+    global CUBE
+    dfs = dict(dfs)
+    store = get_store()
+    if SHEET_UNITS in dfs:
+        set_unit_overrides(dfs[SHEET_UNITS])  # хранилище в базовых единицах — меняются только упаковки
+        invalidate_snapshot()  # а qty в Parquet посчитан по старым упаковкам
+    if SHEET_MOVES in dfs:
+        store.replace_movements(dfs.pop(SHEET_MOVES))
+        invalidate_snapshot()
+        CUBE = None  # кубы статистики пересоберутся по новому журналу
+        drop_inventory_snapshot()
+    if SHEET_INVENTORY in dfs:
+        store.replace_inventory(dfs.pop(SHEET_INVENTORY))
+    snapshot, upto = _store_snapshot()
+    if _write_workbook(dfs, snapshot, upto):
+        store.mark_flushed(upto)
 
-def set_threshold(product: str, mode: str, value: float) -> None:
-    """mode in {'poor','luxe'}"""
-    s = get_thresholds().copy()
-    if product in s["product"].values:
+
+def flush_store() -> bool:
+    """Сбрасывает журнал в data.xlsx, если есть что сбрасывать."""
+    if STORE is None or not STORE.dirty:
+        return False
+    save_df_map({})
+    return True
+
+
+async def flush_store_async() -> bool:
+    """То же без блокировки цикла: снимок в памяти здесь, запись файла — в потоке."""
+    if STORE is None or not STORE.dirty:
+        return False
+    with timer("storage_seconds", op="flush"):
+        frozen = STORE.frozen()
+        if await asyncio.to_thread(_write_frozen, {}, frozen):
+            STORE.mark_flushed(frozen.last_seq)
+    return True
+
+
+async def save_df_map_async(dfs: Dict[str, DataFrame]) -> None:
+    """save_df_map для прочих листов без блокировки цикла (movements/inventory — только через хранилище)."""
+    if SHEET_MOVES in dfs or SHEET_INVENTORY in dfs:
+        raise ValueError("movements и inventory меняются через хранилище, а не листом")
+    store = get_store()
+    with timer("storage_seconds", op="save_df_map_async"):
+        while True:
+            frozen = store.frozen()
+            if await asyncio.to_thread(_write_frozen, dfs, frozen):
+                store.mark_flushed(frozen.last_seq)
+                return
+            # пока писали, кто-то сохранил снимок новее и наш отброшен — листы dfs ещё не в файле
+
+
+def store_etag() -> str:
+    """Версия хранилища: меняется при каждой перезаписи data.xlsx."""
+    st = os.stat(DATA_FILE)
+    return f"{st.st_mtime_ns}-{st.st_size}"
+
+
+def apply_movement(cur: float, action: str, qty: float) -> float:
+    """Новый остаток после движения: consume списывает, count задаёт факт, остальное приходует."""
+    if action == "consume":
+        return cur - qty
+    if action == "count":
+        return qty
+    return cur + qty
+
+
+def _at_origin(mov: DataFrame) -> DataFrame:
+    """Отмены (ref) переносим на ts гасимой записи, колонки seq и ref убираем.
+
+    Так отмена вычитается из того же дня, что и исходное движение. Если
+    исходной в выборке нет, она вне периода — тогда и отмену отбрасываем.
+    """
+    refs = mov["ref"].astype("int64")
+    undo = refs != 0
+    if undo.any():
+        origin = pd.Series(mov["ts"].values, index=mov["seq"].astype("int64").values)
+        ts = origin.reindex(refs[undo].values)
+        mov = mov.copy()
+        mov.loc[undo, "ts"] = ts.values
+        mov = mov.loc[~undo | mov["ts"].notna()]
+    return mov.drop(columns=["seq", "ref"])
+
+
+def add_movement(
+    who: str, action: str, user_id: int, product: str, qty: float, ref: int = 0, base: Optional[int] = None,
+    origin: Optional[dt.datetime] = None,
+) -> List[str]:
+    """Пишем строку в movements и корректируем остатки в inventory.
+
+    qty — в упаковках; base — то же в базовых единицах (мл, шт), если уже
+    посчитано (см. parse_quantity) — тогда qty из него и выводится.
+    Только хранилище в памяти и строка журнала — data.xlsx догонит при flush.
+    ref — seq записи, которую эта гасит (см. undo_last); такие не проверяем.
+    origin — время гасимой записи: прогноз и кубы вычитают отмену из её дня и часа.
+    Возвращает тексты предупреждений детектора аномалий (обычно пусто).
+    """
+    store = get_store()
+    if ANOMALIES is None:
+        backfill_anomalies()  # поднимаем состояние детектора из истории один раз
+    now = venue_now().replace(tzinfo=None)
+    ts = now.strftime("%Y-%m-%d %H:%M:%S")
+    size = units_of(product).pack_size
+    if base is None:
+        base = to_base(product, qty)
+    qty = base / size
+    cur = store.stock_base(product)  # неизвестный товар — с нуля, расход честно уводит в минус
+    if not ref and action == "consume" and apply_movement(cur, action, base) < 0 and STOCK_POLICY == "reject":
+        raise StockError(product, cur / size, qty)
+    new_qty = store.append(now, who, action, user_id, product, base, ref) / size
+    inc("movements_total", action=action)
+    forecast_observe(product, action, origin or now, qty)
+    stats_observe(action, origin or now, user_id, product, base)
+    if ref:
+        inc("corrections_total", action=action)
+        return []
+    return anomaly_observe(ts, action, user_id, product, qty, new_qty)
+
+
+def undo_last(user_id: int, n: int = 1) -> List[Tuple[str, str, int]]:
+    """Гасит последние n записей пользователя компенсирующими.
+
+    Возвращает [(action, product, qty в базовых единицах)] отменённых, от последней к первой.
+    """
+    store = get_store()
+    since = _to_secs(venue_now().replace(tzinfo=None) - dt.timedelta(hours=UNDO_WINDOW_HOURS))
+    done: List[Tuple[str, str, int]] = []
+    for i in store.undoable(user_id, n, since):
+        action = store.actions.names[store.action[i]]
+        product = store.products.names[store.product[i]]
+        base = store.qty[i]
+        add_movement(store.whos.names[store.who[i]], action, user_id, product, 0, ref=store.seq[i], base=-base,
+                     origin=_EPOCH + dt.timedelta(seconds=store.ts[i]))
+        done.append((action, product, base))
+    return done
+
+
+def get_thresholds() -> DataFrame:
+    ensure_excel()
+    try:
+        s = load_df(SHEET_SETTINGS)
+    except Exception:
+        s = pd.DataFrame(columns=["product", "poor_threshold", "luxe_threshold"])
+    # дополним отсутствующие позиции нулевыми порогами; в файл они попадут со следующей
+    # записью порогов — отчёт на цикле ради них data.xlsx не переписывает
+    present = set(s["product"].astype(str).tolist())
+    missing = [p for p in dict.fromkeys(ALL_PRODUCTS) if p not in present]
+    if missing:
+        add_rows = pd.DataFrame(
+            [{"product": p, "poor_threshold": 0, "luxe_threshold": 0} for p in missing]
+        )
+        s = add_rows if s.empty else pd.concat([s, add_rows], ignore_index=True)
+    return s
+
+
+async def set_threshold(product: str, mode: str, value: float) -> None:
+    """mode in {'poor','luxe'}"""
+    s = get_thresholds().copy()
+    if product in s["product"].values:
         idx = s.index[s["product"] == product][0]
         if mode == "poor":
             s.at[idx, "poor_threshold"] = value
@@ -337,14 +1608,13 @@ def set_threshold(product: str, mode: str, value: float) -> None:
                                "luxe_threshold": value if mode == "luxe" else 0}])],
             ignore_index=True
         )
-    save_df_map({SHEET_SETTINGS: s})
+    await save_df_map_async({SHEET_SETTINGS: s})
 
 
 def compute_order(mode: str) -> List[Tuple[str, float]]:
     """Возвращает список (product, need_qty) исходя из порога (poor/luxe) и текущих остатков."""
     s = get_thresholds()
-    inv = load_df(SHEET_INVENTORY)
-    inv_map = {str(r["product"]): float(r["qty"]) if pd.notna(r["qty"]) else 0.0 for _, r in inv.iterrows()}
+    inv_map = get_store().stock_map()
     out: List[Tuple[str, float]] = []
     for _, r in s.iterrows():
         prod = str(r["product"])
@@ -356,27 +1626,477 @@ def compute_order(mode: str) -> List[Tuple[str, float]]:
     return out
 
 
-def record_expiry(product: str, expiry_date: dt.date, qty: float) -> None:
+async def record_expiry(product: str, expiry_date: dt.date, qty: float) -> None:
     """Сохраняем срок годности (суммируем по продукту/дате)."""
     ensure_excel()
+    await save_df_map_async({SHEET_EXPIRY: _merge_expiry(_load_expiry(), {(product, expiry_date): qty})})
+
+
+def _load_expiry() -> DataFrame:
     try:
         exp = load_df(SHEET_EXPIRY)
     except Exception:
         exp = pd.DataFrame(columns=["product", "expiry_date", "qty"])
     exp["expiry_date"] = pd.to_datetime(exp["expiry_date"], errors="coerce").dt.date
+    return exp
 
-    # ищем совпадение по продукту+дата
-    mask = (exp["product"] == product) & (exp["expiry_date"] == expiry_date)
-    if mask.any():
-        idx = exp.index[mask][0]
-        old = float(exp.at[idx, "qty"]) if pd.notna(exp.at[idx, "qty"]) else 0.0
-        exp.at[idx, "qty"] = old + qty
-    else:
-        exp = pd.concat(
-            [exp, pd.DataFrame([{"product": product, "expiry_date": expiry_date, "qty": qty}])],
+
+def _merge_expiry(exp: DataFrame, lots: Dict[Tuple[str, dt.date], float]) -> DataFrame:
+    """Добавляет партии {(продукт, дата): кол-во} к листу expiry: та же пара — суммируем, новая — строкой."""
+    exp = exp.copy()
+    pos = {(p, d): i for i, p, d in zip(exp.index, exp["product"], exp["expiry_date"])}
+    new = []
+    for (product, expiry_date), qty in lots.items():
+        idx = pos.get((product, expiry_date))
+        if idx is None:
+            new.append({"product": product, "expiry_date": expiry_date, "qty": qty})
+        else:
+            old = float(exp.at[idx, "qty"]) if pd.notna(exp.at[idx, "qty"]) else 0.0
+            exp.at[idx, "qty"] = old + qty
+    if new:
+        exp = pd.concat([exp, pd.DataFrame(new)], ignore_index=True)
+    return exp
+
+
+# ================== ИНВЕНТАРИЗАЦИЯ ==================
+def current_stock(product: str) -> float:
+    return get_store().stock_of(product)
+
+
+async def record_stocktake(user_id: int, product: str, counted: float,
+                     base: Optional[int] = None) -> Tuple[float, float]:
+    """Пересчёт: остаток становится фактическим, расхождение пишем в stocktake.
+
+    counted — в упаковках (или base — в базовых единицах, тогда counted из него).
+    Возвращает (ожидалось, расхождение) в упаковках. Минус — недостача.
+    """
+    ensure_excel()
+    rows = _stocktake_rows(user_id, {product: to_base(product, counted) if base is None else base})
+    await save_df_map_async({SHEET_STOCKTAKE: _append_rows(SHEET_STOCKTAKE, STOCKTAKE_COLUMNS, rows)})
+    return float(rows.at[0, "expected"]), float(rows.at[0, "variance"])
+
+
+def _stocktake_rows(user_id: int, counts: Dict[str, int]) -> DataFrame:
+    """Пересчёты пачкой: движения count в хранилище и строки для листа stocktake (в упаковках)."""
+    ts = venue_now().strftime("%Y-%m-%d %H:%M:%S")
+    rows = []
+    for product, base in counts.items():
+        expected = current_stock(product)
+        counted = base / units_of(product).pack_size
+        add_movement("admin", "count", user_id, product, counted, base=base)
+        rows.append({"ts": ts, "user_id": user_id, "product": product,
+                     "expected": expected, "counted": counted, "variance": counted - expected})
+    return pd.DataFrame(rows, columns=STOCKTAKE_COLUMNS)
+
+
+def _append_rows(sheet: str, columns: List[str], rows: DataFrame) -> DataFrame:
+    try:
+        cur = load_df(sheet)
+    except Exception:
+        cur = pd.DataFrame(columns=columns)
+    return pd.concat([cur, rows], ignore_index=True)
+
+
+def variance_report(days: int = 30) -> str:
+    """Последний пересчёт по каждому продукту за N дней: ожидалось vs насчитали."""
+    ensure_excel()
+    try:
+        cnt = load_df(SHEET_STOCKTAKE)
+    except Exception:
+        return "Пересчётов ещё не было."
+    if cnt.empty:
+        return "Пересчётов ещё не было."
+    cnt["ts"] = pd.to_datetime(cnt["ts"], errors="coerce")
+    cnt = cnt.loc[cnt["ts"] >= pd.Timestamp(venue_now().replace(tzinfo=None)) - pd.Timedelta(days=days)]
+    if cnt.empty:
+        return f"За {days} дн. пересчётов не было."
+    last = cnt.sort_values("ts").groupby("product", as_index=False).tail(1)
+    last = last.reindex(last["variance"].abs().sort_values(ascending=False).index)
+    lines = []
+    short: Dict[str, float] = {}  # недостача по базовым единицам: кеги с бутылками не складываем
+    for _, r in last.iterrows():
+        p = str(r["product"])
+        sign = "+" if r["variance"] > 0 else ""
+        lines.append(f"• {p}: ожидалось {fmt_qty(p, to_base(p, r['expected']))}, "
+                     f"насчитали {fmt_qty(p, to_base(p, r['counted']))} ({sign}{fmt_qty(p, to_base(p, r['variance']))})")
+        if r["variance"] < 0:
+            unit = units_of(p).base
+            short[unit] = short.get(unit, 0.0) - to_base(p, r["variance"])
+    lines.append(f"\nИтого недостача: {fmt_sums(short)}")
+    return "\n".join(lines)
+
+
+def inventory_from_log(mov: DataFrame, base: Optional[Dict[str, float]] = None) -> pd.Series:
+    """Остатки по журналу движений за один векторный проход.
+
+    По каждому продукту берём последний пересчёт (count) как базу и
+    прибавляем всё, что было после него; без пересчёта — с base (снимка
+    остатков до первой строки mov) или с нуля.
+    """
+    if mov.empty:
+        return pd.Series(base or {}, dtype=float, name="qty")
+    m = pd.DataFrame({
+        "product": mov["product"].astype(str),
+        "action": mov["action"],
+        "qty": pd.to_numeric(mov["qty"], errors="coerce").fillna(0.0),
+        "pos": range(len(mov)),
+    })
+    is_count = m["action"] == "count"
+    base_pos = m.loc[is_count].groupby("product")["pos"].max()
+    start = m["product"].map(base_pos).fillna(-1)
+    m = m.loc[m["pos"] >= start]
+    signed = m["qty"].where(m["action"] != "consume", -m["qty"])
+    by_log = signed.groupby(m["product"]).sum()
+    if base:
+        carry = pd.Series({p: q for p, q in base.items() if p not in base_pos.index}, dtype=float)
+        by_log = by_log.add(carry, fill_value=0.0)
+    return by_log.rename("qty")
+
+
+# Снимок остатков, свёрнутый из самого журнала до seq включительно: пересборка
+# начинает с него и доигрывает только хвост. Обновляется по таймеру flush.
+def inventory_snapshot() -> Optional[dict]:
+    snap = load_state().get("inventory_snapshot")
+    if not snap or snap.get("seq", 0) > get_store().last_seq:
+        return None  # журнал заменили целиком — снимок ему не соответствует
+    return snap
+
+
+def inventory_by_log() -> pd.Series:
+    """Остатки по журналу: снимок + движения после него (без снимка — весь журнал)."""
+    snap = inventory_snapshot() or {}
+    mov = get_store().movements_frame(["action", "product", "qty"], after_seq=snap.get("seq", 0))
+    return inventory_from_log(mov, base=snap.get("stock"))
+
+
+def snapshot_inventory() -> bool:
+    """Сдвигает снимок остатков к последней записи журнала."""
+    store = get_store()
+    snap = inventory_snapshot()
+    if snap and snap["seq"] == store.last_seq:
+        return False
+    with timer("storage_seconds", op="snapshot_inventory"):
+        stock = inventory_by_log()
+        state = load_state()
+        state["inventory_snapshot"] = {"seq": store.last_seq, "stock": {str(p): float(q) for p, q in stock.items()}}
+        save_state(state)
+    return True
+
+
+def drop_inventory_snapshot() -> None:
+    state = load_state()
+    if state.pop("inventory_snapshot", None) is not None:
+        save_state(state)
+
+
+def _drift(inv: DataFrame, by_log: pd.Series) -> DataFrame:
+    sheet = pd.to_numeric(inv["qty"], errors="coerce").fillna(0.0).groupby(inv["product"].astype(str)).sum()
+    both = pd.concat([sheet.rename("sheet"), by_log.rename("log")], axis=1)
+    both = both.loc[both["log"].notna()].fillna(0.0)
+    return both.loc[(both["sheet"] - both["log"]).abs() > 1e-9]
+
+
+def inventory_drift() -> List[Tuple[str, float, float]]:
+    """Где лист inventory разошёлся с журналом: (product, в листе, по журналу)."""
+    ensure_excel()
+    diff = _drift(load_df(SHEET_INVENTORY), inventory_by_log())
+    return [(str(p), float(r["sheet"]), float(r["log"])) for p, r in diff.iterrows()]
+
+
+async def rebuild_inventory() -> int:
+    """Пересобирает лист inventory из журнала. Возвращает число исправленных позиций.
+
+    Позиции без истории движений (внесённые руками) остаются как есть.
+    Журнал доигрывается от последнего снимка остатков, а не с начала.
+    """
+    ensure_excel()
+    inv = load_df(SHEET_INVENTORY)
+    by_log = inventory_by_log()
+    drift = _drift(inv, by_log)
+    inv = inv.copy()
+    inv["product"] = inv["product"].astype(str)
+    known = inv["product"].isin(by_log.index)
+    inv.loc[known, "qty"] = inv.loc[known, "product"].map(by_log)
+    inv.loc[known, "qty_base"] = np.nan  # пересчитается из qty: иначе победит старый qty_base
+    missing = by_log.index.difference(inv["product"])
+    if len(missing):
+        inv = pd.concat(
+            [inv, pd.DataFrame({"product": missing, "unit": "", "qty": by_log.loc[missing].values})],
             ignore_index=True,
         )
-    save_df_map({SHEET_EXPIRY: exp})
+    get_store().replace_inventory(inv)
+    await save_df_map_async({})  # запишет inventory из хранилища
+    return len(drift)
+
+
+# ================== ИМПОРТ НАКЛАДНЫХ И ПЕРЕСЧЁТОВ ==================
+# Админ присылает CSV/XLSX: накладную поставщика (приём + сроки годности) или
+# лист пересчёта. Файл читается построчно в потоке (csv / openpyxl read_only),
+# названия сопоставляются с каталогом по заранее собранному индексу, админ
+# смотрит превью и подтверждает — тогда всё проводится пачкой и data.xlsx
+# пишется один раз, а не по разу на строку.
+IMPORT_MAX_BYTES = 20 * 1024 * 1024  # больше Bot API боту всё равно не отдаст
+IMPORT_MAX_ROWS = 5000
+IMPORT_HEADER_ROWS = 20              # где искать строку заголовков
+IMPORT_PREVIEW_LINES = 15
+IMPORT_FUZZY_CUTOFF = 0.88           # с какой похожести название считаем «наверное, это оно»
+
+# узнаваемые заголовки колонок (в виде после _norm_name)
+_IMPORT_HEADERS = {
+    "product": ("товар", "наименование", "наименование товара", "название", "продукт", "позиция",
+                "product", "name", "item"),
+    "qty": ("количество", "кол во", "колво", "кол", "qty", "quantity", "count", "факт", "насчитали", "counted"),
+    "unit": ("ед", "ед изм", "единица", "единица измерения", "unit", "units", "uom"),
+    "expiry": ("срок годности", "годен до", "срок", "expiry", "expiry date", "best before"),
+}
+_EXPIRY_FORMATS = ("%d.%m.%Y", "%d.%m.%y", "%Y-%m-%d", "%d/%m/%Y")
+
+
+class ImportFileError(ValueError):
+    """Файл не похож на накладную/пересчёт: не тот формат или нет нужных колонок."""
+
+
+@dataclass
+class ImportPlan:
+    """Разобранный файл — то, что будет проведено после подтверждения."""
+
+    kind: str                                # "receive" — накладная, "count" — пересчёт
+    qty: Dict[str, int]                      # товар -> базовые единицы (повторы строк сложены)
+    lots: Dict[Tuple[str, dt.date], int]     # (товар, срок годности) -> базовые единицы
+    guessed: Dict[str, str]                  # название из файла -> товар, найденный по похожести
+    skipped: List[str]                       # что не разобрали, с причиной
+    rows: int = 0                            # строк с данными в файле
+
+
+def _norm_name(s: str) -> str:
+    """«Jägermeister 0,7 л.» и «jagermeister 0 7 л» — один ключ: регистр, ё, пунктуация."""
+    return re.sub(r"[\W_]+", " ", str(s).lower().replace("ё", "е")).strip()
+
+
+def _sorted_key(key: str) -> str:
+    return " ".join(sorted(key.split()))
+
+
+NAME_INDEX: Optional[Tuple[Tuple[int, int], Dict[str, str]]] = None
+
+
+def name_index() -> Dict[str, str]:
+    """Ключ названия -> товар каталога, и по точному ключу, и без учёта порядка слов.
+
+    Собирается один раз и заново — только когда каталог пополнился.
+    """
+    global NAME_INDEX
+    store = get_store()
+    version = (len(ALL_PRODUCTS), len(store.products.names))
+    if NAME_INDEX is None or NAME_INDEX[0] != version:
+        idx: Dict[str, str] = {}
+        known = [store.products.names[pid] for pid in store.rows]
+        for p in dict.fromkeys(ALL_PRODUCTS + known):
+            key = _norm_name(p)
+            idx.setdefault(key, p)
+            idx.setdefault(_sorted_key(key), p)
+        NAME_INDEX = (version, idx)
+    return NAME_INDEX[1]
+
+
+def match_product(name: str, idx: Optional[Dict[str, str]] = None) -> Tuple[Optional[str], bool]:
+    """(товар, точно ли). Похожие по написанию названия возвращаем с False — их покажем в превью.
+
+    Из потока передаём idx, собранный в цикле: name_index() трогает хранилище и глобальный кэш.
+    """
+    idx = name_index() if idx is None else idx
+    key = _norm_name(name)
+    found = idx.get(key) or idx.get(_sorted_key(key))
+    if found:
+        return found, True
+    close = difflib.get_close_matches(key, list(idx), n=1, cutoff=IMPORT_FUZZY_CUTOFF)
+    return (idx[close[0]], False) if close else (None, False)
+
+
+def _iter_rows(data: bytes, filename: str):
+    """Строки файла по одной: xlsx — openpyxl в read_only, csv — модулем csv поверх потока байт."""
+    name = filename.lower()
+    if name.endswith((".xlsx", ".xlsm")):
+        import openpyxl  # тянется вместе с pandas-движком для data.xlsx
+
+        try:
+            wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        except Exception as e:
+            raise ImportFileError(f"не открывается как XLSX: {e}") from e
+        try:
+            yield from wb.worksheets[0].iter_rows(values_only=True)
+        except Exception as e:  # битый архив/лист всплывает только при чтении строк
+            raise ImportFileError(f"не читается как XLSX: {e}") from e
+        finally:
+            wb.close()
+        return
+    if not name.endswith((".csv", ".txt")):
+        raise ImportFileError("нужен файл .csv или .xlsx")
+    # кодировку и разделитель определяем по началу файла; 1С и Excel часто отдают cp1251 и «;»
+    head = data[:64 * 1024]
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+        encoding = "utf-8-sig"
+    except UnicodeDecodeError:
+        encoding = "cp1251"
+    # csv.Sniffer путается на шапке накладной («Накладная №5;;») — просто считаем кандидатов
+    lines = head.decode(encoding, errors="ignore").splitlines()[:IMPORT_HEADER_ROWS]
+    delimiter = max(";,\t", key=lambda d: sum(line.count(d) for line in lines))
+    with io.TextIOWrapper(io.BytesIO(data), encoding=encoding, errors="replace", newline="") as f:
+        try:
+            yield from csv.reader(f, delimiter=delimiter)
+        except csv.Error as e:  # NUL-байты, огромное поле — это не таблица
+            raise ImportFileError(f"не читается как CSV: {e}") from e
+
+
+def _find_columns(row) -> Optional[Dict[str, int]]:
+    cols: Dict[str, int] = {}
+    for i, cell in enumerate(row):
+        key = _norm_name(cell) if cell is not None else ""
+        for field, names in _IMPORT_HEADERS.items():
+            if key in names and field not in cols:
+                cols[field] = i
+    return cols if "product" in cols and "qty" in cols else None
+
+
+def _parse_expiry(cell) -> Optional[dt.date]:
+    if isinstance(cell, dt.datetime):
+        return cell.date()
+    if isinstance(cell, dt.date):
+        return cell
+    for fmt in _EXPIRY_FORMATS:
+        try:
+            return dt.datetime.strptime(str(cell).strip(), fmt).date()
+        except ValueError:
+            pass
+    return None
+
+
+def parse_import(data: bytes, filename: str, kind: str, index: Dict[str, str]) -> ImportPlan:
+    """Разбирает накладную или пересчёт в план. Тяжёлое — зовём через asyncio.to_thread,
+    а index (name_index()) собираем заранее в цикле.
+
+    Нужны колонки «товар» и «количество»; «ед.» и «срок годности» — по желанию.
+    Количество без единицы — в упаковках, как при ручном вводе.
+    """
+    plan = ImportPlan(kind, {}, {}, {}, [])
+    cols: Optional[Dict[str, int]] = None
+    matched: Dict[str, Tuple[Optional[str], bool]] = {}  # повторы названий не ищем заново
+    for n, row in enumerate(_iter_rows(data, filename), start=1):
+        if cols is None:
+            cols = _find_columns(row)
+            if cols is None and n >= IMPORT_HEADER_ROWS:
+                break
+            continue
+
+        def cell(field: str):
+            i = cols.get(field)
+            v = row[i] if i is not None and i < len(row) else None
+            return None if v is None or str(v).strip() == "" else v
+
+        name = cell("product")
+        if name is None or _norm_name(name) in ("итого", "всего", "total"):
+            continue  # пустые строки и подвал накладной
+        plan.rows += 1
+        if plan.rows > IMPORT_MAX_ROWS:
+            raise ImportFileError(f"больше {IMPORT_MAX_ROWS} строк — раздели файл")
+        name = str(name).strip()
+        if name not in matched:
+            matched[name] = match_product(name, index)
+        product, exact = matched[name]
+        if product is None:
+            plan.skipped.append(f"строка {n}: «{name}» — нет в каталоге")
+            continue
+        qty = cell("qty")
+        unit = cell("unit")
+        text = "" if qty is None else f"{qty:g}" if isinstance(qty, float) else str(qty).strip()
+        text = f"{text} {unit}" if unit is not None else text
+        base = parse_quantity(text, product)
+        if base is None:
+            plan.skipped.append(f"строка {n}: «{name}» — не понял количество «{text}»")
+            continue
+        if not exact:
+            plan.guessed[name] = product
+        plan.qty[product] = plan.qty.get(product, 0) + base
+        if kind == "receive" and cell("expiry") is not None:
+            exp = _parse_expiry(cell("expiry"))
+            if exp is None:
+                plan.skipped.append(f"строка {n}: «{name}» — срок «{cell('expiry')}» не разобран, принят без срока")
+            else:
+                plan.lots[(product, exp)] = plan.lots.get((product, exp), 0) + base
+    if cols is None:
+        raise ImportFileError("не нашёл заголовков — нужны колонки «Товар» и «Количество»")
+    return plan
+
+
+def import_hint(kind: str) -> str:
+    what = ("накладную поставщика: колонки «Товар», «Количество», по желанию «Ед.» и «Срок годности»"
+            if kind == "receive" else "лист пересчёта: колонки «Товар» и «Количество», по желанию «Ед.»")
+    return (f"Пришли файлом (CSV или XLSX) {what}.\n"
+            "Количество без единицы — в бутылках/штуках; в «Ед.» можно указать мл, л, порц.\n"
+            "Перед проведением покажу, что получилось.")
+
+
+def import_preview(plan: ImportPlan) -> str:
+    title = "Накладная" if plan.kind == "receive" else "Пересчёт"
+    store = get_store()
+    lines = [f"{title}: строк {plan.rows}, позиций {len(plan.qty)}."]
+    for p, base in list(plan.qty.items())[:IMPORT_PREVIEW_LINES]:
+        if plan.kind == "count":
+            lines.append(f"• {p} — {fmt_qty(p, base)} (по учёту {fmt_qty(p, store.stock_base(p))})")
+        else:
+            lines.append(f"• {p} — +{fmt_qty(p, base)}")
+    if len(plan.qty) > IMPORT_PREVIEW_LINES:
+        lines.append(f"… и ещё {len(plan.qty) - IMPORT_PREVIEW_LINES}")
+    if plan.lots:
+        lines.append(f"\nСроки годности: партий {len(plan.lots)}, ближайший "
+                     f"{min(d for _, d in plan.lots).strftime('%d.%m.%Y')}.")
+    if plan.guessed:
+        lines.append("\nУгадал по похожести — проверь:")
+        lines += [f"• «{raw}» → {p}" for raw, p in list(plan.guessed.items())[:IMPORT_PREVIEW_LINES]]
+    if plan.skipped:
+        lines.append(f"\nПропущено: {len(plan.skipped)}")
+        lines += [f"• {s}" for s in plan.skipped[:IMPORT_PREVIEW_LINES]]
+        if len(plan.skipped) > IMPORT_PREVIEW_LINES:
+            lines.append(f"… и ещё {len(plan.skipped) - IMPORT_PREVIEW_LINES}")
+    return "\n".join(lines)
+
+
+def apply_import(plan: ImportPlan, user_id: int) -> Tuple[List[str], Dict[str, DataFrame]]:
+    """Проводит план пачкой в хранилище (без записи файла).
+
+    Возвращает алерты детектора и листы, которые надо записать в data.xlsx
+    одним save_df_map / save_df_map_async вместе со снимком движений.
+    """
+    ensure_excel()
+    if plan.kind == "count":
+        rows = _stocktake_rows(user_id, plan.qty)
+        return [], {SHEET_STOCKTAKE: _append_rows(SHEET_STOCKTAKE, STOCKTAKE_COLUMNS, rows)}
+    alerts: List[str] = []
+    for product, base in plan.qty.items():
+        alerts += add_movement("admin", "receive", user_id, product, 0, base=base)
+    if not plan.lots:
+        return alerts, {}
+    lots = {(p, d): base / units_of(p).pack_size for (p, d), base in plan.lots.items()}
+    return alerts, {SHEET_EXPIRY: _merge_expiry(_load_expiry(), lots)}
+
+
+# ================== КЛАВИАТУРЫ ==================
+# Кнопка товара несёт его номер в ALL_PRODUCTS, а не название: callback_data — не
+# больше 64 байт, а «countchoose:» + длинное русское название туда не влезает.
+# Каталог только дописывается, так что номер стабилен.
+_PRODUCT_PREFIXES = {"bchoose", "setupchoose", "recvchoose", "expchoose", "countchoose"}
+
+
+def product_ref(name: str) -> str:
+    return str(ALL_PRODUCTS.index(name))
+
+
+def product_by_ref(ref: str) -> Optional[str]:
+    try:
+        return ALL_PRODUCTS[int(ref)]
+    except (ValueError, IndexError):
+        return None
 
 
 def list_products_kb(prefix: str, page: int = 0) -> InlineKeyboardMarkup:
@@ -387,7 +2107,7 @@ def list_products_kb(prefix: str, page: int = 0) -> InlineKeyboardMarkup:
     page_items = items[start:end]
     rows: List[List[InlineKeyboardButton]] = []
     for name in page_items:
-        rows.append([InlineKeyboardButton(name, callback_data=f"{prefix}:{name}")])
+        rows.append([InlineKeyboardButton(name, callback_data=f"{prefix}:{product_ref(name)}")])
     nav = []
     if page > 0:
         nav.append(InlineKeyboardButton("◀️", callback_data=f"nav:{prefix}:{page-1}"))
@@ -413,7 +2133,9 @@ def items_in_category_kb(cat_key: str, next_prefix: str, page: int = 0) -> Inlin
     start = page * PAGE_SIZE
     end = min(total, start + PAGE_SIZE)
     page_items = items[start:end]
-    rows: List[List[InlineKeyboardButton]] = [[InlineKeyboardButton(n, callback_data=f"{next_prefix}:{n}")] for n in page_items]
+    rows: List[List[InlineKeyboardButton]] = [
+        [InlineKeyboardButton(n, callback_data=f"{next_prefix}:{product_ref(n)}")] for n in page_items
+    ]
     nav = []
     if page > 0:
         nav.append(InlineKeyboardButton("◀️", callback_data=f"catnav:{next_prefix}:{cat_key}:{page-1}"))
@@ -438,6 +2160,7 @@ def admin_menu_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton("📊 Статистика", callback_data="admin:stats")],
         [InlineKeyboardButton("🧾 Додеп", callback_data="admin:dodep")],
         [InlineKeyboardButton("📦 Приём товара", callback_data="admin:receive")],
+        [InlineKeyboardButton("🧮 Инвентаризация", callback_data="admin:count")],
         [InlineKeyboardButton("⬅️ Назад", callback_data="back"), InlineKeyboardButton("🏠 В начало", callback_data="home")],
     ])
 
@@ -447,14 +2170,36 @@ def stats_menu_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton("За месяц", callback_data="stats:30")],
         [InlineKeyboardButton("За 4 дня", callback_data="stats:4")],
         [InlineKeyboardButton("За сутки", callback_data="stats:1")],
+        [InlineKeyboardButton("🔎 Разрезы и сравнение периодов", callback_data="slice:menu")],
+        [InlineKeyboardButton("⬅️ Назад", callback_data="back"), InlineKeyboardButton("🏠 В начало", callback_data="home")],
+    ])
+
+
+def slice_period_kb() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Сегодня", callback_data="slice:period:today"),
+         InlineKeyboardButton("7 дней", callback_data="slice:period:7"),
+         InlineKeyboardButton("30 дней", callback_data="slice:period:30")],
+        [InlineKeyboardButton("Этот месяц", callback_data="slice:period:month"),
+         InlineKeyboardButton("Прошлый месяц", callback_data="slice:period:prevmonth")],
+        [InlineKeyboardButton("📅 Свои даты", callback_data="slice:custom")],
         [InlineKeyboardButton("⬅️ Назад", callback_data="back"), InlineKeyboardButton("🏠 В начало", callback_data="home")],
     ])
 
 
+def slice_by_kb() -> InlineKeyboardMarkup:
+    rows = [[InlineKeyboardButton(f"По {title}", callback_data=f"slice:by:{key}")]
+            for key, title in STATS_DIMENSIONS.items()]
+    rows.append([InlineKeyboardButton("⬅️ Назад", callback_data="back"), InlineKeyboardButton("🏠 В начало", callback_data="home")])
+    return InlineKeyboardMarkup(rows)
+
+
 def dodep_menu_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("Нищий закуп", callback_data="dodep:poor")],
         [InlineKeyboardButton("Люксовый закуп", callback_data="dodep:luxe")],
+        [InlineKeyboardButton("🔮 Закуп по прогнозу", callback_data="dodep:forecast")],
+        [InlineKeyboardButton("Подставить пороги из прогноза", callback_data="dodep:autotune")],
         [InlineKeyboardButton("Настроить закуп", callback_data="dodep:setup")],
         [InlineKeyboardButton("⬅️ Назад", callback_data="back"), InlineKeyboardButton("🏠 В начало", callback_data="home")],
     ])
@@ -466,6 +2211,26 @@ def receive_menu_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton("Добавить товар вручную (из меню)", callback_data="recv:manual")],
         [InlineKeyboardButton("Добавить новый продукт", callback_data="recv:new")],
         [InlineKeyboardButton("Ввести сроки годности", callback_data="recv:expiry")],
+        [InlineKeyboardButton("📥 Загрузить накладную (CSV/XLSX)", callback_data="recv:import")],
+        [InlineKeyboardButton("⬅️ Назад", callback_data="back"), InlineKeyboardButton("🏠 В начало", callback_data="home")],
+    ])
+
+
+def count_menu_kb() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Ввести пересчёт", callback_data="count:enter")],
+        [InlineKeyboardButton("📥 Загрузить пересчёт (CSV/XLSX)", callback_data="count:import")],
+        [InlineKeyboardButton("Отчёт расхождений", callback_data="count:report")],
+        [InlineKeyboardButton("Сверить остатки с журналом", callback_data="count:drift")],
+        [InlineKeyboardButton("Пересобрать остатки из журнала", callback_data="count:rebuild")],
+        [InlineKeyboardButton("⬅️ Назад", callback_data="back"), InlineKeyboardButton("🏠 В начало", callback_data="home")],
+    ])
+
+
+def import_confirm_kb() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ Провести", callback_data="import:ok"),
+         InlineKeyboardButton("✖️ Отмена", callback_data="import:cancel")],
         [InlineKeyboardButton("⬅️ Назад", callback_data="back"), InlineKeyboardButton("🏠 В начало", callback_data="home")],
     ])
 
@@ -474,6 +2239,7 @@ def confirm_more_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("✅ Добавить ещё", callback_data="b:more")],
         [InlineKeyboardButton("❌ Нет, это всё", callback_data="b:done")],
+        [InlineKeyboardButton("↩️ Отменить последнюю запись", callback_data="b:undo")],
         [InlineKeyboardButton("🏠 В начало", callback_data="home")],
     ])
 
@@ -482,25 +2248,577 @@ def confirm_more_kb() -> InlineKeyboardMarkup:
 def compute_stats(days: int) -> str:
     """Суммируем расход (action=consume) за N дней, группируем по продукту."""
     ensure_excel()
-    try:
-        mov = load_df(SHEET_MOVES)
-    except Exception:
-        mov = pd.DataFrame(columns=["ts", "who", "action", "user_id", "product", "qty"])
-    if mov.empty:
+    if not len(get_store()):
         return "Пока нет данных."
-
-    mov["ts"] = pd.to_datetime(mov["ts"], errors="coerce")
-    since = pd.Timestamp.now() - pd.Timedelta(days=days)
-    mask = (mov["action"] == "consume") & (mov["ts"] >= since)
-    df = mov.loc[mask].copy()
-    if df.empty:
+    since = venue_now().replace(tzinfo=None) - dt.timedelta(days=days)
+    df = _at_origin(read_movements(["ts", "product", "qty", "qty_base", "seq", "ref"], since=since,
+                                  actions=["consume"]))
+    # сумма точная (целые мл/шт), порядок — по упаковкам, как и раньше; отменённое целиком не показываем
+    grp = df.groupby("product", as_index=False)[["qty", "qty_base"]].sum()
+    grp = grp.loc[grp["qty_base"] != 0].sort_values("qty", ascending=False)
+    if grp.empty:
         return "За выбранный период расхода нет."
-
-    grp = df.groupby("product", as_index=False)["qty"].sum().sort_values("qty", ascending=False)
-    lines = [f"• {r['product']}: {r['qty']:.0f}" for _, r in grp.iterrows()]
+    lines = [f"• {p}: {fmt_qty(p, int(b))}" for p, b in zip(grp["product"], grp["qty_base"])]
     return "\n".join(lines)
 
 
+# ================== ПРОГНОЗ РАСХОДА ==================
+class ProductForecast:
+    """Сглаженный дневной расход одного продукта с поправкой на день недели.
+
+    Обновляется по одному движению за раз: расход копится в текущем дне,
+    а при переходе на новый день закрытый день (и пропущенные нулевые дни)
+    вливаются в экспоненциальное среднее, дисперсию и недельную сезонность.
+    """
+
+    __slots__ = ("level", "var", "season", "day", "day_total", "days_seen")
+
+    def __init__(self) -> None:
+        self.level = 0.0                  # средний расход в «обычный» день
+        self.var = 0.0                    # дисперсия ошибки прогноза
+        self.season = [1.0] * 7           # множители Пн..Вс (среднее = 1)
+        self.day: Optional[dt.date] = None
+        self.day_total = 0.0
+        self.days_seen = 0
+
+    def observe(self, day: dt.date, qty: float) -> None:
+        if self.day is None:
+            self.day = day
+        elif day > self.day:
+            self._close_until(day)
+        # запоздавшие записи (day < self.day) относим к текущему дню
+        self.day_total += qty
+
+    def _close_until(self, day: dt.date) -> None:
+        self._fold(self.day, self.day_total)
+        gap = (day - self.day).days - 1
+        # после месяца простоя нули уже ничего не меняют — не крутим цикл зря
+        for i in range(min(gap, 28)):
+            self._fold(self.day + dt.timedelta(days=i + 1), 0.0)
+        self.day = day
+        self.day_total = 0.0
+
+    def _fold(self, day: dt.date, total: float) -> None:
+        wd = day.weekday()
+        s = self.season[wd]
+        base = total / s if s > 0 else total
+        if self.days_seen == 0:
+            self.level = base
+        else:
+            err = base - self.level
+            self.level += FORECAST_ALPHA * err
+            self.var = (1 - FORECAST_ALPHA) * (self.var + FORECAST_ALPHA * err * err)
+        self.days_seen += 1
+        if self.level > 0:
+            self.season[wd] = (1 - FORECAST_SEASON_ALPHA) * s + FORECAST_SEASON_ALPHA * (total / self.level)
+            norm = sum(self.season) / 7
+            if norm > 0:
+                self.season = [x / norm for x in self.season]
+
+    def as_of(self, today: dt.date) -> "ProductForecast":
+        """Копия, где закрыты все дни до today: дни без расхода — нули, а не «как было».
+
+        Сам прогноз закрывает дни только при следующем расходе, и товар, который
+        давно не наливают, иначе так и продолжал бы заказываться.
+        """
+        if self.day is None or self.day >= today:
+            return self
+        f = ProductForecast()
+        f.level, f.var, f.season = self.level, self.var, list(self.season)
+        f.day, f.day_total, f.days_seen = self.day, self.day_total, self.days_seen
+        f._close_until(today)
+        return f
+
+    def demand(self, start: dt.date, days: int) -> float:
+        """Ожидаемый расход за days дней начиная с start."""
+        return sum(self.level * self.season[(start + dt.timedelta(days=i)).weekday()] for i in range(days))
+
+    def safety(self, days: int) -> float:
+        return SAFETY_Z * math.sqrt(max(self.var, 0.0) * days)
+
+
+FORECASTS: Optional[Dict[str, ProductForecast]] = None
+
+
+def get_forecasts() -> Dict[str, ProductForecast]:
+    """Состояние прогноза; при первом обращении строится по истории movements."""
+    global FORECASTS
+    if FORECASTS is not None:
+        return FORECASTS
+    ensure_excel()
+    mov = _at_origin(read_movements(["ts", "product", "qty", "seq", "ref"], actions=["consume"]))
+    state: Dict[str, ProductForecast] = {}
+    if not mov.empty:
+        mov["ts"] = pd.to_datetime(mov["ts"], errors="coerce")
+        mov = mov.loc[mov["ts"].notna()]
+        daily = mov.groupby([mov["product"].astype(str), mov["ts"].dt.date])["qty"].sum()
+        for (prod, day), qty in daily.items():  # отсортировано по продукту и дате
+            state.setdefault(prod, ProductForecast()).observe(day, float(qty))
+    FORECASTS = state
+    return FORECASTS
+
+
+def forecast_observe(product: str, action: str, when: dt.datetime, qty: float) -> None:
+    """Инкрементное обновление прогноза новым движением (только расход)."""
+    if FORECASTS is None or action != "consume":
+        return
+    f = FORECASTS.setdefault(product, ProductForecast())
+    if qty < 0 and f.day is not None and when.date() < f.day:
+        return  # отмена из уже закрытого дня: он влит в среднее, сегодняшний расход ею не уменьшаем
+    f.observe(when.date(), qty)
+
+
+def suggest_thresholds(today: Optional[dt.date] = None) -> Dict[str, Tuple[float, float]]:
+    """Пороги по прогнозу: product -> (poor, luxe).
+
+    Нищий порог покрывает срок поставки, люксовый — поставку плюс неделю до
+    следующего закупа. Оба со страховым запасом.
+    """
+    today = today or venue_today()
+    start = today + dt.timedelta(days=1)
+    out: Dict[str, Tuple[float, float]] = {}
+    for prod, f in get_forecasts().items():
+        f = f.as_of(today)
+        poor_days = SUPPLIER_LEAD_DAYS
+        luxe_days = SUPPLIER_LEAD_DAYS + ORDER_CYCLE_DAYS
+        if f.demand(start, luxe_days) < 0.5:
+            out[prod] = (0, 0)  # товар не берут: остаток страховки не должен заказывать по бутылке
+            continue
+        poor = f.demand(start, poor_days) + f.safety(poor_days)
+        luxe = f.demand(start, luxe_days) + f.safety(luxe_days)
+        out[prod] = (math.ceil(poor), math.ceil(luxe))
+    return out
+
+
+def compute_forecast_order() -> List[Tuple[str, float]]:
+    """Сколько докупить, чтобы дожить до следующей поставки (по прогнозу)."""
+    inv_map = get_store().stock_map()
+    out: List[Tuple[str, float]] = []
+    for prod, (_, luxe) in suggest_thresholds().items():
+        need = math.ceil(max(0.0, luxe - inv_map.get(prod, 0.0)))
+        if need > 0:
+            out.append((prod, need))
+    out.sort(key=lambda x: -x[1])
+    return out
+
+
+async def apply_forecast_thresholds() -> int:
+    """Записывает пороги из прогноза в settings. Возвращает число обновлённых позиций."""
+    sugg = suggest_thresholds()
+    s = get_thresholds().copy()
+    n = 0
+    for prod, (poor, luxe) in sugg.items():
+        if prod in s["product"].values:
+            idx = s.index[s["product"] == prod][0]
+            if (s.at[idx, "poor_threshold"], s.at[idx, "luxe_threshold"]) == (poor, luxe):
+                continue
+            # нули тоже пишем: товар перестали брать — старые пороги не должны его заказывать
+            s.at[idx, "poor_threshold"] = poor
+            s.at[idx, "luxe_threshold"] = luxe
+        elif poor <= 0 and luxe <= 0:
+            continue
+        else:
+            s = pd.concat(
+                [s, pd.DataFrame([{"product": prod, "poor_threshold": poor, "luxe_threshold": luxe}])],
+                ignore_index=True
+            )
+        n += 1
+    if n:
+        await save_df_map_async({SHEET_SETTINGS: s})
+    return n
+
+
+# ================== АНОМАЛИИ РАСХОДА ==================
+class RunningStat:
+    """Экспоненциально взвешенные среднее и дисперсия — O(1) памяти."""
+
+    __slots__ = ("n", "mean", "var")
+
+    def __init__(self) -> None:
+        self.n = 0
+        self.mean = 0.0
+        self.var = 0.0
+
+    def zscore(self, x: float) -> float:
+        std = math.sqrt(self.var)
+        if std == 0:
+            return math.inf if x > self.mean else 0.0
+        return (x - self.mean) / std
+
+    def push(self, x: float) -> None:
+        if self.n == 0:
+            self.mean = x
+        else:
+            d = x - self.mean
+            self.mean += ANOMALY_ALPHA * d
+            self.var = (1 - ANOMALY_ALPHA) * (self.var + ANOMALY_ALPHA * d * d)
+        self.n += 1
+
+
+class AnomalyDetector:
+    """Онлайн-проверка расхода: по продукту в целом и по паре продукт/бармен."""
+
+    def __init__(self) -> None:
+        self.by_product: Dict[str, RunningStat] = {}
+        self.by_user: Dict[Tuple[str, int], RunningStat] = {}
+
+    @staticmethod
+    def _outlier(st: RunningStat, qty: float) -> bool:
+        return (
+            st.n >= ANOMALY_MIN_SAMPLES
+            and st.mean > 0
+            and qty >= ANOMALY_RATIO * st.mean
+            and st.zscore(qty) >= ANOMALY_Z
+        )
+
+    def score(self, action: str, user_id: int, product: str, qty: float,
+              stock_after: Optional[float] = None) -> List[str]:
+        """Проверяет движение и учитывает его в статистике. Возвращает причины тревоги."""
+        reasons: List[str] = []
+        if action != "consume":
+            return reasons
+        # только в момент перехода через ноль: дальше, пока остаток в минусе, каждый
+        # расход тоже «в минусе», и без этого админам летело бы по сообщению на тап
+        if stock_after is not None and stock_after < 0 <= stock_after + qty:
+            reasons.append(f"остаток ушёл в минус ({stock_after:.2f})")
+        ust = self.by_user.setdefault((product, int(user_id)), RunningStat())
+        pst = self.by_product.setdefault(product, RunningStat())
+        if self._outlier(ust, qty):
+            reasons.append(f"в {qty / ust.mean:.1f} раза больше обычного для этого бармена (~{ust.mean:.1f})")
+        elif self._outlier(pst, qty):
+            reasons.append(f"в {qty / pst.mean:.1f} раза больше обычного по продукту (~{pst.mean:.1f})")
+        ust.push(qty)
+        pst.push(qty)
+        return reasons
+
+
+ANOMALIES: Optional[AnomalyDetector] = None
+ANOMALY_LOG: List[str] = []  # последние срабатывания (для /anomalies)
+
+
+def format_anomaly(ts: str, user_id: int, product: str, qty: float, reasons: List[str]) -> str:
+    return f"⚠️ {ts} · {product} — {fmt_qty(product, to_base(product, qty))} (бармен id {user_id}): " + "; ".join(reasons)
+
+
+def scan_anomalies(mov: DataFrame, det: AnomalyDetector, stock: Dict[str, float]) -> List[str]:
+    """Прогоняет движения через детектор; det и бегущие остатки stock дополняются на месте."""
+    found: List[str] = []
+    for r in mov.itertuples(index=False):
+        prod = str(r.product)
+        qty = float(r.qty) if pd.notna(r.qty) else 0.0
+        uid = int(r.user_id) if pd.notna(r.user_id) else 0
+        after = apply_movement(stock.get(prod, 0.0), r.action, qty)
+        stock[prod] = after
+        if r.ref:
+            continue  # отмены не оцениваем
+        reasons = det.score(r.action, uid, prod, qty, after)
+        if reasons:
+            found.append(format_anomaly(str(r.ts), uid, prod, qty, reasons))
+    return found
+
+
+def backfill_anomalies() -> List[str]:
+    """Прогоняет весь лог movements через свежий детектор и делает его текущим."""
+    global ANOMALIES
+    ensure_excel()
+    det = AnomalyDetector()
+    found = scan_anomalies(get_store().movements_frame(), det, {})
+    ANOMALIES = det
+    ANOMALY_LOG[:] = found[-50:]
+    return found
+
+
+async def backfill_anomalies_async() -> List[str]:
+    """То же для /anomalies all: проход по копии хранилища в потоке, в цикле — только хвост,
+    дописанный за время прохода, и подмена детектора."""
+    global ANOMALIES
+    ensure_excel()
+    frozen = get_store().frozen()
+    det, stock = AnomalyDetector(), {}
+    found = await asyncio.to_thread(lambda: scan_anomalies(frozen.movements_frame(), det, stock))
+    found += scan_anomalies(get_store().movements_frame(after_seq=frozen.last_seq), det, stock)
+    ANOMALIES = det
+    ANOMALY_LOG[:] = found[-50:]
+    return found
+
+
+def anomaly_observe(ts: str, action: str, user_id: int, product: str, qty: float,
+                    stock_after: Optional[float]) -> List[str]:
+    """Проверка нового движения детектором."""
+    if ANOMALIES is None:
+        return []
+    reasons = ANOMALIES.score(action, user_id, product, qty, stock_after)
+    if not reasons:
+        return []
+    alert = format_anomaly(ts, user_id, product, qty, reasons)
+    ANOMALY_LOG.append(alert)
+    del ANOMALY_LOG[:-50]
+    return [alert]
+
+
+async def notify_anomalies(bot, alerts: List[str]) -> None:
+    for alert in alerts:
+        log.warning("Аномалия: %s", alert)
+        await notify_admins(bot, alert, tag="anomaly", wait=False)
+
+
+# ================== СРЕЗЫ СТАТИСТИКИ ==================
+# Расход предагрегирован по дням: на каждый день — суммы по товару, бармену
+# и часу. Срез за любой период — сумма по дням диапазона, без прохода по
+# журналу; категории и дни недели выводятся из товара и даты.
+STATS_DIMENSIONS = {
+    "product": "товарам",
+    "category": "категориям",
+    "bartender": "барменам",
+    "hour": "часам",
+    "weekday": "дням недели",
+}
+WEEKDAYS = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+
+
+class StatsCube:
+    """Дневные суммы расхода в базовых единицах: ordinal дня -> (по товару, по (user_id, ед.), по (часу, ед.)).
+
+    Бармены и часы смешивают товары, а мл и шт складывать нельзя — там сумма на каждую базовую единицу.
+    """
+
+    __slots__ = ("days",)
+
+    def __init__(self) -> None:
+        self.days: Dict[int, Tuple[Dict[str, float], Dict[Tuple[int, str], float], Dict[Tuple[int, str], float]]] = {}
+
+    def _cell(self, ordinal: int) -> Tuple[Dict[str, float], Dict[Tuple[int, str], float], Dict[Tuple[int, str], float]]:
+        cell = self.days.get(ordinal)
+        if cell is None:
+            cell = self.days[ordinal] = ({}, {}, {})
+        return cell
+
+    def add(self, when: dt.datetime, user_id: int, product: str, base: float) -> None:
+        by_product, by_user, by_hour = self._cell(when.toordinal())
+        unit = units_of(product).base
+        by_product[product] = by_product.get(product, 0.0) + base
+        by_user[(user_id, unit)] = by_user.get((user_id, unit), 0.0) + base
+        by_hour[(when.hour, unit)] = by_hour.get((when.hour, unit), 0.0) + base
+
+    def query(self, start: dt.date, end: dt.date, by: str) -> Dict:
+        """Суммы за start <= день < end в разрезе by (ключи STATS_DIMENSIONS): ключ -> {ед.: сумма}."""
+        out: Dict = {}
+
+        def put(key, unit: str, base: float) -> None:
+            sums = out.setdefault(key, {})
+            sums[unit] = sums.get(unit, 0.0) + base
+
+        if not self.days:
+            return out
+        lo = max(start.toordinal(), min(self.days))
+        hi = min(end.toordinal(), max(self.days) + 1)
+        for ordinal in range(lo, hi):
+            cell = self.days.get(ordinal)
+            if cell is None:
+                continue
+            if by == "weekday":
+                wd = dt.date.fromordinal(ordinal).weekday()
+                for (_, unit), base in cell[2].items():
+                    put(wd, unit, base)
+            elif by in ("product", "category"):
+                for prod, base in cell[0].items():
+                    put(prod if by == "product" else PRODUCT_CATEGORY.get(prod, ""), units_of(prod).base, base)
+            else:
+                for (key, unit), base in cell[1 if by == "bartender" else 2].items():
+                    put(key, unit, base)
+        return out
+
+
+CUBE: Optional[StatsCube] = None
+
+
+def get_cube() -> StatsCube:
+    """Кубы расхода; при первом обращении строятся по истории одним groupby на разрез."""
+    global CUBE
+    if CUBE is not None:
+        return CUBE
+    ensure_excel()
+    mov = _at_origin(read_movements(["ts", "user_id", "product", "qty_base", "seq", "ref"], actions=["consume"]))
+    cube = StatsCube()
+    if not mov.empty:
+        ts = pd.to_datetime(mov["ts"], errors="coerce")
+        mov = mov.loc[ts.notna()]
+        ts = ts.loc[ts.notna()]
+        day = ts.values.astype("datetime64[D]").astype(np.int64) + _EPOCH.toordinal()
+        prod = mov["product"].astype(str)
+        unit = prod.map(lambda p: units_of(p).base).values
+        for (ordinal, key), base in mov["qty_base"].groupby([day, prod.values]).sum().items():
+            cube._cell(int(ordinal))[0][str(key)] = float(base)
+        for idx, col in ((1, mov["user_id"]), (2, ts.dt.hour)):
+            for (ordinal, key, u), base in mov["qty_base"].groupby([day, col.values, unit]).sum().items():
+                cube._cell(int(ordinal))[idx][(int(key), str(u))] = float(base)
+    CUBE = cube
+    return CUBE
+
+
+def stats_observe(action: str, when: dt.datetime, user_id: int, product: str, base: int) -> None:
+    """Инкрементное обновление кубов новым движением (только расход, в базовых единицах)."""
+    if CUBE is None or action != "consume":
+        return
+    CUBE.add(when, user_id, product, base)
+
+
+def stats_period(key: str, today: Optional[dt.date] = None) -> Tuple[dt.date, dt.date]:
+    """Пресет периода -> (первый день, день после последнего)."""
+    today = today or venue_today()
+    tomorrow = today + dt.timedelta(days=1)
+    if key == "month":
+        return today.replace(day=1), tomorrow
+    if key == "prevmonth":
+        end = today.replace(day=1)
+        return (end - dt.timedelta(days=1)).replace(day=1), end
+    days = 1 if key == "today" else int(key)
+    return today - dt.timedelta(days=days - 1), tomorrow
+
+
+def parse_stats_range(text: str) -> Optional[Tuple[dt.date, dt.date]]:
+    """«ДД.ММ.ГГГГ» или «ДД.ММ.ГГГГ-ДД.ММ.ГГГГ» (включительно) -> (начало, день после конца)."""
+    dates = re.findall(r"(\d{2})\.(\d{2})\.(\d{4})", text)
+    if len(dates) not in (1, 2):
+        return None
+    try:
+        parsed = [dt.date(int(y), int(m), int(d)) for d, m, y in dates]
+    except ValueError:
+        return None
+    start, last = min(parsed), max(parsed)
+    return start, last + dt.timedelta(days=1)
+
+
+def _stats_label(by: str, key) -> str:
+    if by == "category":
+        return CATEGORIES[key]["title"] if key in CATEGORIES else "Без категории"
+    if by == "bartender":
+        return f"бармен id {key}"
+    if by == "hour":
+        return f"{key:02d}:00–{(key + 1) % 24:02d}:00"
+    if by == "weekday":
+        return WEEKDAYS[key]
+    return str(key)
+
+
+def fmt_base(unit: str, amount: float, signed: bool = False) -> str:
+    """Сумма в базовой единице для людей: мл крупнее литра — в литрах."""
+    sign = "+" if signed else ""
+    if unit == "мл" and abs(amount) >= 1000:
+        return f"{amount / 1000:{sign}.2f} л"
+    return f"{amount:{sign}.0f} {unit}" if unit == "мл" else f"{amount:{sign}g} {unit}"
+
+
+def fmt_sums(sums: Dict[str, float]) -> str:
+    """{ед.: сумма} разных товаров: «12.30 л + 40 шт» — мл со штуками не складываем."""
+    return " + ".join(fmt_base(u, v) for u, v in sorted(sums.items()) if abs(v) > 1e-9) or "0"
+
+
+def _delta(cur: float, prev: float, unit: str) -> str:
+    if prev == 0:
+        return "новое" if cur else "—"
+    return f"{fmt_base(unit, cur - prev, signed=True)}, {(cur - prev) / prev * 100:+.0f}%"
+
+
+def _delta_sums(cur: Dict[str, float], prev: Dict[str, float]) -> str:
+    units = sorted(u for u in set(cur) | set(prev) if abs(cur.get(u, 0.0)) > 1e-9 or abs(prev.get(u, 0.0)) > 1e-9)
+    if len(units) == 1:
+        return _delta(cur.get(units[0], 0.0), prev.get(units[0], 0.0), units[0])
+    if not any(abs(prev.get(u, 0.0)) > 1e-9 for u in units):
+        return "новое"
+    return "; ".join(f"{u}: {_delta(cur.get(u, 0.0), prev.get(u, 0.0), u)}" for u in units)
+
+
+def stats_breakdown(start: dt.date, end: dt.date, by: str) -> Tuple[str, List[str]]:
+    """Срез расхода за период и сравнение с предыдущим периодом той же длины.
+
+    Возвращает (заголовок, строки отчёта). Товар — в его упаковках, прочие
+    разрезы и итог — в базовых единицах, отдельно мл и шт.
+    """
+    cube = get_cube()
+    span = end - start
+    prev_start = start - span
+    cur = cube.query(start, end, by)
+    prev = cube.query(prev_start, start, by)
+    last = end - dt.timedelta(days=1)
+    title = (f"Расход по {STATS_DIMENSIONS[by]} за {start:%d.%m.%Y}–{last:%d.%m.%Y}\n"
+             f"(в скобках — к {prev_start:%d.%m}–{start - dt.timedelta(days=1):%d.%m}):")
+    # позиции, расход которых целиком отменён в обоих периодах, не показываем
+    keys = {k for k in set(cur) | set(prev)
+            if any(abs(v) > 1e-9 for v in (*cur.get(k, {}).values(), *prev.get(k, {}).values()))}
+    if not keys:
+        return title, ["За выбранный период расхода нет."]
+    if by in ("hour", "weekday"):
+        order = sorted(keys)
+    elif by == "product":
+        order = sorted(keys, key=lambda k: (-sum(cur.get(k, {}).values()) / units_of(k).pack_size, str(k)))
+    else:
+        order = sorted(keys, key=lambda k: (-cur.get(k, {}).get("мл", 0.0), -cur.get(k, {}).get("шт", 0.0), str(k)))
+    lines = []
+    for k in order:
+        c, p = cur.get(k, {}), prev.get(k, {})
+        value = fmt_qty(k, int(round(sum(c.values())))) if by == "product" else fmt_sums(c)
+        lines.append(f"• {_stats_label(by, k)}: {value} ({_delta_sums(c, p)})")
+    total: Dict[str, float] = {}
+    total_prev: Dict[str, float] = {}
+    for src, dst in ((cur, total), (prev, total_prev)):
+        for sums in src.values():
+            for u, v in sums.items():
+                dst[u] = dst.get(u, 0.0) + v
+    lines.append(f"\nИтого: {fmt_sums(total)} ({_delta_sums(total, total_prev)})")
+    return title, lines
+
+
+# ================== КЭШ ВЫГРУЗОК ==================
+# Telegram хранит загруженные файлы и отдаёт file_id, который можно
+# переотправлять без повторной загрузки. Запоминаем file_id по ключу выгрузки
+# вместе с версией данных: пока версия не изменилась — шлём file_id.
+def get_cached_file_id(key: str, etag: str) -> Optional[str]:
+    entry = load_state().get("export_cache", {}).get(key)
+    if entry and entry.get("etag") == etag:
+        return entry.get("file_id")
+    return None
+
+
+def remember_file_id(key: str, etag: str, file_id: str) -> None:
+    state = load_state()
+    state.setdefault("export_cache", {})[key] = {"etag": etag, "file_id": file_id}
+    save_state(state)
+
+
+def forget_file_id(key: str) -> None:
+    state = load_state()
+    if state.get("export_cache", {}).pop(key, None) is not None:
+        save_state(state)
+
+
+async def send_cached_document(message, key: str, etag: str, open_file, filename: str, caption: str):
+    """Отправляет документ: по file_id, если версия не менялась, иначе — загрузкой.
+
+    open_file — функция без аргументов, возвращающая бинарный файл (или bytes)
+    для загрузки; вызывается только при промахе кэша. Подходит для любых
+    генерируемых отчётов/графиков: достаточно своего key и etag.
+    """
+    file_id = get_cached_file_id(key, etag)
+    if file_id:
+        try:
+            return await message.reply_document(document=file_id, caption=caption)
+        except BadRequest as e:
+            # file_id протух (например, сменился токен бота) — загрузим заново
+            log.warning("Кэшированный file_id для %s не принят: %s", key, e)
+            forget_file_id(key)
+
+    src = open_file()
+    try:
+        sent = await message.reply_document(document=InputFile(src, filename=filename), caption=caption)
+    finally:
+        if hasattr(src, "close"):
+            src.close()
+    if sent is not None and sent.document is not None:
+        remember_file_id(key, etag, sent.document.file_id)
+    return sent
+
+
 # ================== ХЕНДЛЕРЫ ==================
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data.clear()
@@ -511,12 +2829,72 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return ROLE
 
 
-async def ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("понг")
+async def ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("понг")
+
+
+async def anomalies_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/anomalies — последние срабатывания; /anomalies all — пересчитать по всему логу."""
+    if update.effective_user.id not in ACTIVE_ADMINS:
+        await update.message.reply_text("Команда доступна администраторам.")
+        return
+    if context.args and context.args[0] == "all":
+        found = await backfill_anomalies_async()
+        lines = found[-30:]
+        head = f"Проверил весь лог: найдено {len(found)} подозрительных записей."
+    else:
+        if ANOMALIES is None:
+            backfill_anomalies()
+        lines = ANOMALY_LOG[-30:]
+        head = "Последние подозрительные записи:"
+    if not lines:
+        await update.message.reply_text("Подозрительных записей нет.")
+        return
+    await send_report(update.message, head + "\n" + "\n".join(lines))
+
+
+ACTION_TITLES = {"consume": "расход", "receive": "приём", "count": "пересчёт"}
+
+
+def format_undone(done: List[Tuple[str, str, int]]) -> str:
+    return "; ".join(f"{ACTION_TITLES.get(a, a)} {p} — {fmt_qty(p, q)}" for a, p, q in done)
+
+
+async def undo_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/undo [N] — отменить свои последние N записей (по умолчанию одну)."""
+    try:
+        n = int(context.args[0]) if context.args else 1
+    except ValueError:
+        await update.message.reply_text("Формат: /undo или /undo 3")
+        return
+    n = max(1, min(n, UNDO_MAX))
+    done = undo_last(update.effective_user.id, n)
+    if not done:
+        await update.message.reply_text("Отменять нечего — за сутки ваших записей нет.")
+        return
+    await update.message.reply_text(f"Отменил записей: {len(done)}\n" + "\n".join(
+        f"• {format_undone([d])}" for d in done))
 
 
 # ====== ЕДИНЫЙ КЛИК-ОБРАБОТЧИК ======
+# префиксы, после которых в callback_data идёт название товара — в метрики не тащим
+_ITEM_PREFIXES = {"bchoose", "setupchoose", "recvchoose", "expchoose", "countchoose", "rpage", "nav"}
+
+
+def callback_route(data: str) -> str:
+    """Маршрут для метрик: 'stats:30', 'dodep:poor', 'cat:bitem', 'bchoose'..."""
+    parts = data.split(":")
+    if parts[0] in _ITEM_PREFIXES:
+        return parts[0]
+    return ":".join(parts[:2])
+
+
 async def cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    with timer("handler_seconds", route=callback_route(update.callback_query.data or "")):
+        return await _cb_route(update, context)
+
+
+async def _cb_route(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     q = update.callback_query
     await q.answer()
     data = q.data or ""
@@ -527,6 +2905,24 @@ async def cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         await q.edit_message_text("Выбери роль:", reply_markup=main_menu_kb())
         return ROLE
 
+    # Счётчик страниц — просто кнопка-подпись
+    if data == "noop":
+        return None
+
+    # Кнопка товара: номер в каталоге -> название, дальше маршруты работают с названием
+    prefix, _, ref = data.partition(":")
+    if prefix in _PRODUCT_PREFIXES:
+        product = product_by_ref(ref)
+        if product is None:  # кнопка из старого сообщения, а добавленного в сессии товара уже нет
+            await q.edit_message_text("Список товаров изменился — выбери заново.", reply_markup=main_menu_kb())
+            return ROLE
+        data = f"{prefix}:{product}"
+
+    # Листание отчёта
+    if data.startswith("rpage:"):
+        _, rid, page = data.split(":")
+        return await flip_report(q, rid, int(page))
+
     # Назад
     if data == "back":
         # Пытаемся понять, где мы были, по "ui_state"
@@ -535,18 +2931,34 @@ async def cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             await q.edit_message_text("Выбери категорию:", reply_markup=categories_kb("bitem"))
             context.user_data["ui_state"] = "barmen_categories"
             return B_CAT
-        if ui in {"admin_menu", "admin_stats", "admin_dodep", "admin_receive"}:
+        if ui in {"stats_report", "stats_slice_period"}:
+            await q.edit_message_text("Выбери период:", reply_markup=stats_menu_kb())
+            context.user_data["ui_state"] = "admin_stats"
+            return A_STATS_MENU
+        if ui in {"stats_slice_by", "stats_slice_range"}:
+            await q.edit_message_text("Срез расхода — за какой период?", reply_markup=slice_period_kb())
+            context.user_data["ui_state"] = "stats_slice_period"
+            return A_STATS_MENU
+        if ui == "stats_slice_report":
+            await q.edit_message_text("В каком разрезе показать?", reply_markup=slice_by_kb())
+            context.user_data["ui_state"] = "stats_slice_by"
+            return A_STATS_MENU
+        if ui in {"admin_menu", "admin_stats", "admin_dodep", "admin_receive", "admin_count"}:
             await q.edit_message_text("Здравствуйте, начальник! Что делаем?", reply_markup=admin_menu_kb())
             context.user_data["ui_state"] = "admin_menu"
             return A_MENU
-        if ui == "dodep_setup_pick_mode" or ui == "dodep_setup_pick_cat" or ui == "dodep_setup_pick_item" or ui == "dodep_setup_qty":
+        if ui == "dodep_setup_pick_mode" or ui == "dodep_setup_pick_cat" or ui == "dodep_setup_pick_item" or ui == "dodep_setup_qty" or ui == "dodep_report":
             await q.edit_message_text("Додеп:", reply_markup=dodep_menu_kb())
             context.user_data["ui_state"] = "admin_dodep"
             return A_DODEP_MENU
-        if ui == "receive_menu" or ui == "receive_pick_item" or ui == "receive_qty" or ui == "receive_new_name" or ui == "receive_new_qty" or ui == "expiry_pick_item" or ui == "expiry_enter_date":
+        if ui == "receive_menu" or ui == "receive_pick_item" or ui == "receive_qty" or ui == "receive_new_name" or ui == "receive_new_qty" or ui == "expiry_pick_item" or ui == "expiry_enter_date" or ui == "receive_report" or ui == "receive_import":
             await q.edit_message_text("Меню приёма товара:", reply_markup=receive_menu_kb())
             context.user_data["ui_state"] = "receive_menu"
             return A_RECEIVE_MENU
+        if ui == "count_pick_item" or ui == "count_qty" or ui == "count_report" or ui == "count_import":
+            await q.edit_message_text("Инвентаризация:", reply_markup=count_menu_kb())
+            context.user_data["ui_state"] = "admin_count"
+            return A_COUNT_MENU
 
         # по умолчанию в главное
         await q.edit_message_text("Выбери роль:", reply_markup=main_menu_kb())
@@ -559,12 +2971,12 @@ async def cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             context.user_data["ui_state"] = "barmen_categories"
             await q.edit_message_text(
                 "Ну как прошла смена? Выбери категорию и затем напиток. "
-                "После этого введи количество потраченных бутылок:",
+                "После этого введи, сколько потрачено (бутылками, порциями или мл):",
                 reply_markup=categories_kb("bitem")
             )
             return B_CAT
         if role == "admin":
-            ACTIVE_ADMINS.add(q.from_user.id)
+            remember_admin(q.from_user.id)
             context.user_data["ui_state"] = "admin_menu"
             await q.edit_message_text("Здравствуйте, начальник! Что делаем?", reply_markup=admin_menu_kb())
             return A_MENU
@@ -597,7 +3009,7 @@ async def cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         context.user_data["b_product"] = product
         context.user_data["ui_state"] = "barmen_qty"
         await q.edit_message_text(
-            f"Вы выбрали: <b>{product}</b>\n\nВведи <b>количество потраченных бутылок</b> числом (например, 5).",
+            f"Вы выбрали: <b>{product}</b>\n\nВведи, <b>сколько потрачено</b>.\n{qty_hint(product)}",
             parse_mode="HTML",
             reply_markup=InlineKeyboardMarkup([
                 [InlineKeyboardButton("⬅️ Назад", callback_data="back"), InlineKeyboardButton("🏠 В начало", callback_data="home")]
@@ -610,6 +3022,12 @@ async def cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         await q.edit_message_text("Добавь ещё! Выбери категорию:", reply_markup=categories_kb("bitem"))
         return B_CAT
 
+    if data == "b:undo":
+        done = undo_last(q.from_user.id, 1)
+        text = f"Отменил: {format_undone(done)}" if done else "Отменять нечего — за сутки ваших записей нет."
+        await q.edit_message_text(text + "\n\nЧто дальше?", reply_markup=confirm_more_kb())
+        return B_CONFIRM
+
     if data == "b:done":
         await q.edit_message_text("Класс, спасибо! Доброй ночи! 🌙")
         await q.message.reply_text("Выбери роль:", reply_markup=main_menu_kb())
@@ -618,12 +3036,16 @@ async def cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # ====== АДМИН: МЕНЮ ======
     if data == "admin:share":
         ensure_excel()
+        await flush_store_async()  # в выгрузку — всё, что ещё лежит в журнале
         try:
-            with open(DATA_FILE, "rb") as f:
-                await q.message.reply_document(
-                    document=InputFile(f, filename="data.xlsx"),
-                    caption="Текущая таблица учёта (Excel)."
-                )
+            await send_cached_document(
+                q.message,
+                key="share:data.xlsx",
+                etag=store_etag(),
+                open_file=lambda: open(DATA_FILE, "rb"),
+                filename="data.xlsx",
+                caption="Текущая таблица учёта (Excel)."
+            )
         except Exception as e:
             await q.message.reply_text(f"Не удалось отправить файл: {e}")
         return A_MENU
@@ -636,9 +3058,39 @@ async def cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if data.startswith("stats:"):
         days = int(data.split(":")[1])
         txt = compute_stats(days)
-        await q.message.reply_text(f"Статистика расхода за {days} дн.:\n\n{txt}")
+        context.user_data["ui_state"] = "stats_report"
+        return await show_report(q, f"Статистика расхода за {days} дн.:", txt.split("\n"), A_STATS_MENU)
+
+    if data == "slice:menu":
+        context.user_data["ui_state"] = "stats_slice_period"
+        await q.edit_message_text("Срез расхода — за какой период?", reply_markup=slice_period_kb())
+        return A_STATS_MENU
+
+    if data.startswith("slice:period:"):
+        start, end = stats_period(data.split(":")[2])
+        context.user_data["slice_range"] = (start.isoformat(), end.isoformat())
+        context.user_data["ui_state"] = "stats_slice_by"
+        await q.edit_message_text("В каком разрезе показать?", reply_markup=slice_by_kb())
         return A_STATS_MENU
 
+    if data == "slice:custom":
+        context.user_data["ui_state"] = "stats_slice_range"
+        await q.edit_message_text(
+            "Введи период: ДД.ММ.ГГГГ-ДД.ММ.ГГГГ (обе даты включительно) или одну дату.\n"
+            "Например: 01.10.2025-15.10.2025",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back"),
+                                                InlineKeyboardButton("🏠 В начало", callback_data="home")]])
+        )
+        return A_STATS_RANGE
+
+    if data.startswith("slice:by:"):
+        by = data.split(":")[2]
+        rng = context.user_data.get("slice_range")
+        start, end = (dt.date.fromisoformat(x) for x in rng) if rng else stats_period("7")
+        title, lines = stats_breakdown(start, end, by)
+        context.user_data["ui_state"] = "stats_slice_report"
+        return await show_report(q, title, lines, A_STATS_MENU)
+
     if data == "admin:dodep":
         context.user_data["ui_state"] = "admin_dodep"
         await q.edit_message_text("Додеп:", reply_markup=dodep_menu_kb())
@@ -646,20 +3098,39 @@ async def cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     if data == "dodep:poor":
         order = compute_order("poor")
+        context.user_data["ui_state"] = "dodep_report"
         if not order:
-            await q.message.reply_text("По нищему закупу — ничего не требуется докупать.")
-        else:
-            lines = [f"• {p} — {q:.0f}" for p, q in order]
-            await q.message.reply_text("Нищий закуп (докупить):\n" + "\n".join(lines))
-        return A_DODEP_MENU
+            return await show_report(q, "По нищему закупу — ничего не требуется докупать.", [], A_DODEP_MENU)
+        lines = [f"• {p} — {fmt_qty(p, to_base(p, q))}" for p, q in order]
+        return await show_report(q, "Нищий закуп (докупить):", lines, A_DODEP_MENU)
 
     if data == "dodep:luxe":
         order = compute_order("luxe")
+        context.user_data["ui_state"] = "dodep_report"
         if not order:
-            await q.message.reply_text("По люксовому закупу — ничего не требуется докупать.")
-        else:
-            lines = [f"• {p} — {q:.0f}" for p, q in order]
-            await q.message.reply_text("Люксовый закуп (докупить):\n" + "\n".join(lines))
+            return await show_report(q, "По люксовому закупу — ничего не требуется докупать.", [], A_DODEP_MENU)
+        lines = [f"• {p} — {fmt_qty(p, to_base(p, q))}" for p, q in order]
+        return await show_report(q, "Люксовый закуп (докупить):", lines, A_DODEP_MENU)
+
+    if data == "dodep:forecast":
+        context.user_data["last_order_mode"] = "forecast"
+        order = compute_forecast_order()
+        context.user_data["ui_state"] = "dodep_report"
+        if not order:
+            return await show_report(
+                q, "По прогнозу расхода докупать ничего не нужно (или пока мало истории).", [], A_DODEP_MENU
+            )
+        lines = [f"• {p} — {fmt_qty(p, to_base(p, q))}" for p, q in order]
+        title = f"Закуп по прогнозу (поставка {SUPPLIER_LEAD_DAYS} дн. + {ORDER_CYCLE_DAYS} дн. до следующего):"
+        return await show_report(q, title, lines, A_DODEP_MENU)
+
+    if data == "dodep:autotune":
+        n = await apply_forecast_thresholds()
+        await q.message.reply_text(
+            f"Пороги обновлены по прогнозу для {n} позиций." if n
+            else "Пороги уже совпадают с прогнозом." if get_forecasts()
+            else "Пока мало истории расхода для прогноза."
+        )
         return A_DODEP_MENU
 
     if data == "dodep:setup":
@@ -725,7 +3196,7 @@ async def cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if data == "recv:auto":
         # Принимаем по последнему расчёту — используем poor как пример (можно хранить последний выбор)
         mode = context.user_data.get("last_order_mode", "poor")
-        order = compute_order(mode)
+        order = compute_forecast_order() if mode == "forecast" else compute_order(mode)
         if not order:
             await q.message.reply_text("Нет актуальной заявки (по выбранному порогу закуп не требуется).")
             return A_RECEIVE_MENU
@@ -733,8 +3204,10 @@ async def cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         for prod, qty in order:
             if qty > 0:
                 add_movement("admin", "receive", q.from_user.id, prod, qty)
-        await q.message.reply_text("Заявка принята в учёт. Не забудьте ввести сроки годности при необходимости.")
-        return A_RECEIVE_MENU
+        context.user_data["ui_state"] = "receive_report"
+        lines = [f"• {p} — {fmt_qty(p, to_base(p, qty))}" for p, qty in order if qty > 0]
+        lines.append("\nНе забудьте ввести сроки годности при необходимости.")
+        return await show_report(q, "Заявка принята в учёт:", lines, A_RECEIVE_MENU)
 
     if data == "recv:manual":
         # меню категорий -> товары -> ввод количества -> +в остаток
@@ -768,7 +3241,7 @@ async def cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         context.user_data["recv_product"] = prod
         context.user_data["ui_state"] = "receive_qty"
         await q.edit_message_text(
-            f"Вы выбрали приём: <b>{prod}</b>\n\nВведите <b>количество поступивших бутылок</b> числом:",
+            f"Вы выбрали приём: <b>{prod}</b>\n\nВведите, <b>сколько поступило</b>.\n{qty_hint(prod)}",
             parse_mode="HTML",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back"),
                                                 InlineKeyboardButton("🏠 В начало", callback_data="home")]])
@@ -784,6 +3257,39 @@ async def cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         )
         return A_RECEIVE_NEW_NAME
 
+    if data in ("recv:import", "count:import"):
+        kind = "receive" if data == "recv:import" else "count"
+        context.user_data["import_kind"] = kind
+        context.user_data["ui_state"] = f"{kind}_import"
+        await q.edit_message_text(
+            import_hint(kind),
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back"),
+                                                InlineKeyboardButton("🏠 В начало", callback_data="home")]])
+        )
+        return A_IMPORT_UPLOAD
+
+    if data in ("import:ok", "import:cancel"):
+        plan = context.user_data.pop("import_plan", None)
+        kind = context.user_data.get("import_kind", "receive")
+        menu_text, menu_kb, menu_state, menu_ui = (
+            ("Меню приёма товара:", receive_menu_kb(), A_RECEIVE_MENU, "receive_menu") if kind == "receive"
+            else ("Инвентаризация:", count_menu_kb(), A_COUNT_MENU, "admin_count")
+        )
+        context.user_data["ui_state"] = menu_ui
+        if data == "import:cancel" or plan is None:
+            text = "Импорт отменён." if data == "import:cancel" else "Превью устарело — пришли файл ещё раз."
+            await q.edit_message_text(f"{text}\n\n{menu_text}", reply_markup=menu_kb)
+            return menu_state
+        with timer("storage_seconds", op="import"):
+            alerts, dfs = apply_import(plan, q.from_user.id)
+            await save_df_map_async(dfs)  # одна запись data.xlsx на весь файл
+        inc("imports_total", kind=plan.kind)
+        await notify_anomalies(context.bot, alerts)
+        done = (f"Приём проведён: позиций {len(plan.qty)}, партий со сроком {len(plan.lots)}."
+                if plan.kind == "receive" else f"Пересчёт проведён: позиций {len(plan.qty)}.")
+        await q.edit_message_text(f"{done}\n\n{menu_text}", reply_markup=menu_kb)
+        return menu_state
+
     if data == "recv:expiry":
         # меню всех продуктов -> выбор -> ввод даты
         context.user_data["ui_state"] = "expiry_pick_item"
@@ -810,32 +3316,99 @@ async def cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         )
         return A_EXPIRY_ENTER_DATE
 
-    return ConversationHandler.END
+    # ====== АДМИН: ИНВЕНТАРИЗАЦИЯ ======
+    if data == "admin:count":
+        context.user_data["ui_state"] = "admin_count"
+        await q.edit_message_text("Инвентаризация:", reply_markup=count_menu_kb())
+        return A_COUNT_MENU
 
+    if data == "count:enter":
+        context.user_data["ui_state"] = "count_pick_item"
+        await q.edit_message_text("Выберите категорию для пересчёта:", reply_markup=categories_kb("countitem"))
+        return A_COUNT_PICK_ITEM
 
-# ====== ВВОД КОЛИЧЕСТВА БАРМЕН ======
-async def barmen_qty(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    text = (update.message.text or "").strip().replace(",", ".")
-    if not re.fullmatch(r"\d+(\.\d+)?", text):
-        await update.message.reply_text(
-            "Введите количество ЧИСЛОМ. Например: 5",
+    if data.startswith("cat:countitem:") or data.startswith("catnav:countchoose:"):
+        _, _, cat_key, page = data.split(":")
+        page = int(page)
+        context.user_data["ui_state"] = "count_pick_item"
+        await q.edit_message_text(
+            f"Категория: {CATEGORIES[cat_key]['title']}\nВыберите продукт:",
+            reply_markup=items_in_category_kb(cat_key, "countchoose", page)
+        )
+        return A_COUNT_PICK_ITEM
+
+    if data.startswith("countchoose:"):
+        prod = data.split(":", 1)[1]
+        context.user_data["count_product"] = prod
+        context.user_data["ui_state"] = "count_qty"
+        await q.edit_message_text(
+            f"Пересчёт: <b>{prod}</b>\nПо учёту: {fmt_qty(prod, get_store().stock_base(prod))}\n\n"
+            f"Введите <b>фактическое количество</b> на складе.\n{qty_hint(prod)}",
+            parse_mode="HTML",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back"),
                                                 InlineKeyboardButton("🏠 В начало", callback_data="home")]])
         )
-        return B_QTY
-    qty = float(text)
+        return A_COUNT_QTY
+
+    if data == "count:report":
+        context.user_data["ui_state"] = "count_report"
+        return await show_report(
+            q, "Расхождения по последним пересчётам (30 дн.):", variance_report(30).split("\n"), A_COUNT_MENU
+        )
+
+    if data == "count:drift":
+        drift = inventory_drift()
+        context.user_data["ui_state"] = "count_report"
+        if not drift:
+            return await show_report(q, "Остатки совпадают с журналом движений.", [], A_COUNT_MENU)
+        lines = [f"• {p}: в таблице {fmt_qty(p, to_base(p, a))}, по журналу {fmt_qty(p, to_base(p, b))}"
+                 for p, a, b in drift]
+        return await show_report(q, "Остатки разошлись с журналом:", lines, A_COUNT_MENU)
+
+    if data == "count:rebuild":
+        n = await rebuild_inventory()
+        await q.message.reply_text(
+            f"Остатки пересобраны из журнала, исправлено позиций: {n}." if n else "Остатки уже совпадают с журналом."
+        )
+        return A_COUNT_MENU
+
+    return ConversationHandler.END
+
+
+# ====== ВВОД КОЛИЧЕСТВА БАРМЕН ======
+@timed("handler_seconds", route="barmen_qty")
+async def barmen_qty(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     prod = context.user_data.get("b_product")
     if not prod:
         await update.message.reply_text("Сначала выберите категорию и напиток.", reply_markup=categories_kb("bitem"))
         context.user_data["ui_state"] = "barmen_categories"
         return B_CAT
+    base = parse_quantity(update.message.text, prod)
+    if base is None:
+        await update.message.reply_text(
+            f"Не понял количество. {qty_hint(prod)}",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back"),
+                                                InlineKeyboardButton("🏠 В начало", callback_data="home")]])
+        )
+        return B_QTY
     # Пишем расход
-    add_movement("barman", "consume", update.effective_user.id, prod, qty)
-    await update.message.reply_text(f"Записал расход: {prod} — {qty:.0f}.", reply_markup=confirm_more_kb())
+    try:
+        alerts = add_movement("barman", "consume", update.effective_user.id, prod, 0, base=base)
+    except StockError as e:
+        await update.message.reply_text(
+            f"На складе по учёту только {fmt_qty(prod, to_base(prod, e.available))} «{prod}» — расход не записан. "
+            "Проверь количество или попроси админа сделать пересчёт.",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back"),
+                                                InlineKeyboardButton("🏠 В начало", callback_data="home")]])
+        )
+        return B_QTY
+    await notify_anomalies(context.bot, alerts)
+    await update.message.reply_text(f"Записал расход: {prod} — {fmt_qty(prod, base)}.", reply_markup=confirm_more_kb())
     return B_CONFIRM
 
 
 # ====== ВВОД ПОРОГА ЗАКУПА ======
+@timed("handler_seconds", route="dodep_set_qty")
 async def dodep_set_qty(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     text = (update.message.text or "").strip().replace(",", ".")
     if not re.fullmatch(r"\d+(\.\d+)?", text):
@@ -853,36 +3426,37 @@ async def dodep_set_qty(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         context.user_data["ui_state"] = "dodep_setup_pick_cat"
         return A_DODEP_SET_CAT
 
-    set_threshold(prod, mode, value)
-    await update.message.reply_text(f"Готово. Порог ({'Нищий' if mode=='poor' else 'Люксовый'}) для «{prod}» = {value:.0f}.")
+    await set_threshold(prod, mode, value)
+    await update.message.reply_text(f"Готово. Порог ({'Нищий' if mode=='poor' else 'Люксовый'}) для «{prod}» = {value:g}.")
     # запомним последний расчётный режим
     context.user_data["last_order_mode"] = mode
     return A_DODEP_MENU
 
 
 # ====== ПРИЁМ ТОВАРА (КОЛИЧЕСТВО) ======
+@timed("handler_seconds", route="receive_qty")
 async def receive_qty(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    text = (update.message.text or "").strip().replace(",", ".")
-    if not re.fullmatch(r"\d+(\.\d+)?", text):
-        await update.message.reply_text(
-            "Введите количество ЧИСЛОМ. Например: 8",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back"),
-                                                InlineKeyboardButton("🏠 В начало", callback_data="home")]])
-        )
-        return A_RECEIVE_QTY
-    qty = float(text)
     prod = context.user_data.get("recv_product")
     if not prod:
         await update.message.reply_text("Сначала выберите продукт из меню.", reply_markup=categories_kb("recvitem"))
         context.user_data["ui_state"] = "receive_pick_item"
         return A_RECEIVE_PICK_ITEM
+    base = parse_quantity(update.message.text, prod)
+    if base is None:
+        await update.message.reply_text(
+            f"Не понял количество. {qty_hint(prod)}",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back"),
+                                                InlineKeyboardButton("🏠 В начало", callback_data="home")]])
+        )
+        return A_RECEIVE_QTY
 
-    add_movement("admin", "receive", update.effective_user.id, prod, qty)
-    await update.message.reply_text(f"Принял на склад: {prod} — {qty:.0f}.")
+    add_movement("admin", "receive", update.effective_user.id, prod, 0, base=base)
+    await update.message.reply_text(f"Принял на склад: {prod} — {fmt_qty(prod, base)}.")
     return A_RECEIVE_MENU
 
 
 # ====== НОВЫЙ ПРОДУКТ (ИМЯ, ПОТОМ КОЛ-ВО) ======
+@timed("handler_seconds", route="receive_new_name")
 async def receive_new_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     name = (update.message.text or "").strip()
     if not name:
@@ -894,7 +3468,7 @@ async def receive_new_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         return A_RECEIVE_NEW_NAME
     context.user_data["new_product_name"] = name
     await update.message.reply_text(
-        f"Новый продукт: <b>{name}</b>\nВведите количество (числом):",
+        f"Новый продукт: <b>{name}</b>\nВведите количество.\n{qty_hint(name)}",
         parse_mode="HTML",
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back"),
                                             InlineKeyboardButton("🏠 В начало", callback_data="home")]])
@@ -902,26 +3476,111 @@ async def receive_new_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     return A_RECEIVE_NEW_QTY
 
 
+@timed("handler_seconds", route="receive_new_qty")
 async def receive_new_qty(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    text = (update.message.text or "").strip().replace(",", ".")
-    if not re.fullmatch(r"\d+(\.\d+)?", text):
+    prod = context.user_data.get("new_product_name")
+    base = parse_quantity(update.message.text, prod)
+    if base is None:
         await update.message.reply_text(
-            "Введите количество ЧИСЛОМ. Например: 6",
+            f"Не понял количество. {qty_hint(prod)}",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back"),
                                                 InlineKeyboardButton("🏠 В начало", callback_data="home")]])
         )
         return A_RECEIVE_NEW_QTY
-    qty = float(text)
-    prod = context.user_data.get("new_product_name")
-    add_movement("admin", "receive", update.effective_user.id, prod, qty)
+    add_movement("admin", "receive", update.effective_user.id, prod, 0, base=base)
     # добавим продукт в справочник ALL_PRODUCTS (в сессии не сохраняем навсегда, хранится в Excel)
     if prod not in ALL_PRODUCTS:
         ALL_PRODUCTS.append(prod)
-    await update.message.reply_text(f"Добавлен новый продукт: {prod} — {qty:.0f}.")
+    await update.message.reply_text(f"Добавлен новый продукт: {prod} — {fmt_qty(prod, base)}.")
     return A_RECEIVE_MENU
 
 
+# ====== ПЕРЕСЧЁТ (ФАКТИЧЕСКОЕ КОЛ-ВО) ======
+@timed("handler_seconds", route="count_qty")
+async def count_qty(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    prod = context.user_data.get("count_product")
+    if not prod:
+        await update.message.reply_text("Сначала выберите продукт.", reply_markup=categories_kb("countitem"))
+        context.user_data["ui_state"] = "count_pick_item"
+        return A_COUNT_PICK_ITEM
+    base = parse_quantity(update.message.text, prod)
+    if base is None:
+        await update.message.reply_text(
+            f"Не понял количество. {qty_hint(prod)}",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back"),
+                                                InlineKeyboardButton("🏠 В начало", callback_data="home")]])
+        )
+        return A_COUNT_QTY
+
+    expected, variance = await record_stocktake(update.effective_user.id, prod, 0, base=base)
+    diff = to_base(prod, variance)
+    await update.message.reply_text(
+        f"Пересчёт записан: {prod} — по учёту {fmt_qty(prod, to_base(prod, expected))}, "
+        f"по факту {fmt_qty(prod, base)} ({'+' if diff >= 0 else '-'}{fmt_qty(prod, abs(diff))}).",
+        reply_markup=count_menu_kb()
+    )
+    context.user_data["ui_state"] = "admin_count"
+    return A_COUNT_MENU
+
+
+# ====== ИМПОРТ ФАЙЛА ======
+@timed("handler_seconds", route="import_document")
+async def import_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    doc = update.message.document
+    kind = context.user_data.get("import_kind", "receive")
+    back_kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back"),
+                                     InlineKeyboardButton("🏠 В начало", callback_data="home")]])
+    if doc.file_size and doc.file_size > IMPORT_MAX_BYTES:
+        await update.message.reply_text("Файл слишком большой (до 20 МБ).", reply_markup=back_kb)
+        return A_IMPORT_UPLOAD
+    data = bytes(await (await doc.get_file()).download_as_bytearray())
+    try:
+        plan = await asyncio.to_thread(parse_import, data, doc.file_name or "", kind, name_index())
+    except ImportFileError as e:
+        await update.message.reply_text(f"Не получилось разобрать файл: {e}.", reply_markup=back_kb)
+        return A_IMPORT_UPLOAD
+    if not plan.qty:
+        await update.message.reply_text(import_preview(plan) + "\n\nПроводить нечего.", reply_markup=back_kb)
+        return A_IMPORT_UPLOAD
+    context.user_data["import_plan"] = plan
+    await update.message.reply_text(import_preview(plan), reply_markup=import_confirm_kb())
+    return A_IMPORT_CONFIRM
+
+
+@timed("handler_seconds", route="import_text")
+async def import_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Вместо файла прислали текст — напоминаем, что ждём."""
+    await update.message.reply_text(
+        import_hint(context.user_data.get("import_kind", "receive")),
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back"),
+                                            InlineKeyboardButton("🏠 В начало", callback_data="home")]])
+    )
+    return A_IMPORT_UPLOAD
+
+
+# ====== СВОЙ ПЕРИОД ДЛЯ СРЕЗОВ ======
+@timed("handler_seconds", route="stats_range")
+async def stats_range_enter(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    rng = parse_stats_range(update.message.text or "")
+    if rng is None:
+        await update.message.reply_text(
+            "Неверный формат. Нужен: ДД.ММ.ГГГГ-ДД.ММ.ГГГГ\nНапример: 01.10.2025-15.10.2025",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back"),
+                                                InlineKeyboardButton("🏠 В начало", callback_data="home")]])
+        )
+        return A_STATS_RANGE
+    start, end = rng
+    context.user_data["slice_range"] = (start.isoformat(), end.isoformat())
+    context.user_data["ui_state"] = "stats_slice_by"
+    await update.message.reply_text(
+        f"Период: {start:%d.%m.%Y}–{end - dt.timedelta(days=1):%d.%m.%Y}. В каком разрезе показать?",
+        reply_markup=slice_by_kb()
+    )
+    return A_STATS_MENU
+
+
 # ====== СРОКИ ГОДНОСТИ ======
+@timed("handler_seconds", route="expiry_enter_date")
 async def expiry_enter_date(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     text = (update.message.text or "").strip()
     # формат: ДД.ММ.ГГГГ, QTY
@@ -950,14 +3609,327 @@ async def expiry_enter_date(update: Update, context: ContextTypes.DEFAULT_TYPE)
         context.user_data["ui_state"] = "expiry_pick_item"
         return A_EXPIRY_PICK_ITEM
 
-    record_expiry(prod, dte, qty)
+    await record_expiry(prod, dte, qty)
     await update.message.reply_text(f"Срок годности записан: {prod} — до {dte.strftime('%d.%m.%Y')}, {qty:.0f} шт.")
     return A_RECEIVE_MENU
 
 
+# ================== ИСХОДЯЩИЕ СООБЩЕНИЯ ==================
+# Всё крупное (отчёты, рассылки) идёт через очередь: длинный текст режется
+# по строкам под лимит Telegram, подряд идущие сообщения в один чат
+# склеиваются, соблюдаются лимиты на чат и на бота, 429 обрабатывается.
+class RateLimiter:
+    """Равномерно: не чаще одного события в interval секунд."""
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self._next = 0.0
+
+    async def wait(self) -> None:
+        now = time.monotonic()
+        at = max(now, self._next)
+        self._next = at + self.interval
+        if at > now:
+            await asyncio.sleep(at - now)
+
+    def pause(self, seconds: float) -> None:
+        self._next = max(self._next, time.monotonic() + seconds)
+
+
+@dataclass
+class Delivery:
+    chat_id: int
+    ok: bool
+    attempts: int
+    error: str = ""
+
+
+@dataclass
+class _Outgoing:
+    text: str
+    kwargs: dict
+    future: asyncio.Future
+
+
+def split_message(text: str, limit: int = TG_MESSAGE_LIMIT) -> List[str]:
+    """Режет текст на части не длиннее limit, по возможности по границам строк."""
+    if len(text) <= limit:
+        return [text]
+    parts: List[str] = []
+    cur = ""
+    for line in text.split("\n"):
+        while len(line) > limit:  # одна строка длиннее лимита — режем как есть
+            if cur:
+                parts.append(cur)
+                cur = ""
+            parts.append(line[:limit])
+            line = line[limit:]
+        if cur and len(cur) + 1 + len(line) > limit:
+            parts.append(cur)
+            cur = line
+        else:
+            cur = f"{cur}\n{line}" if cur else line
+    if cur:
+        parts.append(cur)
+    return parts
+
+
+class Outbox:
+    """Очередь отправки: по воркеру на чат, общий лимит на бота."""
+
+    def __init__(self) -> None:
+        self._queues: Dict[int, List[_Outgoing]] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        self._chat_limits: Dict[int, RateLimiter] = {}
+        self._global = RateLimiter(1 / SEND_GLOBAL_RATE)
+
+    def send(self, bot, chat_id: int, text: str, **kwargs) -> List[asyncio.Future]:
+        """Ставит текст в очередь и сразу возвращает futures с Delivery по каждой части."""
+        loop = asyncio.get_running_loop()
+        parts = split_message(text)
+        queue = self._queues.setdefault(chat_id, [])
+        futures = []
+        for i, part in enumerate(parts):
+            kw = dict(kwargs)
+            if i < len(parts) - 1:
+                kw.pop("reply_markup", None)  # клавиатура — только под последней частью
+            fut = loop.create_future()
+            queue.append(_Outgoing(part, kw, fut))
+            futures.append(fut)
+        if chat_id not in self._workers:
+            self._workers[chat_id] = loop.create_task(self._run(bot, chat_id))
+        return futures
+
+    async def _run(self, bot, chat_id: int) -> None:
+        interval = SEND_GROUP_INTERVAL if chat_id < 0 else SEND_CHAT_INTERVAL
+        limiter = self._chat_limits.setdefault(chat_id, RateLimiter(interval))
+        queue = self._queues[chat_id]
+        batch: List[_Outgoing] = []
+        try:
+            while queue:
+                await limiter.wait()
+                await self._global.wait()
+                # пока ждали лимит, могло накопиться ещё — склеиваем простой текст
+                batch = [queue.pop(0)]
+                if not batch[0].kwargs:
+                    size = len(batch[0].text)
+                    while queue and not queue[0].kwargs and size + 2 + len(queue[0].text) <= TG_MESSAGE_LIMIT:
+                        size += 2 + len(queue[0].text)
+                        batch.append(queue.pop(0))
+                text = "\n\n".join(x.text for x in batch)
+                res = await self._deliver(bot, chat_id, text, batch[0].kwargs, limiter)
+                for x in batch:
+                    if not x.future.done():
+                        x.future.set_result(res)
+                batch = []
+        finally:
+            self._workers.pop(chat_id, None)
+            # воркер прервали или он упал: никто из ждущих (notify_admins(wait=True)) не должен висеть
+            failed = Delivery(chat_id, False, 0, "отправка прервана")
+            for x in batch + queue:
+                if not x.future.done():
+                    x.future.set_result(failed)
+            queue.clear()
+
+    async def _deliver(self, bot, chat_id: int, text: str, kwargs: dict, limiter: RateLimiter) -> Delivery:
+        """send_message с повторами: RetryAfter ждём сколько просят, сетевые сбои — с нарастающей паузой."""
+        delay = SEND_BACKOFF
+        err: Exception = RuntimeError("нет попыток")
+        for attempt in range(1, SEND_RETRIES + 1):
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                return Delivery(chat_id, True, attempt)
+            except RetryAfter as e:
+                err = e
+                wait = e.retry_after
+                secs = wait.total_seconds() if isinstance(wait, dt.timedelta) else float(wait)
+                log.warning("Flood control для чата %s: ждём %.0f с", chat_id, secs)
+                limiter.pause(secs)
+                self._global.pause(secs)
+                await limiter.wait()
+            except (Forbidden, BadRequest) as e:
+                # бот заблокирован / чат не найден — повторять бессмысленно
+                return Delivery(chat_id, False, attempt, str(e))
+            except (TimedOut, NetworkError) as e:
+                err = e
+                await asyncio.sleep(delay)
+                delay *= 2
+            except Exception as e:
+                # ChatMigrated и прочее, чего не ждали: не роняем воркер, отдаём неудачу
+                log.warning("Не доставлено в чат %s: %r", chat_id, e)
+                return Delivery(chat_id, False, attempt, str(e))
+        return Delivery(chat_id, False, SEND_RETRIES, str(err))
+
+
+OUTBOX = Outbox()
+
+
+async def send_report(message, text: str, **kwargs) -> None:
+    """Ответ отчётом в чат сообщения — через очередь, не дожидаясь отправки."""
+    OUTBOX.send(message.get_bot(), message.chat_id, text, **kwargs)
+
+
+# ================== ОТЧЁТЫ ПО СТРАНИЦАМ ==================
+# Отчёт считается один раз и режется на страницы; страницы лежат в кэше
+# чата, листание — edit_message_text того же сообщения без пересчёта.
+REPORT_PAGE_LINES = 25       # строк на странице
+REPORT_TTL = 15 * 60         # сколько живёт отчёт в кэше, сек
+REPORT_KEEP = 5              # отчётов на чат, старые вытесняются
+
+# chat_id -> {report_id: (истекает, заголовок, страницы)}
+REPORT_CACHE: Dict[int, Dict[str, Tuple[float, str, List[str]]]] = {}
+
+
+def paginate(lines: List[str], per_page: int = REPORT_PAGE_LINES, title: str = "") -> List[str]:
+    """Страницы по per_page строк; каждая с запасом влезает в одно сообщение."""
+    budget = TG_MESSAGE_LIMIT - len(title) - 40  # заголовок и «Стр. x/y»
+    pages: List[str] = []
+    for i in range(0, len(lines), per_page):
+        pages.extend(split_message("\n".join(lines[i:i + per_page]), budget))
+    return pages or [""]
+
+
+def _evict_reports(now: float) -> None:
+    for chat_id in list(REPORT_CACHE):
+        reports = REPORT_CACHE[chat_id]
+        for rid in [r for r, v in reports.items() if v[0] <= now]:
+            del reports[rid]
+        if not reports:
+            del REPORT_CACHE[chat_id]
+
+
+def cache_report(chat_id: int, title: str, pages: List[str]) -> str:
+    now = time.monotonic()
+    _evict_reports(now)
+    reports = REPORT_CACHE.setdefault(chat_id, {})
+    # случайный id, а не счётчик: после рестарта кнопки старых сообщений не должны
+    # листать чужой отчёт, закэшированный под тем же номером
+    rid = secrets.token_hex(4)
+    while rid in reports:
+        rid = secrets.token_hex(4)
+    reports[rid] = (now + REPORT_TTL, title, pages)
+    for old in list(reports)[:-REPORT_KEEP]:
+        del reports[old]
+    return rid
+
+
+def report_page_kb(rid: str, page: int, total: int) -> InlineKeyboardMarkup:
+    rows = []
+    if total > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("◀️", callback_data=f"rpage:{rid}:{page-1}"))
+        nav.append(InlineKeyboardButton(f"{page+1}/{total}", callback_data="noop"))
+        if page < total - 1:
+            nav.append(InlineKeyboardButton("▶️", callback_data=f"rpage:{rid}:{page+1}"))
+        rows.append(nav)
+    rows.append([InlineKeyboardButton("⬅️ Назад", callback_data="back"), InlineKeyboardButton("🏠 В начало", callback_data="home")])
+    return InlineKeyboardMarkup(rows)
+
+
+def render_page(title: str, pages: List[str], page: int) -> str:
+    return f"{title}\n\n{pages[page]}" if pages[page] else title
+
+
+async def show_report(q, title: str, lines: List[str], state: int) -> int:
+    """Показывает отчёт вместо текущего меню (первая страница) и кэширует остальные."""
+    pages = paginate(lines, title=title)
+    rid = cache_report(q.message.chat_id, title, pages)
+    await q.edit_message_text(render_page(title, pages, 0), reply_markup=report_page_kb(rid, 0, len(pages)))
+    return state
+
+
+async def flip_report(q, rid: str, page: int) -> Optional[int]:
+    """Листание: страница из кэша, без пересчёта отчёта.
+
+    Состояние диалога не трогаем (None): кнопки старого сообщения не должны
+    переключать пользователя из того места, где он сейчас.
+    """
+    _evict_reports(time.monotonic())
+    entry = REPORT_CACHE.get(q.message.chat_id, {}).get(rid)
+    if entry is None:
+        await q.edit_message_text(
+            "Отчёт устарел — открой его заново.",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back"),
+                                                InlineKeyboardButton("🏠 В начало", callback_data="home")]])
+        )
+        return None
+    _, title, pages = entry
+    page = max(0, min(page, len(pages) - 1))
+    await q.edit_message_text(render_page(title, pages, page), reply_markup=report_page_kb(rid, page, len(pages)))
+    return None
+
+
+# ================== РАССЫЛКИ АДМИНАМ ==================
+LAST_DELIVERIES: Dict[str, Tuple[dt.datetime, List[Delivery]]] = {}  # tag -> (когда, результаты)
+_BACKGROUND: set = set()  # ссылки на фоновые задачи, чтобы их не собрал GC
+
+
+async def notify_admins(bot, text: str, tag: str = "notify", wait: bool = True) -> List[Delivery]:
+    """Рассылка всем админам через общую очередь отправки.
+
+    Результаты доставки сохраняются в LAST_DELIVERIES[tag] (см. /deliveries).
+    С wait=False возвращается сразу, не блокируя хендлер.
+    """
+    futures = [(a, OUTBOX.send(bot, a, text)) for a in sorted(ACTIVE_ADMINS)]
+
+    async def collect() -> List[Delivery]:
+        results = []
+        for _, futs in futures:
+            parts = await asyncio.gather(*futs)
+            failed = [r for r in parts if not r.ok]
+            results.append(failed[0] if failed else parts[-1])
+        LAST_DELIVERIES[tag] = (venue_now(), results)
+        bad = [r for r in results if not r.ok]
+        if bad:
+            log.warning("Рассылка %s: не доставлено %d из %d (%s)", tag, len(bad), len(results),
+                        ", ".join(f"{r.chat_id}: {r.error}" for r in bad))
+        return results
+
+    if wait:
+        return await collect()
+    task = asyncio.get_running_loop().create_task(collect())
+    _BACKGROUND.add(task)
+    task.add_done_callback(_BACKGROUND.discard)
+    return []
+
+
+async def deliveries_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/deliveries — итоги последних рассылок и запусков джоб."""
+    if update.effective_user.id not in ACTIVE_ADMINS:
+        await update.message.reply_text("Команда доступна администраторам.")
+        return
+    lines = []
+    runs = load_state().get("job_runs", {})
+    for name in JOBS:
+        lines.append(f"⏰ {name}: последний запуск {runs.get(name, '—')}")
+    for tag, (when, results) in sorted(LAST_DELIVERIES.items()):
+        ok = sum(r.ok for r in results)
+        lines.append(f"✉️ {tag} ({when:%d.%m %H:%M}): доставлено {ok}/{len(results)}")
+        lines.extend(f"   ✗ {r.chat_id}: {r.error} (попыток {r.attempts})" for r in results if not r.ok)
+    await send_report(update.message, "\n".join(lines) or "Рассылок ещё не было.")
+
+
 # ================== СИСТЕМНЫЕ ДЖОБЫ ==================
+def job_last_run(name: str) -> Optional[dt.datetime]:
+    raw = load_state().get("job_runs", {}).get(name)
+    try:
+        return dt.datetime.fromisoformat(raw) if raw else None
+    except ValueError:
+        return None
+
+
+def mark_job_run(name: str, when: dt.datetime) -> None:
+    state = load_state()
+    state.setdefault("job_runs", {})[name] = when.isoformat(timespec="seconds")
+    save_state(state)
+
+
 async def job_daily_expiry(context: ContextTypes.DEFAULT_TYPE):
-    """Каждый день в 09:00 — проверка сроков, напоминание за месяц."""
+    """Каждый день в 09:00 — проверка сроков, напоминание за месяц.
+
+    Если бот лежал несколько дней, предупреждаем и за пропущенные дни.
+    """
     ensure_excel()
     try:
         exp = load_df(SHEET_EXPIRY)
@@ -966,38 +3938,229 @@ async def job_daily_expiry(context: ContextTypes.DEFAULT_TYPE):
     if exp.empty:
         return
     exp["expiry_date"] = pd.to_datetime(exp["expiry_date"], errors="coerce").dt.date
-    today = dt.date.today()
-    warn_date = today + dt.timedelta(days=30)
-    due = exp.loc[exp["expiry_date"] == warn_date]
+    today = venue_today()
+    last = job_last_run("daily_expiry")
+    since = last.astimezone(TZ).date() if last else today - dt.timedelta(days=1)
+    since = min(since, today - dt.timedelta(days=1))
+    # окно (последняя проверка + 30 дн.; сегодня + 30 дн.]
+    warn_from = since + dt.timedelta(days=31)
+    warn_to = today + dt.timedelta(days=30)
+    due = exp.loc[(exp["expiry_date"] >= warn_from) & (exp["expiry_date"] <= warn_to)]
     if due.empty:
         return
-    # отправляем активным администраторам
-    for admin_id in list(ACTIVE_ADMINS):
-        lines = [f"• {r['product']} — срок до {pd.to_datetime(r['expiry_date']).strftime('%d.%m.%Y')} ({int(r['qty'])} шт.)"
-                 for _, r in due.iterrows()]
-        if lines:
-            try:
-                await context.bot.send_message(
-                    chat_id=admin_id,
-                    text="Упс! Кажется, через месяц истекает срок годности:\n" + "\n".join(lines)
-                )
-            except Exception:
-                pass
+    lines = [f"• {r['product']} — срок до {pd.to_datetime(r['expiry_date']).strftime('%d.%m.%Y')} ({int(r['qty'])} шт.)"
+             for _, r in due.iterrows()]
+    await notify_admins(
+        context.bot,
+        "Упс! Кажется, через месяц истекает срок годности:\n" + "\n".join(lines),
+        tag="daily_expiry",
+    )
 
 
 async def job_tuesday_reminder(context: ContextTypes.DEFAULT_TYPE):
     """Каждый вторник в 10:00 — напоминание про заявку."""
-    for admin_id in list(ACTIVE_ADMINS):
+    await notify_admins(context.bot, "Алё? Пора закупаться!", tag="tuesday_reminder")
+
+
+# имя -> (функция, время, дни недели: 0=Пн ... 6=Вс)
+JOBS = {
+    "daily_expiry": (job_daily_expiry, dt.time(hour=9, minute=0), tuple(range(7))),
+    "tuesday_reminder": (job_tuesday_reminder, dt.time(hour=10, minute=0), (1,)),
+}
+
+
+def last_due(at: dt.time, days: Tuple[int, ...], now: dt.datetime) -> Optional[dt.datetime]:
+    """Последний момент по расписанию, который уже наступил."""
+    for back in range(8):
+        d = (now - dt.timedelta(days=back)).date()
+        if d.weekday() in days:
+            when = dt.datetime.combine(d, at, tzinfo=TZ)
+            if when <= now:
+                return when
+    return None
+
+
+JOB_LOCKS: Dict[str, asyncio.Lock] = {}
+
+
+async def run_due(name: str, context: ContextTypes.DEFAULT_TYPE, slack: dt.timedelta = dt.timedelta(0)) -> None:
+    """Запускает джобу, если её последний срок по расписанию ещё не отработан.
+
+    Плановый запуск и догонялка после старта могут сработать почти одновременно
+    (бот поднялся за секунды до 09:00) — лок и повторная проверка под ним дают один запуск.
+    """
+    func, at, days = JOBS[name]
+    async with JOB_LOCKS.setdefault(name, asyncio.Lock()):
+        now = venue_now()
+        last = job_last_run(name)
+        due = last_due(at, days, now + slack)
+        if due is None or (last is not None and last >= due):
+            log.info("Джоба %s за %s уже отработала — пропускаю", name, due and due.isoformat(timespec="minutes"))
+            return
         try:
-            await context.bot.send_message(chat_id=admin_id, text="Алё? Пора закупаться!")
+            with timer("job_seconds", job=name):
+                await func(context)
         except Exception:
-            pass
+            log.exception("Джоба %s упала", name)
+            return
+        mark_job_run(name, now)
 
 
-# ================== РЕГИСТРАЦИЯ ХЕНДЛЕРОВ ==================
-def build_app() -> Application:
+async def run_job(context: ContextTypes.DEFAULT_TYPE):
+    """Обёртка джобы: запускает и запоминает время запуска в bot_state.json."""
+    await until_warm()
+    # планировщик может дёрнуть чуть раньше срока — минута запаса, чтобы не принять его за вчерашний
+    await run_due(context.job.data, context, slack=dt.timedelta(minutes=1))
+
+
+async def catch_up_jobs(context: ContextTypes.DEFAULT_TYPE):
+    """После старта добираем запуски, пропущенные, пока бот лежал."""
+    await until_warm()
+    for name in JOBS:
+        if job_last_run(name) is None:
+            # первый запуск на этой машине — отсчитываем от сейчас
+            mark_job_run(name, venue_now())
+            continue
+        await run_due(name, context)
+
+
+# ================== МЕТРИКИ: ХЕНДЛЕРЫ ==================
+async def count_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    inc("updates_total", kind="callback" if update.callback_query else "message")
+
+
+async def metrics_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/metrics — перцентили времени хендлеров/хранилища/джоб и счётчики."""
+    if update.effective_user.id not in ACTIVE_ADMINS:
+        await update.message.reply_text("Команда доступна администраторам.")
+        return
+    await send_report(update.message, "Метрики (мс):\n" + metrics_summary())
+
+
+def _workbook_bytes() -> float:
+    return os.path.getsize(DATA_FILE) if os.path.exists(DATA_FILE) else 0.0
+
+
+GAUGES["workbook_bytes"] = _workbook_bytes
+GAUGES["report_cache_entries"] = lambda: sum(len(v) for v in REPORT_CACHE.values())
+GAUGES["active_admins"] = lambda: len(ACTIVE_ADMINS)
+GAUGES["store_movements"] = lambda: len(STORE)
+GAUGES["store_unflushed"] = lambda: STORE.last_seq - STORE.flushed_seq
+
+
+# ================== СТАРТ И ПРОГРЕВ ==================
+# Поллинг стартует сразу, а pandas, data.xlsx и состояния прогноза/детектора
+# поднимаются в фоне. Апдейты, которым нужен склад, ждут конца прогрева.
+WARM_READY: Optional[asyncio.Event] = None  # None — прогрева не было, ждать нечего
+STARTUP: Dict[str, float] = {}  # warmup / first_response, сек
+
+
+def warm_up() -> None:
+    """Тяжёлая часть старта (в отдельном потоке)."""
+    t0 = time.perf_counter()
     ensure_excel()
-    app = Application.builder().token(TOKEN).build()
+    get_store()
+    refresh_snapshot()
+    get_forecasts()
+    get_cube()
+    if ANOMALIES is None:
+        backfill_anomalies()
+    STARTUP["warmup"] = time.perf_counter() - t0
+    log.info("Прогрев завершён за %.2f с", STARTUP["warmup"])
+
+
+async def _run_warm_up() -> None:
+    try:
+        await asyncio.to_thread(warm_up)
+    except Exception:
+        log.exception("Прогрев не удался, дальше всё поднимется лениво")
+    finally:
+        WARM_READY.set()
+
+
+async def until_warm() -> None:
+    """Для джоб: склад и data.xlsx поднимает прогрев в потоке — не трогаем их параллельно с ним
+    (на старом большом файле это ещё и минуты записи прямо в цикле)."""
+    if WARM_READY is not None:
+        await WARM_READY.wait()
+
+
+WARMING_TEXT = "Бот прогревается после перезапуска, повтори через пару секунд 🙏"
+
+
+async def wait_warm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Пока идёт прогрев, отвечаем «прогревается» и отбрасываем апдейт; /start и /ping проходят.
+
+    Ждать прогрева тут нельзя: апдейты обрабатываются по одному, и ожидание
+    держало бы всю очередь.
+    """
+    if WARM_READY is None or WARM_READY.is_set():
+        return
+    text = update.message.text if update.message and update.message.text else ""
+    if text.split("@")[0] in ("/start", "/ping"):
+        return
+    inc("updates_rejected_warming_total")
+    try:
+        if update.callback_query:
+            await update.callback_query.answer(WARMING_TEXT)
+        elif update.effective_message:
+            await update.effective_message.reply_text(WARMING_TEXT)
+    except (BadRequest, Forbidden, TimedOut, NetworkError) as e:
+        log.warning("Не ответил про прогрев: %s", e)
+    raise ApplicationHandlerStop
+
+
+async def mark_first_response(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """После всех хендлеров первого апдейта — время от запуска процесса до ответа."""
+    if "first_response" in STARTUP:
+        return
+    STARTUP["first_response"] = time.monotonic() - PROCESS_STARTED
+    log.info("Первый ответ через %.2f с после запуска", STARTUP["first_response"])
+
+
+GAUGES["warmup_seconds"] = lambda: STARTUP["warmup"]
+GAUGES["time_to_first_response_seconds"] = lambda: STARTUP["first_response"]
+
+
+async def on_startup(app: Application) -> None:
+    global WARM_READY
+    WARM_READY = asyncio.Event()
+    app.bot_data["warm_up"] = asyncio.get_running_loop().create_task(_run_warm_up())
+    app.bot_data["metrics_server"] = await start_metrics_server()
+
+
+async def on_shutdown(app: Application) -> None:
+    """Остановка: журнал — в data.xlsx, чтобы файл был полным без доигрывания."""
+    try:
+        flush_store()
+    except Exception:
+        log.exception("Не удалось сбросить журнал в %s при остановке", DATA_FILE)
+
+
+async def job_flush_store(context: ContextTypes.DEFAULT_TYPE):
+    """По таймеру: журнал — в data.xlsx, новые движения — в аналитический снимок."""
+    await until_warm()
+    try:
+        await flush_store_async()
+    except Exception:
+        log.exception("Периодический flush в %s не удался, журнал цел", DATA_FILE)
+    try:
+        await refresh_snapshot_async()
+        snapshot_inventory()
+    except Exception:
+        log.exception("Не удалось обновить снимки (аналитический / остатков)")
+
+
+# ================== РЕГИСТРАЦИЯ ХЕНДЛЕРОВ ==================
+def build_app(request: Optional[BaseRequest] = None) -> Application:
+    """Собирает приложение. request — свой транспорт Bot API (например, заглушка в replay.py).
+
+    Excel здесь не трогаем — это делает фоновый прогрев в on_startup.
+    """
+    builder = Application.builder().token(TOKEN).post_init(on_startup).post_shutdown(on_shutdown)
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    app = builder.build()
 
     conv = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
@@ -1029,6 +4192,16 @@ def build_app() -> Application:
             A_EXPIRY_PICK_ITEM: [CallbackQueryHandler(cb_handler)],
             A_EXPIRY_ENTER_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, expiry_enter_date),
                                   CallbackQueryHandler(cb_handler)],
+            A_COUNT_MENU: [CallbackQueryHandler(cb_handler)],
+            A_COUNT_PICK_ITEM: [CallbackQueryHandler(cb_handler)],
+            A_COUNT_QTY: [MessageHandler(filters.TEXT & ~filters.COMMAND, count_qty),
+                          CallbackQueryHandler(cb_handler)],
+            A_STATS_RANGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, stats_range_enter),
+                            CallbackQueryHandler(cb_handler)],
+            A_IMPORT_UPLOAD: [MessageHandler(filters.Document.ALL, import_document),
+                              MessageHandler(filters.TEXT & ~filters.COMMAND, import_text),
+                              CallbackQueryHandler(cb_handler)],
+            A_IMPORT_CONFIRM: [CallbackQueryHandler(cb_handler)],
         },
         fallbacks=[CommandHandler("start", start)],
         per_message=False,
@@ -1036,13 +4209,21 @@ def build_app() -> Application:
 
     app.add_handler(conv)
     app.add_handler(CommandHandler("ping", ping))
+    app.add_handler(CommandHandler("anomalies", anomalies_cmd))
+    app.add_handler(CommandHandler("deliveries", deliveries_cmd))
+    app.add_handler(CommandHandler("metrics", metrics_cmd))
+    app.add_handler(CommandHandler("undo", undo_cmd))
+    app.add_handler(TypeHandler(Update, wait_warm), group=-2)
+    app.add_handler(TypeHandler(Update, count_update), group=-1)
+    app.add_handler(TypeHandler(Update, mark_first_response), group=99)
 
-    # Планировщик
+    # Планировщик: сроки годности ежедневно в 09:00, напоминание по вторникам в 10:00
+    restore_admins()
     jq = app.job_queue
-    # ежедневно в 09:00
-    jq.run_daily(job_daily_expiry, time=dt.time(hour=9, minute=0, tzinfo=TZ))
-    # каждый вторник в 10:00
-    jq.run_daily(job_tuesday_reminder, time=dt.time(hour=10, minute=0, tzinfo=TZ), days=(1,))  # 0=Пн, 1=Вт,...
+    for name, (_, at, days) in JOBS.items():
+        jq.run_daily(run_job, time=at.replace(tzinfo=TZ), days=days, name=name, data=name)
+    jq.run_once(catch_up_jobs, when=5)
+    jq.run_repeating(job_flush_store, interval=STORE_FLUSH_SECONDS, first=STORE_FLUSH_SECONDS, name="flush_store")
 
     return app
 
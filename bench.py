@@ -0,0 +1,316 @@
+# bench.py
+# -*- coding: utf-8 -*-
+"""Бенчмарк горячих путей хранилища и отчётов.
+
+Генерирует синтетическую историю (movements / inventory / settings / expiry)
+во временной папке и меряет время операций бота. Результаты — JSON Lines,
+по строке на (размер истории, операция), чтобы сравнивать прогоны и бэкенды.
+
+    python bench.py --sizes 10000,100000 --products 300 --repeat 5 --out bench.jsonl
+    python bench.py --backend excel --sizes 10000   # исходный бот (чистый Excel) для сравнения
+
+Бэкенды: parquet — хранилище в памяти и снимок для отчётов (как в проде),
+records — то же без снимка, excel — barkeeperbot.py из --baseline-ref.
+"""
+from __future__ import annotations
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+import importlib.util
+import statistics
+import datetime as dt
+from types import ModuleType, SimpleNamespace
+from typing import Callable, Dict, List
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")  # бот в сеть не ходит, токен нужен только для импорта
+
+import pandas as pd  # noqa: E402
+
+import barkeeperbot as bkb  # noqa: E402
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BACKENDS = ("parquet", "records", "excel")
+
+
+def load_baseline(ref: str) -> ModuleType:
+    """barkeeperbot.py из ревизии ref (по умолчанию — первый коммит, бот на чистом Excel)."""
+    if not ref:
+        ref = subprocess.run(["git", "rev-list", "--max-parents=0", "HEAD"], cwd=HERE,
+                             capture_output=True, text=True, check=True).stdout.split()[0]
+    src = subprocess.run(["git", "show", f"{ref}:barkeeperbot.py"], cwd=HERE,
+                         capture_output=True, text=True, check=True).stdout
+    path = os.path.join(tempfile.mkdtemp(prefix="bkb-baseline-"), "barkeeperbot_baseline.py")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(src)
+    spec = importlib.util.spec_from_file_location("barkeeperbot_baseline", path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    mod.BASELINE_REF = ref
+    return mod
+
+
+# ================== СИНТЕТИЧЕСКИЕ ДАННЫЕ ==================
+def product_names(n: int) -> List[str]:
+    names = list(bkb.ALL_PRODUCTS)
+    i = 0
+    while len(names) < n:
+        i += 1
+        names.append(f"Товар {i:04d}")
+    return names[:n]
+
+
+def generate_history(path: str, n_moves: int, n_products: int, days: int = 90, seed: int = 42) -> None:
+    """Пишет data.xlsx с n_moves движениями за последние days дней."""
+    rnd = random.Random(seed)
+    products = product_names(n_products)
+    now = dt.datetime.now()
+    start = now - dt.timedelta(days=days)
+    span = (now - start).total_seconds()
+    offsets = sorted(rnd.random() * span for _ in range(n_moves))
+    rows = []
+    for off in offsets:
+        receive = rnd.random() < 0.1
+        rows.append({
+            "ts": (start + dt.timedelta(seconds=off)).strftime("%Y-%m-%d %H:%M:%S"),
+            "who": "admin" if receive else "barman",
+            "action": "receive" if receive else "consume",
+            "user_id": rnd.randint(1, 12),
+            "product": rnd.choice(products),
+            "qty": float(rnd.randint(6, 24) if receive else rnd.randint(1, 5)),
+        })
+    mov = pd.DataFrame(rows, columns=["ts", "who", "action", "user_id", "product", "qty"])
+    signed = mov["qty"].where(mov["action"] != "consume", -mov["qty"])
+    inv = signed.groupby(mov["product"]).sum().rename("qty").reset_index()
+    inv.insert(1, "unit", "")
+    setdf = pd.DataFrame([
+        {"product": p, "poor_threshold": rnd.randint(0, 10), "luxe_threshold": rnd.randint(10, 30)}
+        for p in products
+    ])
+    exp = pd.DataFrame([
+        {"product": rnd.choice(products), "expiry_date": (now + dt.timedelta(days=rnd.randint(1, 120))).date(),
+         "qty": rnd.randint(1, 12)}
+        for _ in range(n_products)
+    ])
+    with pd.ExcelWriter(path, engine="openpyxl", mode="w") as w:
+        inv.to_excel(w, index=False, sheet_name=bkb.SHEET_INVENTORY)
+        mov.to_excel(w, index=False, sheet_name=bkb.SHEET_MOVES)
+        setdf.to_excel(w, index=False, sheet_name=bkb.SHEET_SETTINGS)
+        exp.to_excel(w, index=False, sheet_name=bkb.SHEET_EXPIRY)
+        if hasattr(bkb, "SHEET_STOCKTAKE"):
+            pd.DataFrame(columns=bkb.STOCKTAKE_COLUMNS).to_excel(w, index=False, sheet_name=bkb.SHEET_STOCKTAKE)
+        if hasattr(bkb, "SHEET_UNITS"):
+            # количества выше — в упаковках; без листа units бот счёл бы файл старым и перевёл бы разливное
+            bkb.default_units_frame().to_excel(w, index=False, sheet_name=bkb.SHEET_UNITS)
+
+
+# кэши модуля -> чем их сбросить; у исходного бота (excel) большинства нет
+_CACHES: Dict[str, Callable[[], object]] = {
+    "FORECASTS": lambda: None,
+    "ANOMALIES": lambda: None,
+    "CUBE": lambda: None,
+    "NAME_INDEX": lambda: None,
+    "SNAPSHOT_SEQ": lambda: None,
+    "_SNAPSHOT_WRITING": lambda: False,
+    "_EXCEL_CHECKED": lambda: None,
+    "_ARROW": lambda: None,
+}
+_CLEARED = ("ANOMALY_LOG", "REPORT_CACHE", "UNIT_OVERRIDES", "LAST_DELIVERIES", "JOB_LOCKS")
+
+
+def reset_caches(backend: str = "parquet") -> None:
+    """Сбрасывает всё, что бот держит в памяти между вызовами, и закрывает журнал хранилища."""
+    for name, fresh in _CACHES.items():
+        if hasattr(bkb, name):
+            setattr(bkb, name, fresh())
+    for name in _CLEARED:
+        if hasattr(bkb, name):
+            getattr(bkb, name).clear()
+    if getattr(bkb, "STORE", None) is not None:
+        bkb.STORE.close()
+        bkb.STORE = None  # хранилище перечитает свежую копию data.xlsx
+    if hasattr(bkb, "JOURNAL_FILE") and os.path.exists(bkb.JOURNAL_FILE):
+        os.remove(bkb.JOURNAL_FILE)
+    if hasattr(bkb, "ANALYTICS_DIR"):
+        shutil.rmtree(bkb.ANALYTICS_DIR, ignore_errors=True)  # снимок соберётся заново с этой истории
+    if backend == "records":
+        bkb._ARROW = False  # как без pyarrow: отчёты читают колонки хранилища в памяти
+
+
+# ================== ФЕЙКОВЫЙ TELEGRAM ==================
+class FakeBot:
+    def __init__(self) -> None:
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+        return SimpleNamespace(chat_id=chat_id, text=text)
+
+
+class FakeMessage:
+    def __init__(self, bot: FakeBot, chat_id: int, text: str = "") -> None:
+        self._bot = bot
+        self.chat_id = chat_id
+        self.text = text
+
+    def get_bot(self) -> FakeBot:
+        return self._bot
+
+    async def reply_text(self, text, **kwargs):
+        return await self._bot.send_message(self.chat_id, text, **kwargs)
+
+    async def reply_document(self, document, **kwargs):
+        return SimpleNamespace(document=SimpleNamespace(file_id="bench"))
+
+
+class FakeQuery:
+    def __init__(self, bot: FakeBot, user_id: int, data: str) -> None:
+        self.data = data
+        self.from_user = SimpleNamespace(id=user_id)
+        self.message = FakeMessage(bot, user_id)
+
+    async def answer(self, *args, **kwargs):
+        return True
+
+    async def edit_message_text(self, text, **kwargs):
+        return SimpleNamespace(text=text)
+
+
+def callback_update(bot: FakeBot, user_id: int, data: str):
+    q = FakeQuery(bot, user_id, data)
+    return SimpleNamespace(callback_query=q, effective_user=q.from_user, effective_message=q.message, message=None)
+
+
+def text_update(bot: FakeBot, user_id: int, text: str):
+    msg = FakeMessage(bot, user_id, text)
+    user = SimpleNamespace(id=user_id)
+    return SimpleNamespace(callback_query=None, effective_user=user, effective_message=msg, message=msg)
+
+
+def fake_context(bot: FakeBot, user_data: Dict) -> SimpleNamespace:
+    return SimpleNamespace(bot=bot, user_data=user_data, args=[], job=SimpleNamespace(data=None))
+
+
+# ================== ЗАМЕРЫ ==================
+def measure(fn: Callable[[], object], repeat: int) -> Dict[str, float]:
+    fn()  # прогрев: ленивые кэши, импорт движков
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return {
+        "runs": repeat,
+        "min_ms": min(times) * 1000,
+        "median_ms": statistics.median(times) * 1000,
+        "mean_ms": statistics.fmean(times) * 1000,
+        "max_ms": max(times) * 1000,
+    }
+
+
+def run_async(coro_fn: Callable[[], object]) -> Callable[[], object]:
+    loop = asyncio.new_event_loop()
+
+    async def call():
+        res = coro_fn()
+        return await res if asyncio.iscoroutine(res) else res  # у исходного бота часть операций синхронная
+
+    return lambda: loop.run_until_complete(call())
+
+
+def build_ops(products: List[str]) -> Dict[str, Callable[[], object]]:
+    bot = FakeBot()
+    rnd = random.Random(7)
+    ref = getattr(bkb, "product_ref", lambda name: name)  # исходный бот кладёт в кнопку имя
+    ops: Dict[str, Callable[[], object]] = {
+        "add_movement": lambda: bkb.add_movement("barman", "consume", 1, rnd.choice(products), 1.0),
+        "compute_stats_1": lambda: bkb.compute_stats(1),
+        "compute_stats_4": lambda: bkb.compute_stats(4),
+        "compute_stats_30": lambda: bkb.compute_stats(30),
+        "compute_order_poor": lambda: bkb.compute_order("poor"),
+        "record_expiry": run_async(lambda: bkb.record_expiry(
+            rnd.choice(products), dt.date.today() + dt.timedelta(days=rnd.randint(1, 90)), 1.0
+        )),
+        "job_daily_expiry": run_async(lambda: bkb.job_daily_expiry(fake_context(bot, {}))),
+    }
+
+    async def cb(data: str, user_data: Dict):
+        return await bkb.cb_handler(callback_update(bot, 1, data), fake_context(bot, user_data))
+
+    async def barmen_shift():
+        # полный путь бармена: роль -> категория -> напиток -> количество -> «это всё»
+        ud: Dict = {}
+        await cb("role:barmen", ud)
+        await cb("cat:bitem:strong:0", ud)
+        await cb(f"bchoose:{ref('Jagermeister')}", ud)
+        await bkb.barmen_qty(text_update(bot, 1, "2"), fake_context(bot, ud))
+        await cb("b:done", ud)
+
+    ops["cb_stats_30"] = run_async(lambda: cb("stats:30", {}))
+    ops["cb_dodep_poor"] = run_async(lambda: cb("dodep:poor", {}))
+    ops["cb_barmen_shift"] = run_async(barmen_shift)
+    return ops
+
+
+def main(argv: List[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="Бенчмарк хранилища и отчётов barkeeperbot")
+    ap.add_argument("--sizes", default="10000,100000", help="размеры истории через запятую (до 1000000)")
+    ap.add_argument("--products", type=int, default=300)
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--ops", default="", help="только эти операции (через запятую)")
+    ap.add_argument("--backend", choices=BACKENDS, default="parquet",
+                    help="parquet — как в проде, records — без снимка, excel — исходный бот (базовая линия)")
+    ap.add_argument("--baseline-ref", default="", help="ревизия бота для --backend excel (по умолчанию первый коммит)")
+    ap.add_argument("--out", default="-", help="файл JSON Lines (по умолчанию stdout)")
+    args = ap.parse_args(argv)
+
+    global bkb
+    if args.backend == "excel":
+        bkb = load_baseline(args.baseline_ref)
+    elif args.backend == "parquet" and bkb._arrow() is None:
+        args.backend = "records"  # pyarrow не установлен — снимка не будет, так и пишем в результаты
+    sizes = [int(x) for x in args.sizes.split(",") if x]
+    only = {x for x in args.ops.split(",") if x}
+    out = sys.stdout if args.out == "-" else open(args.out, "a", encoding="utf-8")
+    meta = {
+        "backend": args.backend,
+        "revision": getattr(bkb, "BASELINE_REF", "HEAD"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "started": dt.datetime.now().isoformat(timespec="seconds"),
+    }
+    workdir = tempfile.mkdtemp(prefix="bkb-bench-")
+    os.chdir(workdir)  # data.xlsx и bot_state.json бота — относительные пути
+    try:
+        for n in sizes:
+            template = os.path.join(workdir, f"history-{n}.xlsx")
+            generate_history(template, n, args.products)
+            size_bytes = os.path.getsize(template)
+            products = product_names(args.products)
+            for name, fn in build_ops(products).items():
+                if only and name not in only:
+                    continue
+                # каждая операция стартует с одинаковой истории
+                shutil.copyfile(template, bkb.DATA_FILE)
+                reset_caches(args.backend)
+                res = measure(fn, args.repeat)
+                rec = {**meta, "op": name, "movements": n, "products": args.products,
+                       "workbook_bytes": size_bytes, **res}
+                out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
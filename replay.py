@@ -0,0 +1,292 @@
+# replay.py
+# -*- coding: utf-8 -*-
+"""Офлайн-прогон бота потоком апдейтов — без сети, с заглушкой Bot API.
+
+Генерирует (или читает из JSON Lines) апдейты, где N барменов одновременно
+закрывают смену по цепочке B_CAT -> B_ITEM -> B_QTY -> B_CONFIRM, и кладёт их
+в update_queue запущенного приложения из build_app() — как это делает поллинг:
+с post_init (фоновый прогрев) и той же очерёдностью обработки апдейтов.
+Каждый бармен шлёт следующий апдейт, только когда бот ответил на предыдущий.
+В конце печатает JSON: пропускную способность, задержки от постановки в очередь
+до конца обработки (p50/p95/p99), вызовы Bot API и сверку итоговых остатков.
+
+    python replay.py --bartenders 12 --items 6 --seed 2
+    python replay.py --record rush.jsonl        # сохранить сгенерированный поток
+    python replay.py --input rush.jsonl         # воспроизвести записанный
+"""
+from __future__ import annotations
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import statistics
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+os.environ.setdefault("BOT_TOKEN", "0:replay")  # в сеть не ходим, токен нужен только для импорта
+
+import pandas as pd  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import TypeHandler  # noqa: E402
+from telegram.request import BaseRequest, RequestData  # noqa: E402
+
+import barkeeperbot as bkb  # noqa: E402
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "BarKeeper", "username": "barkeeper_replay_bot"}
+INITIAL_STOCK = 1000.0
+
+
+# ================== ЗАГЛУШКА BOT API ==================
+class StubRequest(BaseRequest):
+    """Отвечает на вызовы Bot API локально и считает их."""
+
+    def __init__(self) -> None:
+        self.calls: Counter = Counter()
+        self._message_id = 10_000
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    def _message(self, params: Dict) -> Dict:
+        self._message_id += 1
+        chat_id = int(params.get("chat_id", 0))
+        msg = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+        if "document" in params:
+            msg["document"] = {"file_id": f"stub-{self._message_id}", "file_unique_id": str(self._message_id)}
+        return msg
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None,
+                         pool_timeout=None) -> Tuple[int, bytes]:
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] += 1
+        params = request_data.parameters if request_data else {}
+        if endpoint == "getMe":
+            result = BOT_USER
+        elif endpoint in ("sendMessage", "sendDocument"):
+            result = self._message(params)
+        elif endpoint == "editMessageText":
+            result = self._message(params)
+            result["message_id"] = int(params.get("message_id", result["message_id"]))
+        else:
+            result = True  # answerCallbackQuery, deleteWebhook и прочее
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+# ================== ПОТОК АПДЕЙТОВ ==================
+def closing_rush(bartenders: int, items: int, seed: int) -> List[List[Dict]]:
+    """По списку апдейтов на бармена: /start, роль, затем items позиций и «это всё»."""
+    rnd = random.Random(seed)
+    update_id = 0
+    streams: List[List[Dict]] = []
+    cats = list(bkb.CATEGORIES)
+    for k in range(bartenders):
+        uid = 1000 + k
+        user = {"id": uid, "is_bot": False, "first_name": f"Бармен {k + 1}"}
+        chat = {"id": uid, "type": "private"}
+        menu_msg = {"message_id": 1, "date": 0, "chat": chat, "from": BOT_USER, "text": "menu"}
+        seq: List[Dict] = []
+
+        def cb(data: str) -> None:
+            nonlocal update_id
+            update_id += 1
+            seq.append({"update_id": update_id, "callback_query": {
+                "id": str(update_id), "from": user, "chat_instance": str(uid), "data": data, "message": menu_msg,
+            }})
+
+        def text(t: str) -> None:
+            nonlocal update_id
+            update_id += 1
+            msg = {"message_id": update_id, "date": 0, "chat": chat, "from": user, "text": t}
+            if t.startswith("/"):
+                msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(t)}]
+            seq.append({"update_id": update_id, "message": msg})
+
+        text("/start")
+        cb("role:barmen")
+        for i in range(items):
+            cat = rnd.choice(cats)
+            prod = rnd.choice(bkb.CATEGORIES[cat]["items"])
+            cb(f"cat:bitem:{cat}:0")
+            cb(f"bchoose:{bkb.product_ref(prod)}")
+            text(str(rnd.randint(1, 6)))
+            cb("b:more" if i < items - 1 else "b:done")
+        streams.append(seq)
+    return streams
+
+
+def load_streams(path: str) -> List[List[Dict]]:
+    """JSON Lines с апдейтами; поток делится по отправителю, порядок внутри сохраняется."""
+    by_user: Dict[int, List[Dict]] = defaultdict(list)
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                u = json.loads(line)
+                sender = (u.get("message") or u.get("callback_query") or {}).get("from", {}).get("id", 0)
+                by_user[sender].append(u)
+    return list(by_user.values())
+
+
+def expected_consumption(streams: List[List[Dict]]) -> Dict[str, float]:
+    """Сколько должно списаться: число из сообщения после выбора напитка."""
+    out: Dict[str, float] = defaultdict(float)
+    for seq in streams:
+        product = None
+        for u in seq:
+            data = (u.get("callback_query") or {}).get("data", "")
+            if data.startswith("bchoose:"):
+                product = bkb.product_by_ref(data.split(":", 1)[1])
+            text = (u.get("message") or {}).get("text", "")
+            if product and text and not text.startswith("/"):
+                out[product] += float(text.replace(",", "."))
+                product = None
+    return dict(out)
+
+
+# ================== ПРОГОН ==================
+def seed_inventory() -> None:
+    """Стартовые остатки — пересчётом (count), чтобы журнал и inventory сходились."""
+    ts = pd.Timestamp.now().strftime("%Y-%m-%d %H:%M:%S")
+    products = list(dict.fromkeys(bkb.ALL_PRODUCTS))  # одно имя бывает в двух категориях
+    inv = pd.DataFrame([{"product": p, "unit": "", "qty": INITIAL_STOCK} for p in products])
+    mov = pd.DataFrame([{"ts": ts, "who": "admin", "action": "count", "user_id": 0, "product": p, "qty": INITIAL_STOCK}
+                        for p in products])
+    bkb.save_df_map({bkb.SHEET_INVENTORY: inv, bkb.SHEET_MOVES: mov})
+
+
+async def replay(streams: List[List[Dict]], think_ms: float) -> Dict:
+    stub = StubRequest()
+    app = bkb.build_app(request=stub)
+    latencies: List[float] = []
+    errors: List[str] = []
+    pending: Dict[int, Tuple[float, asyncio.Future]] = {}  # update_id -> (поставлен в очередь, готов)
+
+    async def on_error(update: object, context) -> None:
+        uid = getattr(update, "update_id", "?")
+        errors.append(f"{uid}: {context.error!r}")
+
+    async def on_done(update: Update, context) -> None:
+        # последняя группа: апдейт прошёл все хендлеры (ошибки не мешают — их ловит on_error)
+        queued, fut = pending.pop(update.update_id, (None, None))
+        if fut is not None:
+            latencies.append(time.perf_counter() - queued)
+            fut.set_result(None)
+
+    app.add_error_handler(on_error)
+    app.add_handler(TypeHandler(Update, on_done), group=1000)
+    # как run_polling: initialize -> post_init (прогрев в фоне) -> start
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    # пока идёт прогрев, бот отвечает «прогревается» и апдейт отбрасывает — смена начинается после него
+    await bkb.until_warm()
+
+    async def bartender(seq: List[Dict]) -> None:
+        loop = asyncio.get_running_loop()
+        for raw in seq:
+            upd = Update.de_json(raw, app.bot)
+            fut = loop.create_future()
+            pending[upd.update_id] = (time.perf_counter(), fut)
+            await app.update_queue.put(upd)
+            await fut  # бармен ждёт ответа, прежде чем тапнуть дальше
+            if think_ms:
+                await asyncio.sleep(think_ms / 1000)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(bartender(seq) for seq in streams))
+    wall = time.perf_counter() - t0
+    # дождаться фоновых отправок (алерты, отчёты)
+    await asyncio.gather(*list(bkb.OUTBOX._workers.values()), return_exceptions=True)
+    await app.stop()
+    await app.shutdown()
+    if app.post_shutdown:
+        await app.post_shutdown(app)
+
+    lat = sorted(latencies)
+    pct = (lambda q: lat[min(len(lat) - 1, int(q * len(lat)))] * 1000) if lat else (lambda q: 0.0)
+    return {
+        "bartenders": len(streams),
+        "concurrent_updates": app.concurrent_updates,
+        "startup_s": dict(bkb.STARTUP),
+        "updates": len(latencies),
+        "wall_s": wall,
+        "throughput_ups": len(latencies) / wall if wall else 0.0,
+        "latency_ms": {"p50": pct(0.5), "p95": pct(0.95), "p99": pct(0.99),
+                       "mean": statistics.fmean(lat) * 1000 if lat else 0.0},
+        "api_calls": dict(stub.calls),
+        "errors": errors,
+    }
+
+
+def check_consistency(streams: List[List[Dict]]) -> Dict:
+    expected = expected_consumption(streams)
+    inv = bkb.load_df(bkb.SHEET_INVENTORY)
+    mov = bkb.load_df(bkb.SHEET_MOVES)
+    sheet = dict(zip(inv["product"].astype(str), pd.to_numeric(inv["qty"], errors="coerce").fillna(0.0)))
+    consumed = mov.loc[mov["action"] == "consume"].groupby("product")["qty"].sum()
+    mismatches = []
+    for prod, qty in sorted(expected.items()):
+        want = INITIAL_STOCK - qty
+        got = sheet.get(prod)
+        logged = float(consumed.get(prod, 0.0))
+        if got is None or abs(got - want) > 1e-9 or abs(logged - qty) > 1e-9:
+            mismatches.append({"product": prod, "expected": want, "inventory": got, "logged_consume": logged})
+    return {
+        "products": len(expected),
+        "expected_entries": sum(1 for seq in streams for u in seq
+                                if not (u.get("message") or {}).get("text", "/").startswith("/")),
+        "logged_entries": int((mov["action"] == "consume").sum()),
+        "inventory_vs_log_drift": len(bkb.inventory_drift()),
+        "mismatches": mismatches,
+        "consistent": not mismatches,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Офлайн-прогон barkeeperbot потоком апдейтов")
+    ap.add_argument("--bartenders", type=int, default=8)
+    ap.add_argument("--items", type=int, default=5, help="позиций на смену у каждого бармена")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--think-ms", type=float, default=0.0, help="пауза между тапами одного бармена")
+    ap.add_argument("--input", help="JSON Lines с записанными апдейтами вместо генерации")
+    ap.add_argument("--record", help="сохранить сгенерированный поток в JSON Lines")
+    args = ap.parse_args(argv)
+
+    streams = load_streams(args.input) if args.input else closing_rush(args.bartenders, args.items, args.seed)
+    if args.record:
+        with open(args.record, "w", encoding="utf-8") as f:
+            for seq in streams:
+                for u in seq:
+                    f.write(json.dumps(u, ensure_ascii=False) + "\n")
+
+    os.chdir(tempfile.mkdtemp(prefix="bkb-replay-"))  # свой data.xlsx и bot_state.json
+    bkb.ensure_excel()
+    seed_inventory()
+    result = asyncio.run(replay(streams, args.think_ms))
+    result["consistency"] = check_consistency(streams)
+    json.dump(result, sys.stdout, ensure_ascii=False, indent=2)
+    sys.stdout.write("\n")
+    return 0 if result["consistency"]["consistent"] and not result["errors"] else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
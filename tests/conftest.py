@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "0:test")  # бот в сеть не ходит, токен нужен только для импорта
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bench  # noqa: E402
+import barkeeperbot as bkb  # noqa: E402
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    """Бот над пустым data.xlsx во временной папке (пути у бота относительные)."""
+    monkeypatch.chdir(tmp_path)
+    bench.reset_caches()
+    bkb.ensure_excel()
+    yield bkb
+    bench.reset_caches()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import io
+
+import pytest
+
+SPIRIT = "Bacardi Spiced"
+
+
+def parse(bot, text, filename="invoice.csv", kind="receive", encoding="utf-8"):
+    return bot.parse_import(text.encode(encoding), filename, kind, bot.name_index())
+
+
+def test_receive_with_units_and_expiry(bot):
+    plan = parse(bot, "Накладная №5;;;\nТовар;Количество;Ед.;Срок годности\n"
+                      f"{SPIRIT};2;;01.03.2027\n{SPIRIT.lower()};250;мл;\nИтого;;;\n", encoding="cp1251")
+    assert plan.rows == 2
+    assert plan.qty == {SPIRIT: 1650}
+    assert sum(plan.lots.values()) == 1400
+    assert plan.skipped == []
+
+
+def test_bad_rows_are_skipped(bot):
+    plan = parse(bot, "Товар,Количество,Срок годности\n"
+                      "Неизвестный ром,1,\n"
+                      f"{SPIRIT},много,\n"
+                      f"{SPIRIT},1,когда-нибудь\n")
+    assert plan.qty == {SPIRIT: 700}
+    assert len(plan.skipped) == 3
+    assert "нет в каталоге" in plan.skipped[0]
+    assert "не понял количество" in plan.skipped[1]
+    assert "принят без срока" in plan.skipped[2]
+
+
+def test_fuzzy_match_is_reported(bot):
+    plan = parse(bot, "Товар;Количество\nSpiced Bacardi;1\nBacardi Spicd;1\n")
+    assert plan.qty == {SPIRIT: 1400}
+    assert plan.guessed == {"Bacardi Spicd": SPIRIT}  # порядок слов — точное совпадение, опечатка — догадка
+
+
+@pytest.mark.parametrize("data, filename, message", [
+    (b"product;qty\n", "invoice.pdf", "нужен файл"),
+    (b"not a zip", "invoice.xlsx", "XLSX"),
+    (b"a;b\n1;2\n", "invoice.csv", "не нашёл заголовков"),
+])
+def test_file_errors(bot, data, filename, message):
+    with pytest.raises(bot.ImportFileError, match=message):
+        bot.parse_import(data, filename, "receive", bot.name_index())
+
+
+def test_too_many_rows(bot, monkeypatch):
+    monkeypatch.setattr(bot, "IMPORT_MAX_ROWS", 3)
+    text = "Товар;Количество\n" + f"{SPIRIT};1\n" * 4
+    with pytest.raises(bot.ImportFileError, match="больше 3 строк"):
+        parse(bot, text)
+
+
+def test_xlsx(bot):
+    import openpyxl
+
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.append(["Товар", "Количество", "Ед."])
+    ws.append([SPIRIT, 3, "порц"])
+    buf = io.BytesIO()
+    wb.save(buf)
+    plan = bot.parse_import(buf.getvalue(), "count.xlsx", "count", bot.name_index())
+    assert plan.qty == {SPIRIT: 120}
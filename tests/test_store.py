@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import json
+
+SPIRIT = "Bacardi Spiced"
+DRAFT = "Речка Вишня"
+
+
+def reload_store(bot):
+    """Как после падения: data.xlsx не сброшен, хранилище поднимается заново из файла и журнала."""
+    if bot.STORE is not None:
+        bot.STORE.close()
+    bot.STORE = None
+    return bot.get_store()
+
+
+def test_journal_replay_after_crash(bot):
+    bot.add_movement("admin", "receive", 1, SPIRIT, 10)
+    bot.add_movement("barman", "consume", 2, SPIRIT, 0, base=120)
+    before = bot.get_store().movements_frame(["seq", "action", "product", "qty_base"])
+    store = reload_store(bot)
+    assert store.stock_base(SPIRIT) == 10 * 700 - 120
+    assert store.movements_frame(["seq", "action", "product", "qty_base"]).equals(before)
+
+
+def test_journal_skips_torn_line_and_flushed_rows(bot):
+    bot.add_movement("admin", "receive", 1, SPIRIT, 2)
+    bot.flush_store()
+    bot.add_movement("barman", "consume", 2, SPIRIT, 1)
+    with open(bot.JOURNAL_FILE, "a", encoding="utf-8") as f:
+        f.write('[99, "2026-01-0')  # недописанная при падении строка
+    store = reload_store(bot)
+    assert len(store) == 2
+    assert store.stock_base(SPIRIT) == 700
+
+
+def test_journal_legacy_line_without_base(bot):
+    # строка до qty_base: количество разливного — в бутылках по 0,5 л
+    with open(bot.JOURNAL_FILE, "w", encoding="utf-8") as f:
+        f.write(json.dumps([1, "2026-01-05 12:00:00", "admin", "receive", 1, DRAFT, 4]) + "\n")
+    store = reload_store(bot)
+    assert store.stock_base(DRAFT) == 2000
+
+
+def test_undo_last(bot):
+    bot.add_movement("admin", "count", 1, SPIRIT, 5)
+    bot.add_movement("barman", "consume", 2, SPIRIT, 1)
+    bot.add_movement("barman", "consume", 2, SPIRIT, 0, base=40)
+    bot.add_movement("barman", "consume", 3, SPIRIT, 0, base=80)  # чужая запись
+
+    assert bot.undo_last(2) == [("consume", SPIRIT, 40)]
+    assert bot.undo_last(2) == [("consume", SPIRIT, 700)]
+    assert bot.undo_last(2) == []  # пересчёт админа и уже отменённое не трогаем
+    assert bot.get_store().stock_base(SPIRIT) == 5 * 700 - 80
+    assert bot.undo_last(1) == []  # пересчёт отменяется новым пересчётом, а не /undo
+
+
+def test_undo_survives_reload(bot):
+    bot.add_movement("barman", "consume", 2, SPIRIT, 1)
+    bot.undo_last(2, n=5)
+    store = reload_store(bot)
+    assert store.stock_base(SPIRIT) == 0
+    assert bot.undo_last(2) == []
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import barkeeperbot as bkb
+
+SPIRIT = "Bacardi Spiced"          # strong: бутылка 700 мл, порция 40 мл
+DRAFT = "Речка Вишня"              # beer_draft: кег 30 л, бокал 500 мл
+BOTTLED = "Миллер Стекло"          # beer_bottle: штуки
+
+
+@pytest.mark.parametrize("text, base", [
+    ("2", 1400),
+    ("1,5", 1050),
+    ("2 бут", 1400),
+    ("2 бутылки", 1400),
+    ("1 уп", 700),
+    ("3 порции", 120),
+    ("3 шота", 120),
+    ("250 мл", 250),
+    ("0,5 л", 500),
+    ("5 cl", 50),
+])
+def test_spirit(text, base):
+    assert bkb.parse_quantity(text, SPIRIT) == base
+
+
+@pytest.mark.parametrize("text, base", [
+    ("1", 30000),       # без единиц — кеги, а не бутылки по 0,5 л
+    ("1 кег", 30000),
+    ("2 бокала", 1000),
+    ("1.5 л", 1500),
+])
+def test_draft(text, base):
+    assert bkb.parse_quantity(text, DRAFT) == base
+
+
+@pytest.mark.parametrize("text", ["3", "3 шт", "3 бут", "3 бутылки", "3 банки"])
+def test_pieces_accept_bottles_and_cans(text):
+    assert bkb.parse_quantity(text, BOTTLED) == 3
+
+
+@pytest.mark.parametrize("text, product", [
+    ("", SPIRIT),
+    ("abc", SPIRIT),
+    ("-1", SPIRIT),
+    ("1 кег", SPIRIT),        # кег у бутылочного
+    ("250 мл", BOTTLED),      # мл у штучного
+    ("2 порции", BOTTLED),    # штучное не наливается
+    ("2 ведра", DRAFT),
+])
+def test_rejected(text, product):
+    assert bkb.parse_quantity(text, product) is None
+
+
+def test_unit_overrides(bot):
+    units = bot.default_units_frame()
+    units.loc[units["product"] == SPIRIT, "pack_size"] = 500
+    bot.set_unit_overrides(units)
+    assert bot.parse_quantity("2", SPIRIT) == 1000
+    assert bot.fmt_qty(SPIRIT, 1040) == "2.08 бут (1040 мл)"